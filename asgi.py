@@ -0,0 +1,657 @@
+"""Modalità di servizio asincrona (ASGI) del backend bot WhatsApp.
+
+Avvio, al posto di `gunicorn main:app`:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+oppure con più processi:
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker -w 4
+
+Webhook WhatsApp, /api/risposta e /api/completa girano nell'event loop: una
+richiesta in attesa è una coroutine, non un thread, e un processo regge
+migliaia di richieste in corso. SQLite non ha un'interfaccia asincrona: bot
+e outbox lavorano in un pool di thread piccolo e limitato. Anche gli invii
+dell'outbox (Twilio e FCM) partono dall'event loop con aiohttp, al posto dei
+thread worker di main. Anche il change feed (/api/eventi in SSE e
+/api/eventi/attendi) è servito dall'event loop: un client collegato è una
+coroutine in attesa, non un thread, e centinaia di dashboard non tolgono
+posti alle altre route. Tutte le altre route sono servite dall'app Flask
+(WSGI) in un pool di thread separato.
+"""
+
+import os
+
+# L'outbox viene consegnato dall'event loop: niente thread worker in main
+os.environ.setdefault('OUTBOX_WORKER', '0')
+
+import asyncio  # noqa: E402
+import contextvars  # noqa: E402
+import functools  # noqa: E402
+import io  # noqa: E402
+import json  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from urllib.parse import parse_qsl  # noqa: E402
+
+import aiohttp  # noqa: E402
+from twilio.base.exceptions import TwilioRestException  # noqa: E402
+from twilio.http.async_http_client import AsyncTwilioHttpClient  # noqa: E402
+from twilio.rest import Client  # noqa: E402
+from werkzeug.datastructures import MultiDict  # noqa: E402
+
+import main  # noqa: E402
+from main import campi, log, metriche  # noqa: E402
+
+# ==================== CONFIGURAZIONE ====================
+
+# Thread per il lavoro su SQLite (bot, outbox) e per le route Flask
+ASGI_THREAD_DB = int(os.getenv('ASGI_THREAD_DB', '8'))
+ASGI_THREAD_WSGI = int(os.getenv('ASGI_THREAD_WSGI', '32'))
+# Invii (Twilio/FCM) in volo contemporaneamente per processo
+ASGI_INVII_CONCORRENTI = int(os.getenv('ASGI_INVII_CONCORRENTI', '100'))
+ASGI_CORPO_MAX = 1024 * 1024  # byte accettati nel corpo di una richiesta
+
+_pool_db = ThreadPoolExecutor(ASGI_THREAD_DB, thread_name_prefix='asgi-db')
+_pool_wsgi = ThreadPoolExecutor(ASGI_THREAD_WSGI,
+                                thread_name_prefix='asgi-wsgi')
+
+
+async def in_thread(pool, funzione, *argomenti):
+    """Esegue una funzione bloccante nel pool, con il contesto di log della
+    richiesta (contextvars)"""
+    contesto = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        pool, functools.partial(contesto.run, funzione, *argomenti))
+
+
+# ==================== RICHIESTE E RISPOSTE ====================
+
+
+class Richiesta:
+    """Richiesta HTTP ASGI già letta: metodo, header, corpo"""
+
+    def __init__(self, scope, corpo):
+        self.scope = scope
+        self.metodo = scope['method']
+        self.percorso = scope['path']
+        self.corpo = corpo
+        self.headers = {
+            nome.decode('latin-1').lower(): valore.decode('latin-1')
+            for nome, valore in scope['headers']
+        }
+
+    @property
+    def ip(self):
+        """IP del client visto dal proxy fidato, come in main.ip_client"""
+        # Header ripetuti: una sola catena, nell'ordine di arrivo
+        inoltrato = ','.join(
+            valore.decode('latin-1') for nome, valore in self.scope['headers']
+            if nome.lower() == b'x-forwarded-for')
+        client = self.scope.get('client')
+        return main.ip_client(inoltrato, client[0] if client else '')
+
+    @property
+    def url(self):
+        """URL completo come lo vede il server (request.url di Flask)"""
+        host = self.headers.get('host')
+        if not host:
+            server = self.scope.get('server') or ('localhost', None)
+            host = f'{server[0]}:{server[1]}' if server[1] else server[0]
+        url = (f"{self.scope['scheme']}://{host}"
+               f"{self.scope.get('root_path', '')}{self.percorso}")
+        if self.scope['query_string']:
+            url += '?' + self.scope['query_string'].decode('latin-1')
+        return url
+
+    @property
+    def args(self):
+        """Parametri della query string (request.args di Flask)"""
+        return MultiDict(
+            parse_qsl(self.scope['query_string'].decode('latin-1'),
+                      keep_blank_values=True))
+
+    def form(self):
+        return MultiDict(
+            parse_qsl(self.corpo.decode('utf-8', 'replace'),
+                      keep_blank_values=True))
+
+    def json(self):
+        return json.loads(self.corpo or b'null')
+
+
+# Il client ha chiuso la connessione prima di finire di mandare il corpo
+_DISCONNESSO = object()
+
+
+async def _leggi_corpo(receive):
+    """Corpo completo della richiesta, None se supera ASGI_CORPO_MAX,
+    _DISCONNESSO se il client se ne va prima"""
+    parti = []
+    dimensione = 0
+    while True:
+        messaggio = await receive()
+        if messaggio['type'] == 'http.disconnect':
+            return _DISCONNESSO
+        parti.append(messaggio.get('body', b''))
+        dimensione += len(parti[-1])
+        if dimensione > ASGI_CORPO_MAX:
+            return None
+        if not messaggio.get('more_body'):
+            return b''.join(parti)
+
+
+def _intestazioni(tipo, extra=None):
+    intestazioni = [(b'content-type', tipo.encode()),
+                    # Come CORS(app) di main per le route Flask
+                    (b'access-control-allow-origin', b'*')]
+    if extra:
+        intestazioni += [(nome.lower().encode(), valore.encode())
+                         for nome, valore in extra.items()]
+        intestazioni.append((b'access-control-expose-headers',
+                             ', '.join(extra).encode()))
+    return intestazioni
+
+
+async def _rispondi(send,
+                    corpo,
+                    stato=200,
+                    tipo='text/plain; charset=utf-8',
+                    extra=None):
+    if not isinstance(corpo, bytes):
+        corpo = corpo.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': stato,
+        'headers': _intestazioni(tipo, extra) +
+        [(b'content-length', str(len(corpo)).encode())]
+    })
+    await send({'type': 'http.response.body', 'body': corpo})
+
+
+def _json(corpo, stato, extra=None):
+    return (json.dumps(corpo, ensure_ascii=False), stato, 'application/json',
+            extra)
+
+
+# ==================== ROUTE ASINCRONE ====================
+
+
+async def webhook_whatsapp(richiesta):
+    """Come main.webhook_whatsapp: controlli nell'event loop, bot nel pool"""
+    form = richiesta.form()
+    # La configurazione delle officine è già in memoria; il database
+    # dell'officina si apre solo al primo messaggio
+    officina = await in_thread(_pool_db, main.officine.da_numero,
+                               form.get('To'))
+    controlli = functools.partial(
+        main.controlla_webhook, officina, richiesta.ip,
+        lambda: main.url_webhook(richiesta.url,
+                                 richiesta.headers.get('x-forwarded-proto')),
+        form, richiesta.headers.get('x-twilio-signature'))
+    # Con i limitatori su SQLite i controlli possono aspettare un lock:
+    # mai nell'event loop
+    if main.limite_ip.bloccante or main.limite_numeri.bloccante:
+        esito = await in_thread(_pool_db, controlli)
+    else:
+        esito = controlli()
+    if esito is None:
+        esito = (await in_thread(_pool_db, main.rispondi_webhook, officina,
+                                 form), 200)
+    corpo, stato = esito
+    return corpo, stato, 'text/xml; charset=utf-8', None
+
+
+async def invia_risposta(richiesta):
+    officina, errore = await _officina(richiesta)
+    if officina is None:
+        return _json(*errore)
+    try:
+        dati = richiesta.json() or {}
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return _json({'error': 'JSON non valido'}, 400)
+    return _json(*await in_thread(_pool_db, main.accoda_risposta, officina,
+                                  dati,
+                                  richiesta.headers.get('idempotency-key')))
+
+
+async def completa_richiesta(richiesta):
+    officina, errore = await _officina(richiesta)
+    if officina is None:
+        return _json(*errore)
+    try:
+        dati = richiesta.json() or {}
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return _json({'error': 'JSON non valido'}, 400)
+    return _json(*await in_thread(_pool_db, main.accoda_completamento,
+                                  officina, dati))
+
+
+async def _officina(richiesta):
+    """Come main.officina_richiesta: header X-Officina o ?officina="""
+    id_officina = richiesta.headers.get('x-officina') or richiesta.args.get(
+        'officina')
+    return await in_thread(_pool_db, main.scegli_officina, id_officina)
+
+
+# ==================== CHANGE FEED ====================
+
+
+async def attendi_eventi(eventi, ultimo_visto=None, timeout=25, limite=500):
+    """Come BusEventi.attendi, nell'event loop: il thread lettore di
+    main sveglia il client con call_soon_threadsafe, nessun thread resta
+    occupato durante l'attesa"""
+    # Solo la prima volta per processo legge la tabella
+    await in_thread(_pool_db, eventi.avvia)
+    if ultimo_visto is None or ultimo_visto > eventi.ultimo_id:
+        ultimo_visto = eventi.ultimo_id
+    loop = asyncio.get_running_loop()
+    scadenza = loop.time() + timeout
+    sveglia = asyncio.Event()
+
+    def notifica():
+        try:
+            loop.call_soon_threadsafe(sveglia.set)
+        except RuntimeError:
+            pass  # event loop già chiuso
+
+    eventi.iscrivi(notifica)
+    try:
+        while True:
+            # Azzerata prima del controllo: un evento arrivato nel mezzo
+            # lascia la sveglia accesa e l'attesa finisce subito
+            sveglia.clear()
+            nuovi = eventi.disponibili(ultimo_visto, limite)
+            if nuovi is None:
+                return await in_thread(_pool_db, eventi.dalla_tabella,
+                                       ultimo_visto, limite)
+            if nuovi:
+                return nuovi
+            attesa = scadenza - loop.time()
+            if attesa <= 0:
+                return []
+            try:
+                await asyncio.wait_for(sveglia.wait(), attesa)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        eventi.disiscrivi(notifica)
+
+
+async def attendi_eventi_http(richiesta):
+    """Come main.attendi_eventi (long-poll), senza limite di client"""
+    officina, errore = await _officina(richiesta)
+    if officina is None:
+        return _json(*errore)
+    try:
+        dopo = richiesta.args.get('dopo')
+        dopo = int(dopo) if dopo else None
+        timeout = min(
+            float(richiesta.args.get('timeout', main.EVENTI_TIMEOUT)),
+            main.EVENTI_TIMEOUT)
+    except ValueError as e:
+        return _json({'error': str(e)}, 400)
+    nuovi = await attendi_eventi(officina.eventi, dopo, max(timeout, 0))
+    ultimo_id = nuovi[-1]['id'] if nuovi else (
+        dopo if dopo is not None else officina.eventi.ultimo_id)
+    return _json(nuovi, 200, {'X-Ultimo-Id': str(ultimo_id)})
+
+
+async def _flusso_eventi(eventi, ultimo_visto):
+    """Pezzi SSE come il generatore di main.stream_eventi"""
+    fine = time.monotonic() + main.EVENTI_DURATA_SSE
+    if ultimo_visto is None:
+        await in_thread(_pool_db, eventi.avvia)
+        ultimo_visto = eventi.ultimo_id
+    yield f"retry: 3000\nid: {ultimo_visto}\n\n"
+    while time.monotonic() < fine:
+        nuovi = await attendi_eventi(eventi, ultimo_visto,
+                                     main.EVENTI_TIMEOUT)
+        if not nuovi:
+            yield ": ping\n\n"
+            continue
+        for evento in nuovi:
+            ultimo_visto = evento['id']
+            yield (f"id: {evento['id']}\nevent: {evento['tipo']}\n"
+                   f"data: {json.dumps(evento)}\n\n")
+
+
+async def stream_eventi(richiesta, receive, send):
+    """Come main.stream_eventi (SSE); ritorna lo stato HTTP"""
+    officina, errore = await _officina(richiesta)
+    if officina is None:
+        await _rispondi(send, *_json(*errore))
+        return errore[1]
+    try:
+        ultimo_visto = richiesta.headers.get('last-event-id',
+                                             richiesta.args.get('dopo'))
+        ultimo_visto = int(ultimo_visto) if ultimo_visto else None
+    except ValueError:
+        await _rispondi(send, *_json({'error': 'Id evento non valido'}, 400))
+        return 400
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': _intestazioni('text/event-stream; charset=utf-8', {
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+    })
+
+    async def inoltra():
+        async for pezzo in _flusso_eventi(officina.eventi, ultimo_visto):
+            await send({
+                'type': 'http.response.body',
+                'body': pezzo.encode(),
+                'more_body': True
+            })
+
+    # Il flusso finisce da solo dopo EVENTI_DURATA_SSE o quando il client
+    # si scollega
+    flusso = asyncio.create_task(inoltra())
+    disconnesso = asyncio.create_task(_attendi_disconnessione(receive))
+    try:
+        finiti, _ = await asyncio.wait({flusso, disconnesso},
+                                       return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        flusso.cancel()
+        disconnesso.cancel()
+    if flusso in finiti:
+        if flusso.exception() is not None:
+            log.error("Errore flusso eventi", exc_info=flusso.exception())
+        await send({'type': 'http.response.body', 'body': b''})
+    return 200
+
+
+ROUTE = {
+    ('POST', '/webhook/whatsapp'): webhook_whatsapp,
+    ('POST', '/api/risposta'): invia_risposta,
+    ('POST', '/api/completa'): completa_richiesta,
+    ('GET', '/api/eventi/attendi'): attendi_eventi_http,
+}
+
+# Route che scrivono la risposta da sole, un pezzo alla volta
+ROUTE_FLUSSO = {
+    ('GET', '/api/eventi'): stream_eventi,
+}
+
+
+# ==================== ALTRE ROUTE (FLASK) ====================
+
+
+def _environ(scope, corpo):
+    """Environ WSGI (PEP 3333) per una richiesta ASGI"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(corpo),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for nome, valore in scope['headers']:
+        nome = nome.decode('latin-1').upper().replace('-', '_')
+        valore = valore.decode('latin-1')
+        if nome not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            nome = 'HTTP_' + nome
+        if nome in environ:
+            valore = f'{environ[nome]},{valore}'
+        environ[nome] = valore
+    return environ
+
+
+async def _servi_wsgi(scope, receive, send, corpo):
+    """Serve la richiesta con l'app Flask nel pool WSGI; le risposte in
+    streaming (SSE) vengono inoltrate un pezzo alla volta finché il client
+    resta collegato"""
+    avvio = {}
+
+    def start_response(stato, headers, exc_info=None):
+        avvio['stato'] = int(stato.split(' ', 1)[0])
+        avvio['headers'] = [(nome.lower().encode('latin-1'),
+                             valore.encode('latin-1'))
+                            for nome, valore in headers]
+
+    risultato = await in_thread(_pool_wsgi, main.app.wsgi_app,
+                                _environ(scope, corpo), start_response)
+    pezzi = iter(risultato)
+    disconnesso = asyncio.create_task(_attendi_disconnessione(receive))
+    try:
+        primo = await in_thread(_pool_wsgi, next, pezzi, None)
+        await send({
+            'type': 'http.response.start',
+            'status': avvio['stato'],
+            'headers': avvio['headers']
+        })
+        pezzo = primo
+        while pezzo is not None and not disconnesso.done():
+            await send({
+                'type': 'http.response.body',
+                'body': pezzo,
+                'more_body': True
+            })
+            pezzo = await in_thread(_pool_wsgi, next, pezzi, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnesso.cancel()
+        if hasattr(risultato, 'close'):
+            await in_thread(_pool_wsgi, risultato.close)
+
+
+async def _attendi_disconnessione(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+# ==================== INVII ASINCRONI ====================
+
+
+class ConsegnaAsincrona:
+    """Consegna degli invii dell'outbox dall'event loop.
+
+    Prende i lotti con gli stessi metodi della CodaInvii di main (lease,
+    retry, dead letter invariati) e li consegna con gestori async: fino a
+    `concorrenza` invii in volo senza un thread per ciascuno.
+    """
+
+    def __init__(self, coda, concorrenza=ASGI_INVII_CONCORRENTI):
+        self.coda = coda
+        self.gestori = {}
+        self._posti = asyncio.Semaphore(concorrenza)
+        self._in_volo = set()
+        self._risveglio = asyncio.Event()
+        self.compito = None
+
+    def registra(self, tipo, gestore):
+        self.gestori[tipo] = gestore
+
+    async def esegui(self):
+        loop = asyncio.get_running_loop()
+
+        def risveglia():
+            # Chiamata da accoda() in un altro thread
+            try:
+                loop.call_soon_threadsafe(self._risveglio.set)
+            except RuntimeError:
+                pass  # event loop già chiuso
+
+        self.coda.al_risveglio(risveglia)
+        while True:
+            await self._posti.acquire()
+            try:
+                righe = await in_thread(_pool_db, self.coda._prendi)
+            except Exception:
+                log.exception("Errore lettura outbox")
+                righe = None
+            if not righe:
+                self._posti.release()
+                await self._attendi_sveglia()
+                continue
+            compito = asyncio.create_task(self._consegna(righe))
+            self._in_volo.add(compito)
+            compito.add_done_callback(self._in_volo.discard)
+
+    async def _attendi_sveglia(self, timeout=1):
+        # Un nuovo invio sveglia subito; il timeout copre i retry in scadenza
+        try:
+            await asyncio.wait_for(self._risveglio.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._risveglio.clear()
+
+    async def _consegna(self, righe):
+        try:
+            tipo, payload = self.coda.apri_lotto(righe)
+            errore = None
+            try:
+                gestore = self.gestori.get(tipo)
+                if gestore is None:
+                    raise main.ErroreDefinitivo(
+                        f"Nessun gestore per il tipo '{tipo}'")
+                await gestore(payload)
+            except Exception as e:
+                errore = e
+            await in_thread(_pool_db, self.coda.registra_esito, righe,
+                            errore)
+        except Exception:
+            log.exception("Errore worker outbox")
+        finally:
+            self._posti.release()
+
+
+class InviiAsincroni:
+    """Gestori async per Twilio e FCM: stessa logica di main.invia_whatsapp
+    e main.NotificatorePush.invia, con I/O non bloccante"""
+
+    def __init__(self, notificatore):
+        self.notificatore = notificatore
+        self.twilio = None
+        self.sessione = None
+
+    async def apri(self):
+        """Client HTTP legati all'event loop corrente"""
+        self.sessione = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=main.HTTP_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=ASGI_INVII_CONCORRENTI))
+        if main.TWILIO_CONFIGURATO:
+            self.twilio = Client(
+                main.TWILIO_ACCOUNT_SID,
+                main.TWILIO_AUTH_TOKEN,
+                http_client=AsyncTwilioHttpClient(timeout=main.HTTP_TIMEOUT))
+            if main.TWILIO_API_URL:
+                self.twilio.api.base_url = main.TWILIO_API_URL
+
+    async def chiudi(self):
+        if self.sessione:
+            await self.sessione.close()
+        if self.twilio:
+            await self.twilio.http_client.close()
+
+    async def whatsapp(self, payload):
+        if not self.twilio:
+            raise main.ErroreDefinitivo('Twilio non configurato')
+        inizio = time.perf_counter()
+        try:
+            message = await self.twilio.messages.create_async(
+                from_=payload.get('from') or main.TWILIO_WHATSAPP_NUMBER,
+                body=payload['body'],
+                to=payload['to'])
+        except TwilioRestException as e:
+            raise main.errore_twilio(e) from e
+        finally:
+            metriche.osserva('twilio_invio_durata_secondi',
+                             time.perf_counter() - inizio)
+        log.info("WhatsApp inviato",
+                 extra=campi(cliente=payload['to'], message_sid=message.sid))
+
+    async def push(self, payloads):
+        payload, headers = self.notificatore.prepara(payloads)
+        inizio = time.perf_counter()
+        try:
+            async with self.sessione.post(self.notificatore.url,
+                                          headers=headers,
+                                          json=payload) as risposta:
+                testo = await risposta.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.notificatore._contatori['errori'] += 1
+            raise
+        self.notificatore.registra_risposta(payloads, risposta.status, testo,
+                                            time.perf_counter() - inizio)
+
+
+# ==================== APPLICAZIONE ASGI ====================
+
+invii = InviiAsincroni(main.notificatore)
+consegna = ConsegnaAsincrona(main.coda_invii)
+consegna.registra('whatsapp', invii.whatsapp)
+consegna.registra('push', invii.push)
+
+
+async def _ciclo_vita(receive, send):
+    """Avvio e arresto del processo (lifespan ASGI)"""
+    while True:
+        messaggio = await receive()
+        if messaggio['type'] == 'lifespan.startup':
+            metriche.avvia()
+            await invii.apri()
+            consegna.compito = asyncio.create_task(consegna.esegui())
+            await send({'type': 'lifespan.startup.complete'})
+        elif messaggio['type'] == 'lifespan.shutdown':
+            consegna.compito.cancel()
+            await invii.chiudi()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """Applicazione ASGI: route asincrone, il resto all'app Flask"""
+    if scope['type'] == 'lifespan':
+        return await _ciclo_vita(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    corpo = await _leggi_corpo(receive)
+    if corpo is _DISCONNESSO:
+        # Nessuno a cui rispondere: niente risposta né metriche
+        return
+    if corpo is None:
+        return await _rispondi(send, 'Richiesta troppo grande', 413)
+
+    chiave = (scope['method'], scope['path'])
+    gestore = ROUTE.get(chiave)
+    flusso = ROUTE_FLUSSO.get(chiave)
+    if gestore is None and flusso is None:
+        return await _servi_wsgi(scope, receive, send, corpo)
+
+    # Ogni richiesta è un task con il proprio contesto: il contesto di log
+    # impostato dal webhook non passa alle richieste successive
+    inizio = time.perf_counter()
+    if flusso is not None:
+        stato = await flusso(Richiesta(scope, corpo), receive, send)
+    else:
+        try:
+            corpo, stato, tipo, extra = await gestore(
+                Richiesta(scope, corpo))
+        except Exception:
+            log.exception("Errore richiesta ASGI",
+                          extra=campi(percorso=scope['path']))
+            corpo, stato, tipo, extra = _json({'error': 'Errore interno'},
+                                              500)
+        await _rispondi(send, corpo, stato, tipo, extra)
+
+    metriche.osserva('http_durata_secondi',
+                     time.perf_counter() - inizio,
+                     (('route', scope['path']), ))
+    metriche.incrementa('http_richieste_totale',
+                        (('route', scope['path']),
+                         ('metodo', scope['method']), ('stato', str(stato))))
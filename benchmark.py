@@ -0,0 +1,2002 @@
+"""Benchmark del backend bot WhatsApp.
+
+Uso:
+    python benchmark.py database [--operazioni 2000] [--thread 4]
+    python benchmark.py richieste [--righe 10000,100000,1000000]
+    python benchmark.py etag [--righe 10000,100000,1000000]
+    python benchmark.py statistiche [--righe 10000,100000,1000000]
+    python benchmark.py esportazione [--righe 10000,100000,1000000]
+    python benchmark.py ricerca [--righe 10000,100000,1000000]
+    python benchmark.py archivio [--righe 10000,100000,1000000]
+    python benchmark.py push [--operazioni 2000]
+    python benchmark.py bot [--operazioni 2000]
+    python benchmark.py clienti [--operazioni 2000] [--righe 10000,1000000]
+    python benchmark.py campagne [--numeri 2000] [--latenza-stub 0.05]
+    python benchmark.py firma [--operazioni 2000]
+    python benchmark.py metriche [--operazioni 2000] [--thread 4]
+    python benchmark.py log [--operazioni 2000]
+    python benchmark.py eventi [--clienti 200]
+    python benchmark.py ingestione [--conversazioni 1000]
+    python benchmark.py asgi [--conversazioni 1000] [--latenza-stub 0.05]
+                             [--gunicorn '--threads 32 --worker-connections 4096']
+    python benchmark.py officine [--conversazioni 1000] [--thread 4]
+                                 [--intervallo-import 0.5]
+    python benchmark.py webhook [--numeri 2000] [--thread 4]
+                                [--gunicorn '-w 4 --threads 8']
+    python benchmark.py avvio [--ripetizioni 200]
+                              [--storico benchmark_avvio.csv]
+
+Ogni benchmark lavora su file temporanei e non tocca il database reale.
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import random
+import shlex
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Il database di main viene creato nella cartella temporanea
+_CARTELLA = tempfile.mkdtemp(prefix='bench_officina_')
+os.environ['DATABASE_PATH'] = os.path.join(_CARTELLA, 'main.db')
+os.environ['OFFICINE_DB_DIR'] = os.path.join(_CARTELLA, 'officine')
+os.environ['ARCHIVIO_DIR'] = os.path.join(_CARTELLA, 'archivio')
+
+import main  # noqa: E402
+
+DATI_ESEMPIO = {
+    'auto': 'Fiat Panda',
+    'problema': 'Auto ferma / rumori strani',
+    'problema_cod': '1',
+    'urgenza': 'Auto non parte',
+}
+
+
+def _stampa(nome, operazioni, secondi):
+    print(f"  {nome:<40} {operazioni / secondi:>12,.0f} op/s "
+          f"({secondi * 1000:,.1f} ms)")
+
+
+def _in_parallelo(n_thread, funzione, operazioni):
+    """Esegue funzione(i) su n_thread thread, ritorna (secondi, errori)"""
+    errori = []
+    per_thread = operazioni // n_thread
+
+    def lavora():
+        for i in range(per_thread):
+            try:
+                funzione(i)
+            except sqlite3.OperationalError as e:
+                errori.append(e)
+
+    threads = [threading.Thread(target=lavora) for _ in range(n_thread)]
+    inizio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - inizio, len(errori)
+
+
+# ==================== DATABASE ====================
+
+
+class _DatabaseLegacy:
+    """Accesso com'era prima del pool: una connessione per ogni chiamata"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        main.DatabaseRichieste(db_path)  # solo per creare lo schema
+
+    def salva_richiesta(self, numero_cliente, dati, categoria):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(main.DatabaseRichieste.SQL_INSERISCI,
+                     (numero_cliente, dati.get('auto'), dati.get('problema'),
+                      dati.get('problema_cod'), dati.get('urgenza'), None,
+                      None, None, None, categoria,
+                      datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'nuova'))
+        conn.commit()
+        conn.close()
+
+    def conta_richieste_nuove(self):
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute(
+            main.DatabaseRichieste.SQL_CONTA_NUOVE).fetchone()[0]
+        conn.close()
+        return count
+
+
+def bench_database(args):
+    """Inserimenti/s e letture/s: connessione per chiamata vs pool per thread"""
+    print(f"\n📊 DATABASE ({args.operazioni} operazioni, "
+          f"{args.thread} thread nel test concorrente)")
+
+    candidati = [
+        ('prima (connect per chiamata)',
+         _DatabaseLegacy(os.path.join(_CARTELLA, 'legacy.db'))),
+        ('dopo (pool WAL + statement in cache)',
+         main.DatabaseRichieste(os.path.join(_CARTELLA, 'pool.db'))),
+    ]
+
+    for nome, database in candidati:
+        print(f"\n {nome}")
+
+        inizio = time.perf_counter()
+        for i in range(args.operazioni):
+            database.salva_richiesta(f'whatsapp:+39{i:010d}', DATI_ESEMPIO,
+                                     'URGENTE')
+        _stampa('inserimenti', args.operazioni, time.perf_counter() - inizio)
+
+        inizio = time.perf_counter()
+        for _ in range(args.operazioni):
+            database.conta_richieste_nuove()
+        _stampa('letture (conta_richieste_nuove)', args.operazioni,
+                time.perf_counter() - inizio)
+
+        secondi, errori = _in_parallelo(
+            args.thread, lambda i: database.salva_richiesta(
+                f'whatsapp:+39{i:010d}', DATI_ESEMPIO, 'URGENTE'),
+            args.operazioni)
+        _stampa(f'inserimenti concorrenti ({errori} lock)', args.operazioni,
+                secondi)
+
+
+# ==================== API RICHIESTE ====================
+
+CATEGORIE = ('URGENTE', 'MANUTENZIONE', 'PREVENTIVO')
+STATI = ('nuova', 'risposta', 'completata')
+
+
+def popola(database, righe, blocco=50_000):
+    """Inserisce righe sintetiche con executemany, a blocchi"""
+    conn = database.connessione()
+    base = time.time() - righe * 60
+    for inizio in range(0, righe, blocco):
+        with conn:
+            conn.executemany(
+                database.SQL_INSERISCI,
+                ((f'whatsapp:+39{i % 50_000:010d}', 'Fiat Panda',
+                  'Tagliando / controllo', '2', None, 'spia olio', 'mattina',
+                  None, None, CATEGORIE[i % 3],
+                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(base + i * 60)), STATI[i % 3])
+                 for i in range(inizio, min(inizio + blocco, righe))))
+
+
+def _misura(funzione, ripetizioni):
+    """Latenza media in ms di funzione()"""
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        funzione()
+    return (time.perf_counter() - inizio) * 1000 / ripetizioni
+
+
+def bench_richieste(args):
+    """Latenza di /api/richieste: scansione completa vs pagine indicizzate"""
+    for righe in args.righe:
+        database = main.DatabaseRichieste(
+            os.path.join(_CARTELLA, f'richieste_{righe}.db'))
+        popola(database, righe)
+        ultimo_id = database.conta_richieste()
+        print(f"\n📊 /api/richieste con {righe:,} righe (ms per chiamata)")
+
+        def scansione_completa():
+            tutte = database.leggi_tutte_richieste()
+            return [r for r in tutte if r[9] == 'URGENTE' and r[11] == 'nuova']
+
+        def pagine_profonde():
+            dopo = None
+            for _ in range(10):
+                _, dopo = database.cerca_richieste(stato='nuova', dopo=dopo)
+
+        casi = [
+            ('prima: tutta la tabella + filtro Python', scansione_completa,
+             1),
+            ('prima pagina (100 righe)', lambda: database.cerca_richieste(),
+             args.ripetizioni),
+            ('filtro categoria+stato',
+             lambda: database.cerca_richieste(categoria='URGENTE',
+                                              stato='nuova'),
+             args.ripetizioni),
+            ('proiezione id,stato',
+             lambda: database.cerca_richieste(campi=('id', 'stato')),
+             args.ripetizioni),
+            ('10 pagine a cursore', pagine_profonde, args.ripetizioni // 10
+             or 1),
+            ('since (ultime 5 righe)',
+             lambda: database.cerca_richieste(since=ultimo_id - 5),
+             args.ripetizioni),
+        ]
+        for nome, funzione, ripetizioni in casi:
+            print(f"  {nome:<40} {_misura(funzione, ripetizioni):>10.3f}")
+
+
+def bench_etag(args):
+    """Poll dell'app del titolare senza modifiche: risposta ricalcolata,
+    corpo dalla cache per versione dei dati e 304 con If-None-Match"""
+    client = main.app.test_client()
+    capacita = main.cache_risposte.capacita
+    for righe in args.righe:
+        officina = _officina_bench(
+            f'etag_{righe}', os.path.join(_CARTELLA, f'etag_{righe}.db'))
+        popola(officina.db, righe)
+        main.officine._aperte[officina.id] = officina
+        print(f"\n📊 Poll invariati con {righe:,} righe (ms per chiamata)")
+
+        for url in ('/api/richieste', '/api/richieste?limite=500',
+                    '/api/richieste/1', '/'):
+            intestazioni = {'X-Officina': officina.id}
+
+            def leggi():
+                return client.get(url, headers=intestazioni)
+
+            # Capacità zero: nessun valore entra in cache
+            main.cache_risposte.capacita = 0
+            senza_cache = _misura(leggi, args.ripetizioni)
+            main.cache_risposte.capacita = capacita
+            leggi()
+            con_cache = _misura(leggi, args.ripetizioni)
+            intestazioni['If-None-Match'] = leggi().headers['ETag']
+            assert leggi().status_code == 304
+            non_modificata = _misura(leggi, args.ripetizioni)
+            print(f"  {url:<28} ricalcolata {senza_cache:>8.3f}  "
+                  f"cache {con_cache:>8.3f}  304 {non_modificata:>8.3f}")
+
+
+# ==================== STATISTICHE ====================
+
+AUTO = ('Fiat Panda', 'Fiat 500', 'VW Golf', 'VW Polo', 'Ford Fiesta',
+        'Renault Clio', 'Toyota Yaris', 'Peugeot 208', 'Opel Corsa',
+        'Dacia Sandero', 'BMW Serie 1', 'Audi A3')
+
+
+def _popola_statistiche(database, righe, blocco=50_000):
+    """Righe sintetiche su circa due anni, auto e categorie variate; un terzo
+    poi completate. Ritorna i secondi di inserimento e di completamento"""
+    conn = database.connessione()
+    base = time.time() - righe * 60
+    inizio = time.perf_counter()
+    for primo in range(0, righe, blocco):
+        with conn:
+            conn.executemany(
+                database.SQL_INSERISCI,
+                ((f'whatsapp:+39{i % 50_000:010d}', AUTO[i % len(AUTO)],
+                  'Tagliando / controllo', '2', None, None, None, None, None,
+                  CATEGORIE[i % 3 if i % 7 else 0],
+                  time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.localtime(base + i * 60)), 'nuova')
+                 for i in range(primo, min(primo + blocco, righe))))
+    inserimento = time.perf_counter() - inizio
+    inizio = time.perf_counter()
+    with conn:
+        conn.execute(
+            "UPDATE richieste SET stato = 'completata' WHERE id % 3 = 0")
+    return inserimento, time.perf_counter() - inizio
+
+
+def _statistiche_python(database):
+    """Com'era possibile prima: tutta la tabella in Python"""
+    per_categoria, per_stato, per_giorno, per_marca = (Counter(), Counter(),
+                                                       Counter(), Counter())
+    for riga in database.leggi_tutte_richieste():
+        per_categoria[riga[9]] += 1
+        per_stato[riga[11]] += 1
+        per_giorno[riga[10][:10]] += 1
+        per_marca[(riga[2] or '').split(' ')[0].upper()] += 1
+    return per_categoria, per_stato, per_giorno, per_marca.most_common(20)
+
+
+def _statistiche_sql(database):
+    """GROUP BY sulla tabella richieste: una scansione per dimensione"""
+    return [
+        database._leggi(sql) for sql in (
+            'SELECT categoria, stato, COUNT(*) FROM richieste GROUP BY 1, 2',
+            'SELECT substr(data_richiesta, 1, 10), COUNT(*) FROM richieste '
+            'GROUP BY 1',
+            "SELECT upper(substr(auto, 1, instr(auto || ' ', ' ') - 1)) AS m, "
+            'COUNT(*) AS n FROM richieste GROUP BY m ORDER BY n DESC LIMIT 20',
+            "SELECT AVG(julianday(data_completamento) - "
+            "julianday(data_richiesta)) FROM richieste "
+            "WHERE data_completamento IS NOT NULL")
+    ]
+
+
+def bench_statistiche(args):
+    """/api/statistiche: aggregati calcolati a ogni chiamata contro i
+    riepiloghi tenuti dai trigger, e quanto costano i trigger in scrittura"""
+    for righe in args.righe:
+        senza = main.DatabaseRichieste(
+            os.path.join(_CARTELLA, f'statistiche_senza_{righe}.db'))
+        con = main.DatabaseRichieste(
+            os.path.join(_CARTELLA, f'statistiche_{righe}.db'))
+        riepiloghi = main.RiepiloghiRichieste(con)
+
+        print(f"\n📊 /api/statistiche con {righe:,} righe")
+        tempi = [_popola_statistiche(senza, righe),
+                 _popola_statistiche(con, righe)]
+        for nome, (inserimento, completamento) in zip(
+                ('senza trigger', 'con riepiloghi'), tempi):
+            print(f"  scrittura {nome:<30} {righe / inserimento:>10,.0f} "
+                  f"righe/s, completamento di {righe // 3:,} in "
+                  f"{completamento * 1000:,.0f} ms")
+
+        print(f"  {'query (ms per chiamata)':<40} {'ms':>10}")
+        ultimi_30 = time.strftime('%Y-%m-%d',
+                                  time.localtime(time.time() - 30 * 86400))
+        casi = [
+            ('prima: tutta la tabella in Python',
+             lambda: _statistiche_python(senza), 1),
+            ('GROUP BY su richieste (4 scansioni)',
+             lambda: _statistiche_sql(senza), 1),
+            ('riepiloghi, tutto il periodo', riepiloghi.riepilogo,
+             args.ripetizioni // 10 or 1),
+            ('riepiloghi, ultimi 30 giorni',
+             lambda: riepiloghi.riepilogo(dal=ultimi_30),
+             args.ripetizioni),
+        ]
+        for nome, funzione, ripetizioni in casi:
+            print(f"  {nome:<40} {_misura(funzione, ripetizioni):>10.3f}")
+        bucket = con._leggi('SELECT COUNT(*) FROM riepilogo_richieste')[0][0]
+        print(f"  righe di riepilogo (giorno x categoria x stato): {bucket:,}")
+        # I riepiloghi devono coincidere con il conteggio diretto
+        assert riepiloghi.riepilogo()['totale'] == con.conta_richieste()
+
+
+# ==================== ESPORTAZIONE ====================
+
+
+def _con_picco_memoria(funzione):
+    """Esegue funzione() in un processo figlio (fork) e ritorna il suo
+    risultato con la crescita di memoria residente di picco, in MB"""
+    import multiprocessing
+    import resource
+    contesto = multiprocessing.get_context('fork')
+    ricevi, invia = contesto.Pipe(False)
+
+    def figlio():
+        base = _rss_kb(os.getpid())
+        risultato = funzione()
+        picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        invia.send((risultato, (picco - base) / 1024))
+
+    processo = contesto.Process(target=figlio)
+    processo.start()
+    risultato = ricevi.recv()
+    processo.join()
+    return risultato
+
+
+def _esporta_in_memoria(database):
+    """Com'era possibile prima: tutta la tabella in una lista, poi il file"""
+    inizio = time.perf_counter()
+    righe = database._leggi(
+        f"SELECT {', '.join(database.COLONNE)} FROM richieste "
+        'ORDER BY data_richiesta, id')
+    corpo = b''.join(
+        main.righe_esportate([righe], database.COLONNE, 'csv'))
+    durata = time.perf_counter() - inizio
+    return len(righe), len(corpo), durata, durata
+
+
+def _esporta_http(officina, url, gzip=False):
+    """GET in streaming sul test client Flask: righe, byte, secondi e
+    secondi al primo pezzo"""
+    client = main.app.test_client()
+    intestazioni = {'X-Officina': officina.id}
+    if gzip:
+        intestazioni['Accept-Encoding'] = 'gzip'
+    inizio = time.perf_counter()
+    risposta = client.get(url, headers=intestazioni, buffered=False)
+    primo = None
+    byte = 0
+    for pezzo in risposta.response:
+        if primo is None:
+            primo = time.perf_counter() - inizio
+        byte += len(pezzo)
+    risposta.close()
+    return officina.db.conta_richieste(), byte, time.perf_counter(
+    ) - inizio, primo
+
+
+def _importa_per_riga(officina, percorso):
+    """Una transazione per riga, come scrivere le righe una alla volta"""
+    esito = {'scartate': 0, 'errori': []}
+    inizio = time.perf_counter()
+    with main.apri_file(percorso, 'rb') as ingresso:
+        n = main.importa_richieste(
+            officina, main.leggi_importazione(ingresso, 'csv', esito), 1)
+    return n, time.perf_counter() - inizio
+
+
+def _importa_a_blocchi(officina, percorso):
+    esito = {'scartate': 0, 'errori': []}
+    inizio = time.perf_counter()
+    with main.apri_file(percorso, 'rb') as ingresso:
+        n = main.importa_richieste(
+            officina, main.leggi_importazione(ingresso, 'csv', esito))
+    return n, time.perf_counter() - inizio
+
+
+def bench_esportazione(args):
+    """Export in streaming (CSV, NDJSON, gzip) contro la tabella caricata
+    in memoria, e import a blocchi contro una transazione per riga"""
+    for righe in args.righe:
+        officina = _officina_bench(
+            f'export_{righe}',
+            os.path.join(_CARTELLA, f'esportazione_{righe}.db'))
+        popola(officina.db, righe)
+        main.officine._aperte[officina.id] = officina
+
+        print(f"\n📊 Export di {righe:,} richieste")
+        print(f"  {'':<40} {'righe/s':>10} {'MB/s':>7} {'primo byte':>11} "
+              f"{'picco RSS':>10}")
+        casi = [
+            ('prima: tutta la tabella in memoria',
+             lambda: _esporta_in_memoria(officina.db)),
+            ('CSV in streaming', lambda: _esporta_http(
+                officina, '/api/richieste/esporta?formato=csv')),
+            ('NDJSON in streaming', lambda: _esporta_http(
+                officina, '/api/richieste/esporta?formato=ndjson')),
+            ('CSV gzip in streaming', lambda: _esporta_http(
+                officina, '/api/richieste/esporta?formato=csv', gzip=True)),
+        ]
+        for nome, funzione in casi:
+            (n, byte, secondi, primo), picco = _con_picco_memoria(funzione)
+            print(f"  {nome:<40} {n / secondi:>10,.0f} "
+                  f"{byte / secondi / 2**20:>7.1f} {primo * 1000:>8.0f} ms "
+                  f"{picco:>7.1f} MB")
+
+        # Il file per l'import, scritto in streaming (anche prova del gzip)
+        percorso = os.path.join(_CARTELLA, f'esportazione_{righe}.csv.gz')
+        with main.apri_file(percorso, 'wb') as uscita:
+            for pezzo in main.righe_esportate(
+                    officina.db.esporta(), main.DatabaseRichieste.COLONNE,
+                    'csv'):
+                uscita.write(pezzo)
+        print(f"  file CSV gzip: {os.path.getsize(percorso) / 2**20:.1f} MB")
+
+        print(f"\n📊 Import di {righe:,} richieste (trigger di riepiloghi ed "
+              "eventi attivi)")
+        per_riga = min(righe, 20_000)
+        ridotto = os.path.join(_CARTELLA, f'importazione_{per_riga}.csv.gz')
+        blocchi = officina.db.esporta(blocco=per_riga)
+        with main.apri_file(ridotto, 'wb') as uscita:
+            for pezzo in main.righe_esportate([next(blocchi)],
+                                              main.DatabaseRichieste.COLONNE,
+                                              'csv'):
+                uscita.write(pezzo)
+        blocchi.close()
+        casi = [
+            (f'una transazione per riga ({per_riga:,})', _importa_per_riga,
+             ridotto),
+            (f'executemany, {main.IMPORTA_BLOCCO:,} righe per commit',
+             _importa_a_blocchi, percorso),
+        ]
+        for indice, (nome, funzione, file) in enumerate(casi):
+            destinazione = _officina_bench(
+                f'import_{righe}_{indice}',
+                os.path.join(_CARTELLA, f'importazione_{righe}_{indice}.db'))
+            (n, secondi), picco = _con_picco_memoria(
+                lambda: funzione(destinazione, file))
+            print(f"  {nome:<40} {n / secondi:>10,.0f} righe/s "
+                  f"{picco:>7.1f} MB")
+            assert destinazione.db.conta_richieste() == n
+
+
+# ==================== RICERCA ====================
+
+PROBLEMI = ('Rumore dai freni in frenata', 'Spia motore accesa',
+            'La frizione slitta', "Perdita d'olio sotto l'auto",
+            'Batteria scarica, non parte', 'Il clima non raffredda',
+            'Vibrazioni al volante in autostrada', 'Tagliando e cambio olio',
+            'Cambio gomme invernali', 'Fumo bianco dallo scarico',
+            'Cambio duro a freddo', 'Lo sterzo tira a destra')
+SPIE = ('spia olio', 'spia ABS', 'spia airbag', 'spia batteria',
+        'spia motore', 'nessuna spia', 'rumore metallico',
+        'odore di bruciato')
+
+
+def _popola_ricerca(database, righe, blocco=50_000):
+    """Righe con testo libero variato e una targa diversa per riga;
+    ritorna le righe al secondo"""
+    casuale = random.Random(7)
+    conn = database.connessione()
+    inizio = time.perf_counter()
+    for primo in range(0, righe, blocco):
+        with conn:
+            conn.executemany(
+                database.SQL_INSERISCI,
+                ((f'whatsapp:+39{i % 50_000:010d}', casuale.choice(AUTO),
+                  f'{casuale.choice(PROBLEMI)} (targa GT{i:06d})', '2', None,
+                  casuale.choice(SPIE), None, None, None, CATEGORIE[i % 3],
+                  '2024-01-01 10:00:00', STATI[i % 3])
+                 for i in range(primo, min(primo + blocco, righe))))
+    return righe / (time.perf_counter() - inizio)
+
+
+def _cerca_like(database, testo, limite=20):
+    """Com'era possibile prima: LIKE su ogni colonna, tabella intera"""
+    colonne = [nome for nome, _ in main.RicercaRichieste.COLONNE]
+    condizioni = []
+    parametri = []
+    for parola in testo.split():
+        condizioni.append(
+            '(' + ' OR '.join(f'{c} LIKE ?' for c in colonne) + ')')
+        parametri.extend([f'%{parola}%'] * len(colonne))
+    return database._leggi(
+        f"SELECT id FROM richieste WHERE {' AND '.join(condizioni)} "
+        'ORDER BY data_richiesta DESC LIMIT ?', parametri + [limite])
+
+
+def bench_ricerca(args):
+    """/api/richieste/cerca: indice FTS5 contro LIKE su tutta la tabella,
+    e quanto costa l'indice in scrittura"""
+    for righe in args.righe:
+        senza = main.DatabaseRichieste(
+            os.path.join(_CARTELLA, f'ricerca_senza_{righe}.db'))
+        con = main.DatabaseRichieste(
+            os.path.join(_CARTELLA, f'ricerca_{righe}.db'))
+        ricerca = main.RicercaRichieste(con)
+
+        print(f"\n📊 Ricerca testuale su {righe:,} righe")
+        print(f"  scrittura senza indice {_popola_ricerca(senza, righe):>17,.0f}"
+              " righe/s")
+        print(f"  scrittura con FTS5 {_popola_ricerca(con, righe):>21,.0f}"
+              " righe/s")
+        try:
+            dimensione = con._leggi(
+                'SELECT SUM(pgsize) FROM dbstat '
+                "WHERE name LIKE 'richieste_fts%'")[0][0]
+            print(f"  dimensione indice: {dimensione / 2**20:.1f} MB")
+        except sqlite3.OperationalError:
+            pass  # SQLite compilato senza dbstat
+
+        print(f"  {'query (ms per chiamata)':<32} {'LIKE':>10} {'FTS5':>10} "
+              f"{'risultati':>10}")
+        for testo in ('panda spia olio', 'frizione', 'freni golf',
+                      f'GT{righe // 2:06d}', 'bruciato scarico'):
+            ripetizioni = max(args.ripetizioni // 20, 1)
+            like = _misura(lambda: _cerca_like(senza, testo), 1)
+            fts = _misura(lambda: ricerca.cerca(testo, campi=('id', )),
+                          ripetizioni)
+            trovati = len(ricerca.cerca(testo, campi=('id', ), limite=100))
+            print(f"  {testo:<32} {like:>10.2f} {fts:>10.2f} {trovati:>10}")
+
+
+# ==================== ARCHIVIO ====================
+
+
+def _dimensione_cartella(cartella):
+    return sum(
+        os.path.getsize(os.path.join(radice, nome))
+        for radice, _, nomi in os.walk(cartella) for nome in nomi)
+
+
+def bench_archivio(args):
+    """Tabella calda prima e dopo l'archiviazione delle richieste completate
+    più vecchie del 10% più recente: righe, file, latenze delle query"""
+    for righe in args.righe:
+        officina = _officina_bench(
+            f'archivio_{righe}',
+            os.path.join(_CARTELLA, f'archivio_{righe}.db'))
+        database = officina.db
+        popola(database, righe)
+        # Come nella realtà, quelle vecchie sono quasi tutte completate
+        with database.connessione() as conn:
+            conn.execute(
+                "UPDATE richieste SET stato = 'completata' "
+                "WHERE id <= ? AND id % 20 != 0", (righe * 0.9, ))
+            conn.execute(
+                'UPDATE richieste SET data_completamento = data_richiesta '
+                "WHERE stato = 'completata'")
+        archivio = officina.archivio
+        # popola mette una riga al minuto: resta calda l'ultima decima parte
+        giorni = righe * 60 / 86400 * 0.1
+
+        def pagine_profonde():
+            dopo = None
+            for _ in range(10):
+                _, dopo = database.cerca_richieste(dopo=dopo)
+
+        casi = [
+            ('prima pagina (100 righe)', lambda: database.cerca_richieste(),
+             args.ripetizioni),
+            ('filtro stato=completata',
+             lambda: database.cerca_richieste(stato='completata'),
+             args.ripetizioni),
+            ('10 pagine a cursore', pagine_profonde, args.ripetizioni // 10
+             or 1),
+            ('conta_richieste', database.conta_richieste,
+             args.ripetizioni // 10 or 1),
+        ]
+
+        def fotografia():
+            archivio._misura()
+            return archivio.misure, [
+                _misura(funzione, ripetizioni)
+                for _, funzione, ripetizioni in casi
+            ]
+
+        misure_prima, latenze_prima = fotografia()
+        inizio = time.perf_counter()
+        archiviate = archivio.esegui(giorni)
+        secondi = time.perf_counter() - inizio
+        # Il lavoro di fondo restituisce le pagine a rate; qui tutte
+        while archivio.compatta():
+            pass
+        misure_dopo, latenze_dopo = fotografia()
+
+        print(f"\n📊 Archiviazione su {righe:,} righe")
+        _stampa('righe archiviate', archiviate, secondi)
+        print(f"  {'':<32} {'prima':>10} {'dopo':>10}")
+        print(f"  {'righe nella tabella':<32} {misure_prima['righe']:>10,} "
+              f"{misure_dopo['righe']:>10,}")
+        print(f"  {'file (MB)':<32} {misure_prima['byte'] / 2**20:>10.1f} "
+              f"{misure_dopo['byte'] / 2**20:>10.1f}")
+        for (nome, _, _), prima, dopo in zip(casi, latenze_prima,
+                                             latenze_dopo):
+            print(f"  {nome + ' (ms)':<32} {prima:>10.3f} {dopo:>10.3f}")
+        print(f"  archivi mensili: {len(archivio.mesi())} file, "
+              f"{_dimensione_cartella(archivio.cartella) / 2**20:.1f} MB")
+
+
+# ==================== NOTIFICHE PUSH ====================
+
+
+class ServerStub:
+    """Server HTTP locale (keep-alive) che imita FCM/Twilio rispondendo 200
+    dopo `latenza` secondi e contando richieste e connessioni"""
+
+    def __init__(self, latenza=0.005):
+        stub = self
+        self.richieste = 0
+        self.connessioni = 0
+        self._lock = threading.Lock()
+
+        class Gestore(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connessioni += 1
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latenza)
+                with stub._lock:
+                    stub.richieste += 1
+                corpo = b'{"success": 1}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Gestore)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+
+    def azzera(self):
+        self.richieste = self.connessioni = 0
+
+
+def _notifica(i):
+    return {
+        'id': None,
+        'cliente': f'whatsapp:+39{i:010d}',
+        'auto': 'Fiat Panda',
+        'urgenza': 'Auto non parte',
+        'categoria': 'URGENTE'
+    }
+
+
+def _payload_fcm(richiesta):
+    return {
+        'to': '/topics/titolare_officina',
+        'priority': 'high',
+        'notification': {
+            'title': '🚨 URGENZA',
+            'body': f"{richiesta['auto']} - {richiesta['urgenza']}"
+        },
+        'data': {
+            'cliente': richiesta['cliente'],
+            'categoria': richiesta['categoria'],
+            'click_action': 'OPEN_URGENZE'
+        }
+    }
+
+
+def bench_push(args):
+    """Notifiche FCM: post singoli vs sessione keep-alive vs raffica coalescente"""
+    stub = ServerStub()
+    url = f'{stub.url}/fcm/send'
+    n = args.operazioni
+    print(f"\n📊 PUSH FCM ({n} notifiche, stub locale con 5 ms di latenza)")
+
+    def riga(nome, secondi):
+        print(f"  {nome:<40} {n / secondi:>8,.0f} notifiche/s "
+              f"{stub.richieste:>6} POST {stub.connessioni:>5} connessioni")
+
+    inizio = time.perf_counter()
+    for i in range(n):
+        requests.post(url, json=_payload_fcm(_notifica(i)), timeout=10)
+    riga('prima: requests.post per notifica', time.perf_counter() - inizio)
+
+    stub.azzera()
+    notificatore = main.NotificatorePush(url, 10, al_secondo=1e9, burst=1e9,
+                                         dimensione_pool=4)
+    inizio = time.perf_counter()
+    for i in range(n):
+        notificatore.invia([_payload_fcm(_notifica(i))])
+    riga('sessione keep-alive, una per volta', time.perf_counter() - inizio)
+    print(f"    latenza: {notificatore.statistiche()['latenza_ms']}")
+
+    # Raffica di urgenze dal bot: passano dall'outbox e vengono raggruppate
+    stub.azzera()
+    main.FIREBASE_SERVER_KEY = 'benchmark'
+    main.notificatore.url = url
+    main.notificatore.sessione.close()
+    inizio = time.perf_counter()
+    for i in range(n):
+        main.officine.predefinita.bot.invia_push_notification(_notifica(i))
+    while main.coda_invii.conteggi().get('inviato', 0) < n:
+        time.sleep(0.01)
+    riga(f'outbox + finestra {main.FCM_FINESTRA * 1000:.0f} ms',
+         time.perf_counter() - inizio)
+    print(f"    {main.notificatore.statistiche()}")
+
+
+# ==================== WEBHOOK ====================
+
+# Copioni dei tre flussi: urgenza, tagliando, preventivo
+COPIONI = (
+    ('ciao', 'Fiat Panda', '1', '1'),
+    ('ciao', 'Fiat Punto', '1', '2'),
+    ('buongiorno', 'VW Golf', '2', 'spia olio accesa', 'mattina'),
+    ('salve', 'Opel Corsa', '3', 'freni', 'serve prima un controllo'),
+)
+
+
+def _percentile(valori, p):
+    return valori[min(len(valori) - 1, int(len(valori) * p))] * 1000
+
+
+def _rss_kb(pid):
+    """Memoria residente di un processo (Linux), 0 se non disponibile"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for riga in f:
+                if riga.startswith('VmRSS:'):
+                    return int(riga.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class ClientInProcesso:
+    """Chiama l'app Flask direttamente, senza rete né gunicorn"""
+
+    def __init__(self):
+        self.client = main.app.test_client()
+        self.pids = [os.getpid()]
+
+    def post(self, dati):
+        risposta = self.client.post('/webhook/whatsapp', data=dati)
+        return risposta.status_code
+
+    def stato(self):
+        return self.client.get('/').get_json()
+
+    def chiudi(self):
+        pass
+
+
+class ClientGunicorn:
+    """Avvia `gunicorn main:app` con le opzioni date e lo chiama via HTTP"""
+
+    def __init__(self, opzioni, stub):
+        porta = _porta_libera()
+        env = dict(os.environ,
+                   DATABASE_PATH=os.path.join(_CARTELLA, 'gunicorn.db'),
+                   FCM_URL=f'{stub.url}/fcm/send',
+                   FIREBASE_SERVER_KEY='benchmark',
+                   TWILIO_ACCOUNT_SID='',
+                   TWILIO_AUTH_TOKEN='')
+        self.processo = subprocess.Popen(
+            ['gunicorn', 'main:app', '--bind', f'127.0.0.1:{porta}'] +
+            shlex.split(opzioni),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        self.url = f'http://127.0.0.1:{porta}'
+        self._locale = threading.local()
+        for _ in range(100):
+            try:
+                self.stato()
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            self.chiudi()
+            raise RuntimeError('gunicorn non risponde')
+
+    @property
+    def pids(self):
+        figli = subprocess.run(['pgrep', '-P', str(self.processo.pid)],
+                               capture_output=True,
+                               text=True).stdout.split()
+        return [self.processo.pid] + [int(p) for p in figli]
+
+    def _sessione(self):
+        if not hasattr(self._locale, 'sessione'):
+            self._locale.sessione = requests.Session()
+        return self._locale.sessione
+
+    def post(self, dati):
+        return self._sessione().post(f'{self.url}/webhook/whatsapp',
+                                     data=dati,
+                                     timeout=30).status_code
+
+    def stato(self):
+        return self._sessione().get(f'{self.url}/', timeout=30).json()
+
+    def chiudi(self):
+        self.processo.terminate()
+        self.processo.wait()
+
+
+def _porta_libera():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench_webhook(args):
+    """Latenza e throughput di /webhook/whatsapp su conversazioni sintetiche"""
+    stub = ServerStub()
+    if args.gunicorn is not None:
+        client = ClientGunicorn(args.gunicorn, stub)
+        modalita = f'gunicorn {args.gunicorn}'.strip()
+    else:
+        main.FIREBASE_SERVER_KEY = 'benchmark'
+        main.notificatore.url = f'{stub.url}/fcm/send'
+        client = ClientInProcesso()
+        modalita = 'in processo (Flask test client)'
+
+    rng = random.Random(42)
+    copioni = []
+    completate = 0
+    for i in range(args.numeri):
+        copione = rng.choice(COPIONI)
+        # Una parte dei clienti abbandona la conversazione a metà
+        if rng.random() < args.abbandono:
+            copione = copione[:rng.randint(1, len(copione) - 1)]
+        else:
+            completate += 1
+        copioni.append((f'whatsapp:+39{3_000_000_000 + i}', copione))
+
+    stato_iniziale = client.stato()
+    rss_iniziale = sum(_rss_kb(pid) for pid in client.pids)
+    latenze = []
+    errori = Counter()
+    prossimo = iter(copioni)
+    lock = threading.Lock()
+
+    def simula_clienti():
+        # Ogni thread gioca conversazioni intere: l'ordine per numero è garantito
+        while True:
+            with lock:
+                voce = next(prossimo, None)
+            if voce is None:
+                return
+            numero, copione = voce
+            for messaggio in copione:
+                inizio = time.perf_counter()
+                try:
+                    codice = client.post({
+                        'From': numero,
+                        'Body': messaggio,
+                        'MessageSid': f'SM{uuid.uuid4().hex}'
+                    })
+                    if codice != 200:
+                        errori[codice] += 1
+                except requests.RequestException as e:
+                    errori[type(e).__name__] += 1
+                latenze.append(time.perf_counter() - inizio)
+
+    threads = [
+        threading.Thread(target=simula_clienti) for _ in range(args.thread)
+    ]
+    inizio = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    durata = time.perf_counter() - inizio
+
+    time.sleep(main.RICHIESTE_LOTTO_ATTESA * 10)  # richieste differite
+    stato_finale = client.stato()
+    rss_finale = sum(_rss_kb(pid) for pid in client.pids)
+    client.chiudi()
+
+    latenze.sort()
+    salvate = (stato_finale['richieste_totali'] -
+               stato_iniziale['richieste_totali'])
+    print(f"\n📊 WEBHOOK {modalita}")
+    print(f"  {args.numeri} numeri, {len(latenze)} messaggi, "
+          f"{args.thread} client concorrenti")
+    print(f"  throughput          {len(latenze) / durata:>10,.0f} msg/s")
+    print(f"  latenza p50/p95/p99 {_percentile(latenze, 0.5):>7.2f} / "
+          f"{_percentile(latenze, 0.95):.2f} / "
+          f"{_percentile(latenze, 0.99):.2f} ms")
+    print(f"  errori HTTP         {dict(errori) or 0}")
+    print(f"  conversazioni       {stato_iniziale['conversazioni_attive']} -> "
+          f"{stato_finale['conversazioni_attive']} attive "
+          f"({args.numeri - completate} abbandonate)")
+    print(f"  memoria (RSS)       {rss_iniziale / 1024:,.1f} -> "
+          f"{rss_finale / 1024:,.1f} MB")
+    perse = completate - salvate
+    print(f"  richieste salvate   {salvate}/{completate}" +
+          (f" ({perse} perse per contesa SQLite)" if perse > 0 else ''))
+
+
+# ==================== BOT ====================
+
+
+def bench_bot(args):
+    """Messaggi/s per core della macchina a stati di BotOfficina"""
+    officina = main.officine.predefinita
+    bot = officina.bot
+    n = args.operazioni * 100
+    print(f"\n📊 BOT ({n:,} messaggi, un solo thread)")
+
+    # Solo dispatch: i copioni senza l'ultimo messaggio (niente chiusura)
+    messaggi = [copione[:-1] for copione in COPIONI]
+    inizio = time.perf_counter()
+    inviati = 0
+    while inviati < n:
+        for copione in messaggi:
+            conv = {'step': None, 'dati': {}}
+            for messaggio in copione:
+                bot.avanza_conversazione('whatsapp:+390', conv, messaggio)
+            inviati += len(copione)
+    _stampa('avanza_conversazione (dispatch)', inviati,
+            time.perf_counter() - inizio)
+
+    # Conversazioni complete: archivio in memoria + salvataggio su SQLite
+    officina.conversazioni = main.ConversazioniMemoria(100_000, 3600)
+    n_conversazioni = args.operazioni
+    inizio = time.perf_counter()
+    inviati = 0
+    for i in range(n_conversazioni):
+        for messaggio in COPIONI[i % len(COPIONI)]:
+            bot.gestisci_messaggio(f'whatsapp:+39{i:010d}', messaggio)
+            inviati += 1
+    _stampa('gestisci_messaggio (con chiusura)', inviati,
+            time.perf_counter() - inizio)
+
+
+# ==================== CLIENTI CHE TORNANO ====================
+
+
+def bench_clienti(args):
+    """Messaggi per richiesta dei clienti che tornano, con e senza la
+    conferma dell'auto, e costo della lettura del profilo"""
+    n = args.operazioni
+    print(f"\n📊 CLIENTI CHE TORNANO ({n:,} clienti, due richieste a testa)")
+    for nome, percorso_breve in (('prima: si richiede l\'auto', False),
+                                 ('conferma insieme alla domanda', True)):
+        officina = _officina_bench(
+            f'clienti_{percorso_breve}',
+            os.path.join(_CARTELLA, f'clienti_{percorso_breve}.db'))
+        if not percorso_breve:
+            officina.bot.flusso.dopo_auto = None
+        officina.conversazioni = main.ConversazioniMemoria(100_000, 3600)
+        messaggi = 0
+        inizio = time.perf_counter()
+        for i in range(n):
+            numero = f'whatsapp:+35{i:010d}'
+            copione = COPIONI[i % len(COPIONI)]
+            for messaggio in copione:
+                officina.bot.gestisci_messaggio(numero, messaggio)
+            # Stessa auto: il secondo messaggio del copione non serve più
+            ritorno = copione[:1] + copione[2:] if percorso_breve else copione
+            for messaggio in ritorno:
+                officina.bot.gestisci_messaggio(numero, messaggio)
+            messaggi += len(copione) + len(ritorno)
+        secondi = time.perf_counter() - inizio
+        officina.db.buffer.svuota()
+        assert officina.db.conta_richieste() == 2 * n
+        print(f"  {nome:<40} {messaggi / (2 * n):>6.2f} messaggi/richiesta "
+              f"({2 * messaggi:,} messaggi WhatsApp tra ricevuti e inviati, "
+              f"{secondi:.1f} s)")
+
+    for righe in args.righe:
+        database = main.DatabaseRichieste(
+            os.path.join(_CARTELLA, f'richieste_{righe}.db'))
+        popola(database, righe)
+        storico = main.StoricoClienti(database)
+        numeri = [f'whatsapp:+39{i:010d}' for i in range(0, 50_000, 97)]
+        print(f"\n📊 Profilo del cliente con {righe:,} richieste (µs)")
+        casi = [
+            ('prima: senza indice per numero', lambda: database._leggi(
+                storico.SQL_ULTIMA.replace('FROM richieste',
+                                           'FROM richieste NOT INDEXED'),
+                (numeri[0], )), 1),
+            ('indice (numero_cliente, data)', lambda: [
+                database._leggi(storico.SQL_ULTIMA, (numero, ))
+                for numero in numeri
+            ], 1),
+            ('LRU in memoria', lambda: [
+                storico.profilo(numero) for numero in numeri
+            ], args.ripetizioni),
+        ]
+        for nome, funzione, ripetizioni in casi:
+            funzione()
+            chiamate = 1 if nome.startswith('prima') else len(numeri)
+            print(f"  {nome:<40} "
+                  f"{_misura(funzione, ripetizioni) * 1000 / chiamate:>10.1f}")
+
+
+# ==================== CAMPAGNE ====================
+
+
+def _popola_campagna(database, numeri):
+    """Tre richieste per cliente, clienti alternati tra le categorie"""
+    conn = database.connessione()
+    with conn:
+        conn.executemany(
+            database.SQL_INSERISCI,
+            ((f'whatsapp:+39{i % numeri:010d}', 'Fiat Panda', 'Tagliando',
+              '2', None, None, None, None, None, 'MANUTENZIONE',
+              '2025-03-01 10:00:00', 'completata')
+             for i in range(numeri * 3)))
+
+
+def bench_campagne(args):
+    """Campagna a --numeri clienti verso uno stub Twilio: un invio alla
+    volta contro il pool di thread, con e senza limite al secondo"""
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    stub = ServerStub(latenza=args.latenza_stub)
+    client = Client('AC' + '0' * 32,
+                    'benchmark',
+                    http_client=TwilioHttpClient(timeout=10))
+    client.api.base_url = stub.url
+    main._twilio_client = client
+    n = args.numeri
+    print(f"\n📊 CAMPAGNE ({n:,} clienti da {n * 3:,} richieste, Twilio "
+          f"simulato a {args.latenza_stub * 1000:.0f} ms)")
+
+    # Prima: un messaggio alla volta, come /api/risposta (su un campione)
+    campione = min(n, 100)
+    inizio = time.perf_counter()
+    for i in range(campione):
+        main.invia_whatsapp({
+            'from': 'whatsapp:+14155238886',
+            'to': f'whatsapp:+39{i:010d}',
+            'body': 'Tagliando'
+        })
+    secondi = time.perf_counter() - inizio
+    print(f"  {'prima: un invio alla volta':<40} "
+          f"{campione / secondi:>8,.0f} msg/s")
+
+    casi = [(8, 1e9), (32, 1e9), (32, 100)]
+    for n_thread, al_secondo in casi:
+        nome = f'campagne_{n_thread}_{al_secondo:.0f}'
+        officina = _officina_bench(nome,
+                                   os.path.join(_CARTELLA, f'{nome}.db'))
+        _popola_campagna(officina.db, n)
+        officina.campagne = main.CampagneOfficina(officina,
+                                                  n_thread=n_thread,
+                                                  al_secondo=al_secondo,
+                                                  burst=n_thread)
+        stub.azzera()
+        inizio = time.perf_counter()
+        id_campagna = officina.campagne.crea('Tagliando',
+                                             categoria='MANUTENZIONE')
+        while officina.campagne.leggi(id_campagna)['stato'] != 'completata':
+            time.sleep(0.05)
+        secondi = time.perf_counter() - inizio
+        campagna = officina.campagne.leggi(id_campagna)
+        limite = (f'max {al_secondo:.0f}/s'
+                  if al_secondo < 1e9 else 'senza limite')
+        print(f"  {f'pool {n_thread} thread, {limite}':<40} "
+              f"{stub.richieste / secondi:>8,.0f} msg/s "
+              f"({secondi:.1f} s, {campagna['avanzamento']})")
+
+
+# ==================== FIRMA WEBHOOK ====================
+
+
+def bench_firma(args):
+    """Costo per richiesta di firma, cache MessageSid e rate limiting"""
+    from twilio.request_validator import RequestValidator
+    from werkzeug.datastructures import MultiDict
+
+    url = 'https://officina.example.com/webhook/whatsapp'
+    form = MultiDict({
+        'SmsMessageSid': 'SM' + 'a' * 32,
+        'NumMedia': '0',
+        'ProfileName': 'Mario',
+        'SmsSid': 'SM' + 'a' * 32,
+        'WaId': '393331234567',
+        'SmsStatus': 'received',
+        'Body': 'Fiat Panda',
+        'To': 'whatsapp:+14155238886',
+        'NumSegments': '1',
+        'MessageSid': 'SM' + 'a' * 32,
+        'AccountSid': 'AC' + 'b' * 32,
+        'From': 'whatsapp:+393331234567',
+        'ApiVersion': '2010-04-01'
+    })
+    firma = RequestValidator('token').compute_signature(url, form.to_dict())
+    validatore = main.ValidatoreTwilio('token')
+    cache = main.CacheMessaggi(dimensione=10000, ttl=3600)
+    for i in range(10000):
+        cache.salva(f'SM{i}', 'risposta')
+    limitatore = main.LimitatoreMemoria(al_minuto=20, burst=10)
+    limitatore_sqlite = main.LimitatoreSQLite(main.db, al_minuto=20, burst=10)
+    n = args.operazioni * 10
+
+    print(f"\n📊 FIRMA WEBHOOK (µs per richiesta, {n:,} ripetizioni)")
+    casi = [
+        ('twilio RequestValidator.validate',
+         lambda: RequestValidator('token').validate(url, form.to_dict(),
+                                                    firma)),
+        ('ValidatoreTwilio.valida (HMAC precalcolato)',
+         lambda: validatore.valida(url, form, firma)),
+        ('CacheMessaggi.leggi (MessageSid nuovo)',
+         lambda: cache.leggi('SMnuovo')),
+        ('CacheMessaggi.salva', lambda: cache.salva('SMnuovo', 'risposta')),
+        ('LimitatoreMemoria.consenti',
+         lambda: limitatore.consenti(f'numero:{random.randrange(100000)}')),
+        ('LimitatoreSQLite.consenti',
+         lambda: limitatore_sqlite.consenti(
+             f'numero:{random.randrange(100000)}')),
+    ]
+    for nome, funzione in casi:
+        print(f"  {nome:<45} {_misura(funzione, n) * 1000:>8.2f}")
+
+
+# ==================== METRICHE ====================
+
+
+def bench_metriche(args):
+    """Costo della strumentazione sul percorso caldo"""
+    metriche = main.Metriche()
+    etichette = (('route', '/webhook/whatsapp'), ('metodo', 'POST'),
+                 ('stato', '200'))
+    n = args.operazioni * 100
+    print(f"\n📊 METRICHE (µs per chiamata, {n:,} ripetizioni)")
+    casi = [
+        ('incrementa (contatore con etichette)',
+         lambda: metriche.incrementa('http_richieste_totale', etichette)),
+        ('osserva (istogramma)',
+         lambda: metriche.osserva('http_durata_secondi', 0.003,
+                                  etichette[:1])),
+        ('perf_counter + osserva',
+         lambda: metriche.osserva('x', -time.perf_counter())),
+    ]
+    for nome, funzione in casi:
+        print(f"  {nome:<45} {_misura(funzione, n) * 1000:>8.3f}")
+
+    secondi, _ = _in_parallelo(
+        args.thread, lambda i: metriche.incrementa('concorrente'), n)
+    print(f"  {'incrementa da ' + str(args.thread) + ' thread':<45} "
+          f"{secondi * 1e6 / n:>8.3f}")
+    totale = metriche.istantanea()[0][('concorrente', ())]
+    print(f"  conteggio concorrente: {totale:,} su {n // args.thread * args.thread:,}")
+
+
+# ==================== INGESTIONE ====================
+
+
+def bench_ingestione(args):
+    """Chiusura concorrente di molte conversazioni: un INSERT e un commit per
+    richiesta contro il buffer a lotti (BufferRichieste)"""
+    main.limite_ip = main.LimitatoreMemoria(al_minuto=1e9, burst=10**9)
+    client = main.app.test_client()
+    n = args.conversazioni
+    sincrone_predefinite = main.RICHIESTE_SINCRONE
+
+    def salva_diretta(numero_cliente, dati, categoria, attendi=True):
+        # Com'era prima: INSERT e commit nel thread del webhook
+        return main.db._scrivi(
+            main.DatabaseRichieste.SQL_INSERISCI,
+            (numero_cliente, dati.get('auto'), dati.get('problema'),
+             dati.get('problema_cod'), dati.get('urgenza'),
+             dati.get('spie_comportamenti'), dati.get('preferenza_orario'),
+             dati.get('tipo_intervento'), dati.get('diagnosi_controllo'),
+             categoria, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+             'nuova')).lastrowid
+
+    modi = [
+        ('commit per richiesta (prima)', salva_diretta, None),
+        ('lotti, tutte sincrone', None,
+         {'URGENTE', 'MANUTENZIONE', 'PREVENTIVO'}),
+        ('lotti, solo URGENTE sincrona', None, sincrone_predefinite),
+    ]
+    print(f"\n📊 INGESTIONE ({n:,} conversazioni chiuse in contemporanea, "
+          f"lotti da {main.RICHIESTE_LOTTO_MAX} o "
+          f"{main.RICHIESTE_LOTTO_ATTESA * 1000:.0f} ms)")
+    print(f"  {'modo':<30} {'chiusure/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'commit':>7} {'salvate':>8}")
+    for indice, (nome, salva, sincrone) in enumerate(modi):
+        if salva:
+            main.db.salva_richiesta = salva
+        else:
+            main.db.__dict__.pop('salva_richiesta', None)
+            main.RICHIESTE_SINCRONE = sincrone
+
+        # Tutte le conversazioni arrivano all'ultimo messaggio
+        finali = []
+        for i in range(n):
+            numero = f'whatsapp:+39{indice}{i:09d}'
+            *messaggi, ultimo = COPIONI[i % len(COPIONI)]
+            for messaggio in messaggi:
+                client.post('/webhook/whatsapp',
+                            data={'From': numero, 'Body': messaggio})
+            finali.append({'From': numero, 'Body': ultimo})
+
+        richieste_iniziali = main.db.conta_richieste()
+        lotti_iniziali = main.db.buffer.statistiche().get('lotti', 0)
+        latenze = []
+        via = threading.Barrier(n + 1)
+
+        def chiudi(dati):
+            via.wait()
+            inizio = time.perf_counter()
+            client.post('/webhook/whatsapp', data=dati)
+            latenze.append(time.perf_counter() - inizio)
+
+        threads = [
+            threading.Thread(target=chiudi, args=(dati, )) for dati in finali
+        ]
+        for t in threads:
+            t.start()
+        via.wait()
+        inizio = time.perf_counter()
+        for t in threads:
+            t.join()
+        durata = time.perf_counter() - inizio
+        time.sleep(main.RICHIESTE_LOTTO_ATTESA * 10)  # righe differite
+
+        salvate = main.db.conta_richieste() - richieste_iniziali
+        commit = (salvate if salva else
+                  main.db.buffer.statistiche()['lotti'] - lotti_iniziali)
+        latenze.sort()
+        print(f"  {nome:<30} {n / durata:>10,.0f} "
+              f"{_percentile(latenze, 0.5):>8.1f} "
+              f"{_percentile(latenze, 0.99):>8.1f} {commit:>7,} "
+              f"{salvate:>8,}")
+
+    main.RICHIESTE_SINCRONE = sincrone_predefinite
+    main.db.__dict__.pop('salva_richiesta', None)
+
+    # Solo il salvataggio, senza il resto del webhook
+    print(f"\n  solo salva_richiesta da {n:,} thread")
+    print(f"  {'modo':<30} {'righe/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'commit':>7}")
+    for nome, salva, attendi in (
+        ('commit per richiesta (prima)', salva_diretta, True),
+        ('lotti, attendi=True', main.db.salva_richiesta, True),
+        ('lotti, attendi=False', main.db.salva_richiesta, False),
+    ):
+        lotti_iniziali = main.db.buffer.statistiche().get('lotti', 0)
+        latenze = []
+        via = threading.Barrier(n + 1)
+
+        def salva_una(i):
+            via.wait()
+            inizio = time.perf_counter()
+            salva(f'whatsapp:+39{i:010d}', DATI_ESEMPIO, 'URGENTE', attendi)
+            latenze.append(time.perf_counter() - inizio)
+
+        threads = [
+            threading.Thread(target=salva_una, args=(i, )) for i in range(n)
+        ]
+        for t in threads:
+            t.start()
+        via.wait()
+        inizio = time.perf_counter()
+        for t in threads:
+            t.join()
+        durata = time.perf_counter() - inizio
+        time.sleep(main.RICHIESTE_LOTTO_ATTESA * 10)
+        commit = (n if salva is salva_diretta else
+                  main.db.buffer.statistiche()['lotti'] - lotti_iniziali)
+        latenze.sort()
+        print(f"  {nome:<30} {n / durata:>10,.0f} "
+              f"{_percentile(latenze, 0.5):>8.2f} "
+              f"{_percentile(latenze, 0.99):>8.2f} {commit:>7,}")
+
+
+# ==================== AVVIO A FREDDO ====================
+
+_MISURA_IMPORT = '''
+import sys, time
+inizio = time.perf_counter()
+import main
+print(time.perf_counter() - inizio, 'twilio.rest' in sys.modules,
+      'requests' in sys.modules)
+'''
+
+
+def _primo_avvio(comando, env):
+    """Avvia il server su un database nuovo (come un'istanza Cloud Run
+    appena creata); ritorna i secondi fino alla prima risposta di
+    /api/richieste e le latenze delle 16 richieste successive, ognuna
+    su una connessione nuova (i worker ancora freddi si vedono nel max)"""
+    porta = _porta_libera()
+    env = dict(os.environ,
+               DATABASE_PATH=os.path.join(_CARTELLA,
+                                          f'avvio_{uuid.uuid4().hex}.db'),
+               **env)
+    inizio = time.perf_counter()
+    processo = subprocess.Popen(
+        [c.replace('{porta}', str(porta)) for c in comando],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{porta}/api/richieste'
+    try:
+        while True:
+            try:
+                if requests.get(url, timeout=10).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                time.sleep(0.005)
+            if time.perf_counter() - inizio > 30:
+                raise RuntimeError(f'{comando[0]} non risponde')
+        prima = time.perf_counter() - inizio
+        latenze = []
+        for _ in range(16):
+            inizio_richiesta = time.perf_counter()
+            requests.get(url, timeout=10)
+            latenze.append(time.perf_counter() - inizio_richiesta)
+        return prima, latenze
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+
+
+def _commit_corrente():
+    """Commit del sorgente misurato ('' fuori da un repository git)"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def _registra_avvio(percorso, righe):
+    """Aggiunge le misure di un'esecuzione al file CSV dello storico
+    (creato con l'intestazione la prima volta)"""
+    nuovo = not os.path.exists(percorso)
+    with open(percorso, 'a', newline='', encoding='utf-8') as f:
+        scrittore = csv.writer(f)
+        if nuovo:
+            scrittore.writerow(('data', 'commit', 'modo', 'import_ms',
+                                'prima_risposta_ms', 'p50_ms', 'max_ms'))
+        scrittore.writerows(righe)
+
+
+def bench_avvio(args):
+    """Avvio a freddo: tempo di import di main e tempo alla prima risposta
+    di gunicorn, con e senza --preload. Ogni esecuzione si aggiunge allo
+    storico CSV (--storico) per seguire l'andamento tra i commit"""
+    ripetizioni = max(args.ripetizioni // 20, 3)
+    env = {
+        'TWILIO_ACCOUNT_SID': 'AC' + '0' * 32,
+        'TWILIO_AUTH_TOKEN': 'benchmark',
+        'LOG_LEVEL': 'WARNING',
+    }
+    print(f"\n📊 AVVIO A FREDDO (mediana di {ripetizioni} avvii)")
+
+    misure = []
+    for _ in range(ripetizioni):
+        uscita = subprocess.run(
+            [sys.executable, '-c', _MISURA_IMPORT],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ,
+                     DATABASE_PATH=os.path.join(
+                         _CARTELLA, f'avvio_{uuid.uuid4().hex}.db'),
+                     **env),
+            capture_output=True,
+            text=True).stdout.split()
+        misure.append(float(uscita[0]))
+    misure.sort()
+    import_ms = misure[len(misure) // 2] * 1000
+    print(f"  {'import main':<40} {import_ms:>8.0f} ms"
+          f"   (twilio caricato: {uscita[1]}, requests: {uscita[2]})")
+
+    modi = [
+        ('gunicorn main:app -w 4',
+         ['gunicorn', 'main:app', '--bind', '127.0.0.1:{porta}', '-w', '4']),
+        ("gunicorn 'main:crea_app()' --preload -w 4", [
+            'gunicorn', 'main:crea_app()', '--preload', '--bind',
+            '127.0.0.1:{porta}', '-w', '4'
+        ]),
+    ]
+    data = datetime.now().isoformat(timespec='seconds')
+    commit = _commit_corrente()
+    storico = []
+    for nome, comando in modi:
+        prime = []
+        latenze = []
+        for _ in range(ripetizioni):
+            prima, successive = _primo_avvio(comando, env)
+            prime.append(prima)
+            latenze += successive
+        prime.sort()
+        latenze.sort()
+        print(f"\n {nome}")
+        print(f"  {'prima risposta':<40} "
+              f"{prime[len(prime) // 2] * 1000:>8.0f} ms")
+        print(f"  {'16 richieste successive':<40} "
+              f"p50 {_percentile(latenze, 0.5):>6.1f} ms   "
+              f"max {latenze[-1] * 1000:>6.1f} ms")
+        storico.append(
+            (data, commit, nome, round(import_ms),
+             round(prime[len(prime) // 2] * 1000),
+             round(_percentile(latenze, 0.5), 1),
+             round(latenze[-1] * 1000, 1)))
+
+    if args.storico:
+        _registra_avvio(args.storico, storico)
+        print(f"\n  Misure aggiunte a {args.storico}")
+
+
+# ==================== ASGI ====================
+
+
+class ServerEsterno:
+    """Avvia il backend con un comando (gunicorn, uvicorn) su una porta
+    libera e aspetta che risponda"""
+
+    def __init__(self, comando, env):
+        porta = _porta_libera()
+        self.processo = subprocess.Popen(
+            [c.replace('{porta}', str(porta)) for c in comando],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, **env),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        self.url = f'http://127.0.0.1:{porta}'
+        for _ in range(100):
+            try:
+                requests.get(f'{self.url}/', timeout=5)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        self.chiudi()
+        raise RuntimeError(f'{comando[0]} non risponde')
+
+    @property
+    def pids(self):
+        figli = subprocess.run(['pgrep', '-P', str(self.processo.pid)],
+                               capture_output=True,
+                               text=True).stdout.split()
+        return [self.processo.pid] + [int(p) for p in figli]
+
+    def thread(self):
+        """Thread totali dei processi del server (Linux)"""
+        totale = 0
+        for pid in self.pids:
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    totale += next(int(riga.split()[1]) for riga in f
+                                   if riga.startswith('Threads:'))
+            except (OSError, StopIteration):
+                pass
+        return totale
+
+    def chiudi(self):
+        self.processo.terminate()
+        try:
+            self.processo.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.processo.kill()
+
+
+async def _carico_asgi(url, n):
+    """n conversazioni contemporanee, ognuna seguita da una risposta del
+    titolare (/api/risposta, un invio Twilio)"""
+    import aiohttp
+
+    latenze = {'webhook': [], 'risposta': []}
+    errori = Counter()
+    connettore = aiohttp.TCPConnector(limit=n)
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(connector=connettore,
+                                     timeout=timeout) as sessione:
+
+        async def chiama(tipo, metodo, percorso, **opzioni):
+            inizio = time.perf_counter()
+            try:
+                async with sessione.request(metodo, url + percorso,
+                                            **opzioni) as risposta:
+                    await risposta.read()
+                    if risposta.status >= 300:
+                        errori[risposta.status] += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                errori[type(e).__name__] += 1
+            latenze[tipo].append(time.perf_counter() - inizio)
+
+        async def conversazione(i):
+            numero = f'whatsapp:+39{4_000_000_000 + i}'
+            for messaggio in COPIONI[i % len(COPIONI)]:
+                await chiama('webhook',
+                             'POST',
+                             '/webhook/whatsapp',
+                             data={
+                                 'From': numero,
+                                 'Body': messaggio,
+                                 'MessageSid': f'SM{uuid.uuid4().hex}'
+                             })
+            await chiama('risposta',
+                         'POST',
+                         '/api/risposta',
+                         json={
+                             'richiesta_id': 1,
+                             'messaggio': 'Ok, la aspettiamo'
+                         },
+                         headers={'Idempotency-Key': f'bench-{i}'})
+
+        inizio = time.perf_counter()
+        await asyncio.gather(*(conversazione(i) for i in range(n)))
+        durata = time.perf_counter() - inizio
+    return latenze, errori, durata
+
+
+def bench_asgi(args):
+    """gunicorn main:app contro uvicorn asgi:app: richieste in corso
+    contemporaneamente, latenza e smaltimento degli invii Twilio/FCM"""
+    # Default: come nel Procfile, senza il tetto di 1000 connessioni di gthread
+    opzioni = '--threads 32 --worker-connections 4096' if args.gunicorn is None else args.gunicorn
+    stub = ServerStub(latenza=args.latenza_stub)
+    n = args.conversazioni
+    env = {
+        'FCM_URL': f'{stub.url}/fcm/send',
+        'FIREBASE_SERVER_KEY': 'benchmark',
+        'TWILIO_ACCOUNT_SID': 'AC' + '0' * 32,
+        'TWILIO_AUTH_TOKEN': 'benchmark',
+        'TWILIO_WHATSAPP_NUMBER': 'whatsapp:+14155238886',
+        'TWILIO_API_URL': stub.url,
+        'TWILIO_VALIDA_FIRMA': '0',
+        'LIMITE_IP_AL_MINUTO': '1e9',
+        'LIMITE_IP_BURST': '1000000000',
+        'LOG_LEVEL': 'WARNING',
+    }
+    modi = [
+        ('gunicorn main:app ' + opzioni,
+         ['gunicorn', 'main:app', '--bind', '127.0.0.1:{porta}'] +
+         shlex.split(opzioni)),
+        ('uvicorn asgi:app', [
+            'uvicorn', 'asgi:app', '--port', '{porta}', '--log-level',
+            'warning', '--backlog', '4096'
+        ]),
+    ]
+    print(f"\n📊 ASGI ({n:,} conversazioni contemporanee + {n:,} risposte "
+          f"del titolare, Twilio/FCM simulati a "
+          f"{args.latenza_stub * 1000:.0f} ms)")
+    for nome, comando in modi:
+        stub.azzera()
+        db_path = os.path.join(_CARTELLA, f'asgi_{comando[0]}.db')
+        server = ServerEsterno(comando, dict(env, DATABASE_PATH=db_path))
+        try:
+            # Una richiesta (id 1) a cui rispondono tutti i client
+            for messaggio in COPIONI[0]:
+                requests.post(f'{server.url}/webhook/whatsapp',
+                              data={
+                                  'From': 'whatsapp:+390000000000',
+                                  'Body': messaggio
+                              })
+
+            thread_iniziali = server.thread()
+            latenze, errori, durata = asyncio.run(
+                _carico_asgi(server.url, n))
+            thread_finali = server.thread()
+
+            # Tempo per consegnare tutti gli invii accodati
+            inizio = time.perf_counter()
+            while True:
+                conteggi = requests.get(f'{server.url}/api/invii',
+                                        timeout=30).json()['conteggi']
+                if not set(conteggi) - {'inviato', 'fallito'}:
+                    break
+                time.sleep(0.2)
+            smaltimento = durata + time.perf_counter() - inizio
+            rss = sum(_rss_kb(pid) for pid in server.pids)
+        finally:
+            server.chiudi()
+
+        print(f"\n {nome}")
+        for tipo, valori in latenze.items():
+            valori.sort()
+            print(f"  {tipo:<10} {len(valori) / durata:>8,.0f} req/s   "
+                  f"p50 {_percentile(valori, 0.5):>8.1f} ms   "
+                  f"p99 {_percentile(valori, 0.99):>8.1f} ms")
+        print(f"  errori          {dict(errori) or 0}")
+        print(f"  invii consegnati {conteggi.get('inviato', 0):,} "
+              f"(falliti {conteggi.get('fallito', 0)}) in "
+              f"{smaltimento:.1f} s dall'inizio")
+        print(f"  thread server    {thread_iniziali} -> {thread_finali}, "
+              f"RSS {rss / 1024:,.1f} MB")
+
+
+# ==================== CHANGE FEED ====================
+
+
+class _DatabaseContato(main.DatabaseRichieste):
+    """DatabaseRichieste che conta le letture eseguite"""
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self.letture = 0
+
+    def _leggi(self, sql, parametri=()):
+        self.letture += 1
+        return super()._leggi(sql, parametri)
+
+
+def bench_eventi(args):
+    """Client collegati in attesa di nuove richieste: polling di
+    /api/richieste?since= ogni secondo contro il change feed (BusEventi)"""
+    n_eventi = 50
+    ogni = 0.05  # secondi tra due nuove richieste
+
+    def scrivi(database):
+        for i in range(n_eventi):
+            database.salva_richiesta(f'whatsapp:+39{i:010d}', DATI_ESEMPIO,
+                                     'URGENTE')
+            time.sleep(ogni)
+
+    def esegui(nome, database, cliente):
+        ritardi = []
+        threads = [
+            threading.Thread(target=cliente, args=(database, ritardi),
+                             daemon=True) for _ in range(args.clienti)
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        database.letture = 0
+        inizio = time.perf_counter()
+        scrivi(database)
+        for t in threads:
+            t.join()
+        secondi = time.perf_counter() - inizio
+        ritardi.sort()
+        print(f"  {nome:<28} {database.letture / secondi:>10.1f} "
+              f"{_percentile(ritardi, 0.5):>10.1f} "
+              f"{_percentile(ritardi, 0.99):>10.1f}")
+
+    def cliente_polling(database, ritardi):
+        # Come l'app oggi: ogni secondo chiede le richieste con id maggiore
+        ultimo, visti = database.conta_richieste(), 0
+        while visti < n_eventi:
+            righe, _ = database.cerca_richieste(since=ultimo,
+                                                campi=('id', ))
+            adesso = time.time()
+            for riga in righe:
+                ultimo = max(ultimo, riga['id'])
+                ritardi.append(adesso - creazione[riga['id']])
+            visti += len(righe)
+            time.sleep(1)
+
+    def cliente_eventi(database, ritardi, bus=None):
+        ultimo, visti = bus.ultimo_id, 0
+        while visti < n_eventi:
+            nuovi = bus.attendi(ultimo, timeout=5)
+            adesso = time.time()
+            for evento in nuovi:
+                ultimo = evento['id']
+                ritardi.append(adesso - evento['creato'])
+            visti += len(nuovi)
+
+    # Istante di creazione per id, per il ritardo del polling
+    creazione = {}
+
+    class _DatabaseConOrario(_DatabaseContato):
+
+        def salva_richiesta(self, *a):
+            id_richiesta = super().salva_richiesta(*a)
+            creazione[id_richiesta] = time.time()
+            return id_richiesta
+
+    print(f"\n📊 CHANGE FEED ({args.clienti} client, {n_eventi} nuove "
+          f"richieste, una ogni {ogni * 1000:.0f} ms)")
+    print(f"  {'modo':<28} {'query/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    esegui('polling ogni secondo',
+           _DatabaseConOrario(os.path.join(_CARTELLA, 'polling.db')),
+           cliente_polling)
+    database = _DatabaseContato(os.path.join(_CARTELLA, 'eventi.db'))
+    bus = main.BusEventi(database)
+    bus.avvia()
+    esegui('BusEventi (long-poll/SSE)', database,
+           lambda d, r: cliente_eventi(d, r, bus))
+
+
+# ==================== LOG ====================
+
+
+def _destinazione_lenta(latenza):
+    """Pipe letta a blocchi da 4 KB con una pausa: un collettore di log
+    (docker, journald) che non tiene il passo"""
+    lettura, scrittura = os.pipe()
+
+    def leggi():
+        while os.read(lettura, 4096):
+            time.sleep(latenza)
+
+    threading.Thread(target=leggi, daemon=True).start()
+    return open(scrittura, 'w', buffering=1, encoding='utf-8')
+
+
+def _misura_in_richiesta(funzione, n, attesa=0.0002):
+    """µs medi della sola chiamata, intervallata da un'attesa che simula
+    l'I/O della richiesta (il thread del log lavora in quel momento)"""
+    totale = 0.0
+    for _ in range(n):
+        inizio = time.perf_counter()
+        funzione()
+        totale += time.perf_counter() - inizio
+        time.sleep(attesa)
+    return totale / n * 1e6
+
+
+def bench_log(args):
+    """Costo dei log sul thread della richiesta per una conversazione
+    completa: print() di prima contro logger JSON in coda"""
+    import logging
+    import sys
+
+    n = args.operazioni
+    messaggi = len(COPIONI[0])
+    numero = 'whatsapp:+393331234567'
+    main.contesto_log.set({'message_sid': 'SM' + 'a' * 32, 'cliente': numero})
+
+    def conversazione_print(destinazione):
+        # Le righe che il percorso del webhook stampava per conversazione
+        stdout, sys.stdout = sys.stdout, destinazione
+        try:
+            for _ in range(messaggi):
+                print(f"📩 Messaggio da {numero}: Fiat Panda")
+            print(f"✅ Richiesta salvata per {numero}")
+            print("📱 Richiesta salvata: Meccanica - Fiat Panda")
+            print("📱 Notifica accodata: Meccanica - Fiat Panda")
+        finally:
+            sys.stdout = stdout
+
+    def conversazione_log(logger):
+        for _ in range(messaggi):
+            main.debug_campionato('Messaggio ricevuto', testo='Fiat Panda')
+        logger.debug('Richiesta salvata',
+                     extra=main.campi(cliente=numero, richiesta_id=1))
+        logger.info('Conversazione chiusa',
+                    extra=main.campi(categoria='Meccanica',
+                                     auto='Fiat Panda',
+                                     richiesta_id=1))
+        logger.debug('Notifica accodata',
+                     extra=main.campi(categoria='Meccanica',
+                                      auto='Fiat Panda'))
+
+    print(f"\n📊 LOG (µs sul thread della richiesta per conversazione di "
+          f"{messaggi} messaggi, {n:,} conversazioni)")
+    for nome_destinazione, destinazione in (
+        ('file', open(os.path.join(_CARTELLA, 'log.txt'), 'w',
+                      buffering=1, encoding='utf-8')),
+        ('pipe lenta', _destinazione_lenta(0.05)),
+    ):
+        finale = logging.StreamHandler(destinazione)
+        finale.setFormatter(main.FormatterJSON())
+        gestore = main.GestoreCodaLog(finale)
+        logger = logging.getLogger(f'bench_officina.{len(nome_destinazione)}')
+        logger.handlers[:] = [gestore]
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        gestore.avvia()
+
+        casi = [
+            ('print() (prima)', lambda: conversazione_print(destinazione)),
+            ('logger JSON in coda', lambda: conversazione_log(logger)),
+        ]
+        for nome, funzione in casi:
+            print(f"  {nome_destinazione + ': ' + nome:<45} "
+                  f"{_misura_in_richiesta(funzione, n):>8.2f}")
+        gestore.ferma()
+        print(f"  {nome_destinazione + ': righe scartate':<45} "
+              f"{gestore.scartati:>8,}")
+
+    main.contesto_log.set(None)
+
+
+# ==================== OFFICINE ====================
+
+
+def _officina_bench(id_officina, percorso):
+    """Officina costruita a mano: nel confronto con un solo file due
+    officine condividono il database, cosa che RegistroOfficine rifiuta"""
+    return main.Officina({'id': id_officina},
+                         main.DatabaseRichieste(percorso),
+                         main.FlussoCompilato(main.FLUSSO_PREDEFINITO))
+
+
+def _conversazione(officina, numero, copione, latenze=None):
+    """Un copione completo; ritorna i messaggi falliti per lock SQLite"""
+    errori = 0
+    for messaggio in copione:
+        inizio = time.perf_counter()
+        try:
+            officina.bot.gestisci_messaggio(numero, messaggio)
+        except sqlite3.OperationalError:
+            errori += 1
+        if latenze is not None:
+            latenze.append(time.perf_counter() - inizio)
+    return errori
+
+
+def _raffica(percorso, indice, ferma, contatori):
+    """Processo worker dell'officina affollata: conversazioni complete a
+    ciclo continuo finché `ferma` non viene impostato"""
+    officina = _officina_bench('affollata', percorso)
+    i = 0
+    while not ferma.is_set():
+        copione = COPIONI[i % len(COPIONI)]
+        errori = _conversazione(officina, f'whatsapp:+38{indice}{i:09d}',
+                                copione)
+        with contatori.get_lock():
+            contatori[0] += len(copione)
+            contatori[1] += errori
+        i += 1
+
+
+def _importazione(percorso, ferma, righe, intervallo):
+    """Processo dell'officina affollata che importa richieste a lotti da
+    5000 righe, una transazione per lotto (es: import da CSV)"""
+    database = main.DatabaseRichieste(percorso)
+    parametri = [('whatsapp:+36', 'Fiat Panda', 'Tagliando / controllo', '2',
+                  None, None, None, None, None, 'MANUTENZIONE',
+                  '2020-01-01 00:00:00', 'completata')] * 5000
+    while not ferma.wait(intervallo):
+        with database.connessione() as conn:
+            conn.executemany(main.DatabaseRichieste.SQL_INSERISCI, parametri)
+        with righe.get_lock():
+            righe.value += len(parametri)
+
+
+def bench_officine(args):
+    """Latenza di un'officina tranquilla mentre un'altra, su più processi,
+    riceve messaggi a raffica e importa righe a lotti: stesso file SQLite
+    contro un file per officina"""
+    import multiprocessing
+    contesto = multiprocessing.get_context('fork')
+    n = args.conversazioni // 10
+    print(f"\n📊 OFFICINE ({args.thread} processi a raffica + 1 import da "
+          f"5000 righe ogni {args.intervallo_import}s sull'officina "
+          f"affollata, {n} conversazioni sulla tranquilla)")
+    print(f"  {'database':<22} {'tranquilla p50':>14} {'p99':>8} {'max':>8} "
+          f"{'errori':>6} {'affollata msg/s':>16} {'errori':>6}")
+    for indice, (nome, condiviso) in enumerate(
+            (('un solo file (prima)', True), ('un file per officina', False))):
+        cartella = os.path.join(_CARTELLA, f'officine_{indice}')
+        os.makedirs(cartella)
+        affollata = os.path.join(cartella, 'affollata.db')
+        tranquilla = affollata if condiviso else os.path.join(
+            cartella, 'tranquilla.db')
+        officina = _officina_bench('tranquilla', tranquilla)
+        main.DatabaseRichieste(affollata)  # schema prima del fork
+
+        ferma = contesto.Event()
+        contatori = contesto.Array('q', 2)  # messaggi, errori
+        importate = contesto.Value('q', 0)
+        processi = [
+            contesto.Process(target=_raffica,
+                             args=(affollata, p, ferma, contatori))
+            for p in range(args.thread)
+        ] + [
+            contesto.Process(target=_importazione,
+                             args=(affollata, ferma, importate,
+                                   args.intervallo_import))
+        ]
+        for processo in processi:
+            processo.start()
+        time.sleep(1)  # i worker a regime
+
+        latenze = []
+        errori = 0
+        messaggi_iniziali = contatori[0]
+        inizio = time.perf_counter()
+        for i in range(n):
+            errori += _conversazione(officina,
+                                     f'whatsapp:+37{indice}{i:09d}',
+                                     COPIONI[i % len(COPIONI)], latenze)
+        durata = time.perf_counter() - inizio
+        al_secondo = (contatori[0] - messaggi_iniziali) / durata
+        ferma.set()
+        for processo in processi:
+            processo.join()
+        latenze.sort()
+        print(f"  {nome:<22} {_percentile(latenze, 0.5):>11.2f} ms "
+              f"{_percentile(latenze, 0.99):>8.2f} "
+              f"{latenze[-1] * 1000:>8.2f} {errori:>6} {al_secondo:>16,.0f} "
+              f"{contatori[1]:>6}")
+
+
+# ==================== AVVIO ====================
+
+BENCHMARK = {
+    'database': bench_database,
+    'richieste': bench_richieste,
+    'etag': bench_etag,
+    'statistiche': bench_statistiche,
+    'esportazione': bench_esportazione,
+    'ricerca': bench_ricerca,
+    'archivio': bench_archivio,
+    'push': bench_push,
+    'webhook': bench_webhook,
+    'bot': bench_bot,
+    'clienti': bench_clienti,
+    'campagne': bench_campagne,
+    'firma': bench_firma,
+    'metriche': bench_metriche,
+    'log': bench_log,
+    'eventi': bench_eventi,
+    'ingestione': bench_ingestione,
+    'asgi': bench_asgi,
+    'officine': bench_officine,
+    'avvio': bench_avvio,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARK))
+    parser.add_argument('--operazioni', type=int, default=2000)
+    parser.add_argument('--thread', type=int, default=4)
+    parser.add_argument('--ripetizioni', type=int, default=200)
+    parser.add_argument('--numeri', type=int, default=2000)
+    parser.add_argument('--clienti', type=int, default=200)
+    parser.add_argument('--conversazioni', type=int, default=1000)
+    parser.add_argument('--latenza-stub', type=float, default=0.05)
+    parser.add_argument('--intervallo-import', type=float, default=0.5)
+    parser.add_argument('--abbandono', type=float, default=0.1)
+    parser.add_argument('--storico',
+                        metavar='FILE',
+                        default='benchmark_avvio.csv',
+                        help="CSV a cui 'avvio' aggiunge le misure "
+                        "('' per non salvarle)")
+    parser.add_argument('--gunicorn',
+                        metavar='OPZIONI',
+                        help="es: '-w 4 --threads 8' (default: in processo)")
+    parser.add_argument('--righe',
+                        type=lambda v: [int(x) for x in v.split(',')],
+                        default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+    BENCHMARK[args.benchmark](args)
@@ -1,18 +1,41 @@
-from flask import Flask, request, jsonify
-from twilio.rest import Client
-from twilio.twiml.messaging_response import MessagingResponse
+from flask import Flask, Response, abort, make_response, request, jsonify
 import os
-from datetime import datetime
+import sys
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import base64
+import bisect
+import binascii
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import zlib
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit
 import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import json
-import requests
+# twilio e requests (il grosso dell'import dopo Flask) si importano al primo
+# invio: un avvio a freddo che non invia nulla non li carica
 from dotenv import load_dotenv
+import click
 from flask_cors import CORS
 
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Cursore-Successivo', 'X-Ultimo-Id', 'ETag'])
 
 
 # ==================== CONFIGURAZIONE ====================
@@ -22,296 +45,3831 @@ TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
 TWILIO_WHATSAPP_NUMBER = os.getenv(
     'TWILIO_WHATSAPP_NUMBER')  # es: whatsapp:+14155238886
 FIREBASE_SERVER_KEY = os.getenv('FIREBASE_SERVER_KEY')  # Per notifiche push
+FCM_URL = os.getenv('FCM_URL', 'https://fcm.googleapis.com/fcm/send')
+FCM_TOPIC = os.getenv('FCM_TOPIC', '/topics/titolare_officina')
 
-# Crea client Twilio solo se le credenziali sono presenti
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-    print("✅ Twilio client creato con successo")
-else:
-    twilio_client = None
-    print(
-        "⚠️ ATTENZIONE: Credenziali Twilio non configurate. Il bot non potrà inviare messaggi."
-    )
+# Più officine sullo stesso deployment: file JSON con una voce per officina
+# (id, numero WhatsApp, topic FCM, flusso del bot...). Senza, una sola
+# officina configurata dalle variabili qui sopra
+OFFICINE_PATH = os.getenv('OFFICINE_PATH')
+OFFICINE_DB_DIR = os.getenv('OFFICINE_DB_DIR',
+                            'officine')  # un file SQLite per officina
 
-# Database in-memory (usa Firebase/PostgreSQL in produzione)
+# API REST di Twilio (da cambiare solo per proxy o server di test)
+TWILIO_API_URL = os.getenv('TWILIO_API_URL')
 
-conversazioni = {}
-richieste = []
+# Verifica X-Twilio-Signature sul webhook (attiva se c'è l'auth token)
+TWILIO_VALIDA_FIRMA = os.getenv('TWILIO_VALIDA_FIRMA', '1') != '0'
+TWILIO_WEBHOOK_URL = os.getenv(
+    'TWILIO_WEBHOOK_URL')  # URL pubblico configurato su Twilio
 
+# Rate limiting del webhook: 'memoria' (per worker) o 'sqlite' (condiviso)
+LIMITE_BACKEND = os.getenv('LIMITE_BACKEND', 'memoria')
+LIMITE_NUMERO_AL_MINUTO = float(os.getenv('LIMITE_NUMERO_AL_MINUTO', '20'))
+LIMITE_NUMERO_BURST = int(os.getenv('LIMITE_NUMERO_BURST', '10'))
+# Tutto il traffico legittimo arriva dagli IP di Twilio: limite ampio
+LIMITE_IP_AL_MINUTO = float(os.getenv('LIMITE_IP_AL_MINUTO', '6000'))
+LIMITE_IP_BURST = int(os.getenv('LIMITE_IP_BURST', '500'))
+# Proxy fidati davanti all'app che aggiungono X-Forwarded-For (Cloud Run: 1;
+# 0 = nessuno, conta solo l'indirizzo della connessione)
+PROXY_FIDATI = int(os.getenv('PROXY_FIDATI', '1'))
 
-class DatabaseRichieste:
+# Invii in uscita (Twilio/Firebase) tramite outbox
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))  # secondi
+OUTBOX_WORKER = int(os.getenv('OUTBOX_WORKER', '2'))
+OUTBOX_MAX_TENTATIVI = int(os.getenv('OUTBOX_MAX_TENTATIVI', '8'))
+
+# Notifiche push: finestra di raggruppamento e limite per destinazione
+FCM_FINESTRA = float(os.getenv('FCM_FINESTRA_MS', '1000')) / 1000  # secondi
+FCM_AL_SECONDO = float(os.getenv('FCM_AL_SECONDO', '1'))
+FCM_BURST = int(os.getenv('FCM_BURST', '5'))
+
+# Database SQLite delle richieste
+DB_PATH = os.getenv('DATABASE_PATH', 'richieste_officina.db')
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', '5'))  # secondi di attesa sui lock
+DB_CACHE_STATEMENT = 256  # statement preparati in cache per connessione
+
+# Scrittura delle nuove richieste a lotti (write-behind): righe per lotto,
+# attesa massima e categorie salvate in modo sincrono (commit prima della
+# risposta al cliente)
+RICHIESTE_LOTTO_MAX = int(os.getenv('RICHIESTE_LOTTO_MAX', '100'))
+RICHIESTE_LOTTO_ATTESA = float(os.getenv('RICHIESTE_LOTTO_MS',
+                                         '5')) / 1000  # secondi
+RICHIESTE_SINCRONE = set(
+    os.getenv('RICHIESTE_SINCRONE', 'URGENTE').split(','))
+# Attesa massima del commit di una riga sincrona, poi INSERT diretto
+RICHIESTE_ATTESA_MAX = 2 * DB_BUSY_TIMEOUT  # secondi
+
+# Stato delle conversazioni: 'sqlite' (condiviso tra i worker) o 'memoria'
+CONVERSAZIONI_BACKEND = os.getenv('CONVERSAZIONI_BACKEND', 'sqlite')
+CONVERSAZIONI_TTL = int(os.getenv('CONVERSAZIONI_TTL',
+                                  str(24 * 3600)))  # secondi di inattività
+CONVERSAZIONI_MAX = int(os.getenv('CONVERSAZIONI_MAX', '10000'))
+# Una conversazione chiusa resta così a lungo solo con l'ultima risposta,
+# per i retry di Twilio che arrivano a un altro worker
+CONVERSAZIONI_TTL_CHIUSE = int(os.getenv('CONVERSAZIONI_TTL_CHIUSE',
+                                         '600'))  # secondi
+
+# Flusso del bot personalizzato (JSON), altrimenti FLUSSO_PREDEFINITO
+FLUSSO_PATH = os.getenv('FLUSSO_PATH')
+
+# Archiviazione delle richieste completate in file mensili compressi
+ARCHIVIO_DOPO_GIORNI = int(os.getenv('ARCHIVIO_DOPO_GIORNI',
+                                     '365'))  # 0 = disattivata
+ARCHIVIO_DIR = os.getenv('ARCHIVIO_DIR', 'archivio')
+ARCHIVIO_INTERVALLO = float(os.getenv('ARCHIVIO_INTERVALLO',
+                                      '3600'))  # secondi tra due giri
+ARCHIVIO_BLOCCO = 1000  # righe per lotto
+ARCHIVIO_VACUUM_PAGINE = 5000  # pagine restituite al filesystem per giro
+
+# Profili dei clienti che tornano (ultima auto e richiesta) in memoria
+STORICO_CLIENTI_MAX = int(os.getenv('STORICO_CLIENTI_MAX', '10000'))
+STORICO_CLIENTI_DURATA = float(os.getenv('STORICO_CLIENTI_DURATA',
+                                         '600'))  # secondi
+
+# Campagne (invii massivi): thread e messaggi al secondo per officina, da
+# tenere sotto il limite Twilio del numero mittente
+CAMPAGNE_THREAD = int(os.getenv('CAMPAGNE_THREAD', '8'))
+CAMPAGNE_AL_SECONDO = float(os.getenv('CAMPAGNE_AL_SECONDO', '10'))
+CAMPAGNE_BURST = int(os.getenv('CAMPAGNE_BURST', '10'))
+CAMPAGNE_MAX_TENTATIVI = int(os.getenv('CAMPAGNE_MAX_TENTATIVI', '5'))
+CAMPAGNE_BLOCCO = 1000  # righe lette per volta scegliendo i destinatari
+
+# Esportazione in streaming e import massivo delle richieste
+ESPORTA_BLOCCO = 1000  # righe lette e inviate per volta
+# Righe per transazione nell'import (flask importa-richieste)
+IMPORTA_BLOCCO = int(os.getenv('IMPORTA_BLOCCO', '10000'))
+
+# Change feed per l'app: lettura della tabella eventi e ripresa
+EVENTI_INTERVALLO = float(os.getenv('EVENTI_INTERVALLO', '1'))  # secondi
+EVENTI_MEMORIA = 1000  # eventi recenti tenuti in memoria per worker
+EVENTI_CONSERVATI = int(os.getenv('EVENTI_CONSERVATI', '100000'))
+EVENTI_TIMEOUT = 25  # secondi di attesa di un long-poll / tra i ping SSE
+EVENTI_DURATA_SSE = int(os.getenv('EVENTI_DURATA_SSE', '300'))  # secondi
+# Flussi SSE e long-poll aperti insieme in un processo WSGI: ognuno tiene
+# occupato un thread, oltre il limite si risponde 503 (asgi.py non ha
+# limite, lì un client in attesa non occupa thread)
+EVENTI_MAX_CONNESSIONI = int(os.getenv('EVENTI_MAX_CONNESSIONI', '8'))
+
+# Cache delle letture dell'app del titolare (ETag): byte di corpi JSON
+# tenuti per worker
+CACHE_RISPOSTE_BYTE = int(
+    os.getenv('CACHE_RISPOSTE_BYTE', str(16 * 1024 * 1024)))
+
+# Log JSON su stdout: livello, frazione di righe DEBUG tenute, PII
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_CAMPIONAMENTO_DEBUG = float(os.getenv('LOG_CAMPIONAMENTO_DEBUG', '0.01'))
+LOG_MASCHERA_NUMERI = os.getenv('LOG_MASCHERA_NUMERI', '1') != '0'
+LOG_CODA_MAX = 10000  # record in attesa di scrittura
+
+# ==================== LOG ====================
+
+# Campi di correlazione della richiesta in corso (MessageSid, cliente...)
+contesto_log = contextvars.ContextVar('contesto_log', default=None)
+
+# Numeri di telefono: restano visibili solo le ultime 3 cifre
+_NUMERO_TELEFONO = re.compile(r'\+?\d[\d ]{6,}(\d{3})\b')
+
+
+def maschera_numeri(testo):
+    """Oscura i numeri di telefono in un testo (PII)"""
+    return _NUMERO_TELEFONO.sub(r'***\1', testo)
+
+
+def campi(**valori):
+    """Campi strutturati per una riga di log: log.info('...', extra=campi(...))"""
+    return {'campi': valori}
+
+
+class FormatterJSON(logging.Formatter):
+    """Una riga JSON per record, con contesto e campi, numeri mascherati"""
+
+    def format(self, record):
+        riga = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(
+                timespec='milliseconds'),
+            'livello': record.levelname,
+            'logger': record.name,
+            'messaggio': record.getMessage(),
+        }
+        if record.__dict__.get('contesto'):
+            riga.update(record.contesto)
+        if record.__dict__.get('campi'):
+            riga.update(record.campi)
+        if record.exc_info:
+            riga['eccezione'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            riga['eccezione'] = record.exc_text
+        testo = json.dumps(riga, ensure_ascii=False, default=str)
+        return maschera_numeri(testo) if LOG_MASCHERA_NUMERI else testo
+
+
+class GestoreCodaLog(logging.handlers.QueueHandler):
+    """QueueHandler non bloccante: il thread della richiesta aggiunge solo il
+    contesto e accoda; formattazione JSON e scrittura su stdout avvengono
+    nel thread del listener. Oltre `massimo` record in attesa il record
+    viene scartato (e contato) invece di rallentare la richiesta.
+    """
+
+    def __init__(self, gestore_finale, massimo=LOG_CODA_MAX):
+        # SimpleQueue è in C e senza lock Python: il limite si controlla
+        # con qsize(), approssimato ma sufficiente
+        super().__init__(queue.SimpleQueue())
+        self.gestore_finale = gestore_finale
+        self.massimo = massimo
+        self.scartati = 0
+        self._listener = None
+        self._pid = None
+        atexit.register(self.ferma)
+
+    def avvia(self):
+        """Avvia il listener (anche nei worker figli dopo un fork: la coda
+        e il thread del padre non servono più; e dopo ferma)"""
+        if self._pid == os.getpid():
+            return
+        self.queue = queue.SimpleQueue()
+        self._pid = os.getpid()
+        self._listener = logging.handlers.QueueListener(
+            self.queue, self.gestore_finale, respect_handler_level=True)
+        self._listener.start()
+
+    def ferma(self):
+        """Scrive i record ancora in coda e ferma il listener; il primo
+        record successivo lo riavvia"""
+        if self._listener and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def prepare(self, record):
+        # Niente formattazione qui: basta fissare messaggio e contesto
+        record.msg = record.getMessage()
+        record.args = None
+        record.contesto = contesto_log.get()
+        if record.exc_info:
+            # Il traceback non sopravvive alla coda: si formatta subito
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self.avvia()
+        if self.queue.qsize() >= self.massimo:
+            self.scartati += 1
+        else:
+            self.queue.put(record)
+
+
+def configura_log():
+    """Logger 'officina': JSON su stdout tramite coda e thread dedicato"""
+    finale = logging.StreamHandler(sys.stdout)
+    finale.setFormatter(FormatterJSON())
+    gestore = GestoreCodaLog(finale)
+
+    logger = logging.getLogger('officina')
+    logger.setLevel(LOG_LEVEL)
+    logger.handlers[:] = [gestore]
+    logger.propagate = False
+    gestore.avvia()
+    return logger
+
+
+log = configura_log()
+
+
+def debug_campionato(messaggio, **valori):
+    """Righe DEBUG ad alto volume (una per messaggio): ne tiene solo una
+    frazione, decidendo prima di costruire il record"""
+    if (log.isEnabledFor(logging.DEBUG)
+            and random.random() < LOG_CAMPIONAMENTO_DEBUG):
+        log.debug(messaggio, extra=campi(**valori))
+
+# ==================== CLIENT TWILIO ====================
+
+TWILIO_CONFIGURATO = bool(TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN)
+if not TWILIO_CONFIGURATO:
+    log.warning(
+        "Credenziali Twilio non configurate: il bot non potrà inviare messaggi")
+
+_twilio_client = None
+_lock_twilio = threading.Lock()
+
+
+def client_twilio():
+    """Client Twilio condiviso, creato al primo invio (None senza
+    credenziali)"""
+    global _twilio_client
+    if _twilio_client is None and TWILIO_CONFIGURATO:
+        with _lock_twilio:
+            if _twilio_client is None:
+                from twilio.http.http_client import TwilioHttpClient
+                from twilio.rest import Client
+                client = Client(
+                    TWILIO_ACCOUNT_SID,
+                    TWILIO_AUTH_TOKEN,
+                    http_client=TwilioHttpClient(timeout=HTTP_TIMEOUT))
+                if TWILIO_API_URL:
+                    client.api.base_url = TWILIO_API_URL
+                _twilio_client = client
+                log.info("Twilio client creato")
+    return _twilio_client
+
+
+# ==================== METRICHE ====================
+
+# Limiti superiori (secondi) dei bucket degli istogrammi di latenza
+BUCKET_LATENZA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metriche:
+    """Contatori e istogrammi in formato Prometheus a basso overhead.
+
+    Ogni thread scrive solo nei propri dizionari (nessun lock sul percorso
+    caldo); la lettura somma i dizionari di tutti i thread. Quelli dei
+    thread terminati vengono sommati in una base comune, così un server
+    con un thread per richiesta non accumula dizionari. Per vedere
+    l'intero servizio con più worker gunicorn, ogni worker pubblica
+    periodicamente la propria istantanea nel database e /metrics le somma.
+    """
+
+    INTERVALLO_PUBBLICAZIONE = 5  # secondi
+    SCADENZA_ISTANTANEA = 60  # secondi dopo cui un worker è considerato morto
+
+    SQL_PUBBLICA = '''
+        INSERT INTO metriche_worker (pid, dati, aggiornato) VALUES (?, ?, ?)
+        ON CONFLICT (pid) DO UPDATE
+        SET dati = excluded.dati, aggiornato = excluded.aggiornato
+    '''
+
+    SQL_ALTRI_WORKER = '''
+        SELECT dati FROM metriche_worker WHERE pid != ? AND aggiornato >= ?
+    '''
+
+    SQL_PULISCI = 'DELETE FROM metriche_worker WHERE aggiornato < ?'
 
     def __init__(self):
+        self.descrizioni = {}  # nome -> (tipo, testo)
+        self._gauge = []  # (nome, funzione)
+        self._locale = threading.local()
+        self._shard = []  # (thread, (contatori, istogrammi))
+        self._base = ({}, {})  # shard dei thread terminati
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self.database = None
+        self._pid_pubblicazione = None
+
+    def descrivi(self, nome, tipo, testo):
+        self.descrizioni[nome] = (tipo, testo)
+
+    def registra_gauge(self, nome, testo, funzione):
+        """Gauge calcolato alla lettura: funzione() ritorna un numero o un
+        dizionario {etichette: valore}"""
+        self.descrivi(nome, 'gauge', testo)
+        self._gauge.append((nome, funzione))
+
+    def _mio_shard(self):
+        shard = getattr(self._locale, 'shard', None)
+        if shard is None or self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # Dopo un fork i contatori del padre non ci riguardano
+                    self._shard = []
+                    self._base = ({}, {})
+                    self._pid = os.getpid()
+                self._raccogli_terminati()
+                shard = self._locale.shard = ({}, {})
+                self._shard.append((threading.current_thread(), shard))
+        return shard
+
+    def _raccogli_terminati(self):
+        """Somma nella base gli shard dei thread terminati (con il lock)"""
+        vivi = []
+        for thread, shard in self._shard:
+            if thread.is_alive():
+                vivi.append((thread, shard))
+            else:
+                self._somma(self._base, shard)
+        self._shard = vivi
+
+    @staticmethod
+    def _somma(destinazione, shard):
+        contatori, istogrammi = destinazione
+        shard_contatori, shard_istogrammi = shard
+        for chiave, valore in shard_contatori.copy().items():
+            contatori[chiave] = contatori.get(chiave, 0) + valore
+        for chiave, valori in shard_istogrammi.copy().items():
+            somma = istogrammi.setdefault(chiave, [0] * len(valori))
+            for i, valore in enumerate(valori):
+                somma[i] += valore
+
+    def incrementa(self, nome, etichette=(), valore=1):
+        contatori = self._mio_shard()[0]
+        chiave = (nome, etichette)
+        contatori[chiave] = contatori.get(chiave, 0) + valore
+
+    def osserva(self, nome, secondi, etichette=()):
+        istogrammi = self._mio_shard()[1]
+        chiave = (nome, etichette)
+        valori = istogrammi.get(chiave)
+        if valori is None:
+            # un contatore per bucket, +Inf, poi la somma dei valori
+            valori = istogrammi[chiave] = [0] * (len(BUCKET_LATENZA) + 1) + [0.0]
+        valori[bisect.bisect_left(BUCKET_LATENZA, secondi)] += 1
+        valori[-1] += secondi
+
+    # ---------- Aggregazione ----------
+
+    def istantanea(self):
+        """Somma degli shard di questo processo"""
+        totale = ({}, {})
+        # Con il lock: uno shard spostato nella base non va contato due
+        # volte (un contatore che scende sembra un riavvio a Prometheus)
+        with self._lock:
+            if self._pid != os.getpid():
+                return totale
+            self._raccogli_terminati()
+            self._somma(totale, self._base)
+            for _, shard in self._shard:
+                self._somma(totale, shard)
+        return totale
+
+    def collega(self, database):
+        """Abilita la pubblicazione delle istantanee tra i worker"""
+        self.database = database
+        with database.connessione() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS metriche_worker (
+                    pid INTEGER PRIMARY KEY,
+                    dati TEXT NOT NULL,
+                    aggiornato REAL NOT NULL
+                )
+            ''')
+
+    def avvia(self):
+        """Avvia la pubblicazione periodica (una volta per processo)"""
+        if self.database is None or self._pid_pubblicazione == os.getpid():
+            return
+        with self._lock:
+            if self._pid_pubblicazione != os.getpid():
+                self._pid_pubblicazione = os.getpid()
+                threading.Thread(target=self._ciclo_pubblicazione,
+                                 name='metriche',
+                                 daemon=True).start()
+
+    def _ciclo_pubblicazione(self):
+        while True:
+            time.sleep(self.INTERVALLO_PUBBLICAZIONE)
+            try:
+                self.pubblica()
+            except Exception:
+                log.exception("Errore pubblicazione metriche")
+
+    def pubblica(self):
+        contatori, istogrammi = self.istantanea()
+        dati = json.dumps({
+            'contatori': [[n, e, v] for (n, e), v in contatori.items()],
+            'istogrammi': [[n, e, v] for (n, e), v in istogrammi.items()]
+        })
+        adesso = time.time()
+        self.database._scrivi(self.SQL_PUBBLICA, (os.getpid(), dati, adesso))
+        self.database._scrivi(self.SQL_PULISCI,
+                              (adesso - self.SCADENZA_ISTANTANEA, ))
+
+    def totale(self):
+        """Istantanea di questo processo sommata a quelle degli altri worker"""
+        contatori, istogrammi = self.istantanea()
+        if self.database is None:
+            return contatori, istogrammi
+        for (dati, ) in self.database._leggi(
+                self.SQL_ALTRI_WORKER,
+            (os.getpid(), time.time() - self.SCADENZA_ISTANTANEA)):
+            dati = json.loads(dati)
+            for nome, etichette, valore in dati['contatori']:
+                chiave = (nome, tuple(map(tuple, etichette)))
+                contatori[chiave] = contatori.get(chiave, 0) + valore
+            for nome, etichette, valori in dati['istogrammi']:
+                chiave = (nome, tuple(map(tuple, etichette)))
+                somma = istogrammi.setdefault(chiave, [0] * len(valori))
+                for i, valore in enumerate(valori):
+                    somma[i] += valore
+        return contatori, istogrammi
+
+    # ---------- Esportazione ----------
+
+    def esporta(self):
+        """Testo nel formato di esposizione Prometheus"""
+        contatori, istogrammi = self.totale()
+        serie = {}  # nome -> righe
+
+        for (nome, etichette), valore in sorted(contatori.items()):
+            serie.setdefault(nome, []).append(
+                f"{nome}{_etichette(etichette)} {valore}")
+
+        for (nome, etichette), valori in sorted(istogrammi.items()):
+            righe = serie.setdefault(nome, [])
+            cumulato = 0
+            for limite, conteggio in zip(BUCKET_LATENZA + ('+Inf', ),
+                                         valori[:-1]):
+                cumulato += conteggio
+                righe.append(f"{nome}_bucket"
+                             f"{_etichette(etichette + (('le', limite), ))} "
+                             f"{cumulato}")
+            righe.append(f"{nome}_sum{_etichette(etichette)} {valori[-1]}")
+            righe.append(f"{nome}_count{_etichette(etichette)} {cumulato}")
+
+        for nome, funzione in self._gauge:
+            try:
+                valore = funzione()
+            except Exception:
+                log.exception("Errore gauge", extra=campi(gauge=nome))
+                continue
+            if not isinstance(valore, dict):
+                valore = {(): valore}
+            serie[nome] = [
+                f"{nome}{_etichette(etichette)} {v}"
+                for etichette, v in valore.items()
+            ]
+
+        righe = []
+        for nome, righe_serie in serie.items():
+            tipo, testo = self.descrizioni.get(nome, ('untyped', nome))
+            righe.append(f"# HELP {nome} {testo}")
+            righe.append(f"# TYPE {nome} {tipo}")
+            righe.extend(righe_serie)
+        return "\n".join(righe) + "\n"
+
+
+def _etichette(etichette):
+    """Etichette nel formato {chiave="valore",...} (vuoto se non ce ne sono)"""
+    if not etichette:
+        return ''
+    coppie = []
+    for chiave, valore in etichette:
+        valore = str(valore).replace('\\', '\\\\').replace('"', '\\"')
+        coppie.append(f'{chiave}="{valore}"')
+    return '{' + ','.join(coppie) + '}'
+
+
+_ETICHETTE_SQL = {}
+# Le query costanti sono poche decine; quelle composte (proiezioni con
+# ?campi=) possono essere infinite: oltre il limite non si tiene la cache
+_ETICHETTE_SQL_MAX = 1000
+
+
+def etichetta_sql(sql):
+    """Etichetta breve di una query (es: 'select_richieste'), in cache.
+
+    L'etichetta dipende solo da operazione e tabella: il numero di serie
+    Prometheus resta limitato qualunque sia il testo della query.
+    """
+    etichetta = _ETICHETTE_SQL.get(sql)
+    if etichetta is None:
+        operazione = sql.split(None, 1)[0].lower()
+        tabella = re.search(r'\b(?:INTO|FROM|UPDATE)\s+(\w+)', sql, re.I)
+        etichetta = f"{operazione}_{tabella.group(1) if tabella else 'altro'}"
+        if len(_ETICHETTE_SQL) < _ETICHETTE_SQL_MAX:
+            _ETICHETTE_SQL[sql] = etichetta
+    return etichetta
+
+
+metriche = Metriche()
+metriche.descrivi('http_richieste_totale', 'counter',
+                  'Richieste HTTP per route, metodo e codice di stato')
+metriche.descrivi('http_durata_secondi', 'histogram',
+                  'Durata delle richieste HTTP per route')
+metriche.descrivi('bot_messaggio_durata_secondi', 'histogram',
+                  'Tempo speso in BotOfficina.gestisci_messaggio')
+metriche.descrivi('db_query_durata_secondi', 'histogram',
+                  'Durata delle query SQLite per operazione e tabella')
+metriche.descrivi('twilio_invio_durata_secondi', 'histogram',
+                  'Durata degli invii WhatsApp tramite Twilio')
+metriche.descrivi('fcm_invio_durata_secondi', 'histogram',
+                  'Durata degli invii di notifiche push FCM')
+metriche.descrivi('outbox_invii_totale', 'counter',
+                  'Invii elaborati dalla coda per tipo ed esito')
+metriche.descrivi('campagne_invii_totale', 'counter',
+                  'Messaggi delle campagne per officina ed esito')
+metriche.descrivi('archivio_richieste_totale', 'counter',
+                  'Richieste completate spostate negli archivi mensili')
+metriche.descrivi('cache_risposte_totale', 'counter',
+                  'Letture dell\'app del titolare per route ed esito della '
+                  'cache (non_modificata, hit, miss)')
+
+
+class DatabaseRichieste:
+    """Accesso al database SQLite delle richieste.
+
+    Ogni thread riusa una propria connessione a lunga vita (journal WAL,
+    busy timeout e cache degli statement preparati), quindi i metodi non
+    aprono più una connessione per ogni query. Lo schema viene creato una
+    sola volta per processo, alla prima istanza.
+    """
+
+    # Percorsi dei database con schema già inizializzato in questo processo
+    _schemi_pronti = set()
+    _lock_schema = threading.Lock()
+
+    # Statement SQL: sempre le stesse stringhe, così restano nella cache
+    # degli statement preparati di ogni connessione
+
+    SQL_INSERISCI = '''
+        INSERT INTO richieste
+        (numero_cliente, auto, problema, problema_cod, urgenza,
+         spie_comportamenti, preferenza_orario, tipo_intervento,
+         diagnosi_controllo, categoria, data_richiesta, stato)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+    SQL_LEGGI_TUTTE = '''
+        SELECT id, numero_cliente, auto, problema, urgenza,
+               spie_comportamenti, preferenza_orario, tipo_intervento,
+               diagnosi_controllo, categoria, data_richiesta, stato
+        FROM richieste
+        ORDER BY data_richiesta DESC
+    '''
+
+    SQL_LEGGI_NUOVE = '''
+        SELECT id, numero_cliente, auto, problema, urgenza,
+               spie_comportamenti, preferenza_orario, tipo_intervento,
+               diagnosi_controllo, categoria, data_richiesta, stato
+        FROM richieste
+        WHERE stato = 'nuova'
+        ORDER BY data_richiesta DESC
+    '''
+
+    SQL_AGGIORNA_STATO = 'UPDATE richieste SET stato = ? WHERE id = ?'
+
+    SQL_ELIMINA = 'DELETE FROM richieste WHERE id = ?'
+
+    SQL_CONTA_NUOVE = "SELECT COUNT(*) FROM richieste WHERE stato = 'nuova'"
+
+    SQL_CONTA_TUTTE = 'SELECT COUNT(*) FROM richieste'
+
+    # Import di dati storici: data e stato vengono dal file
+    SQL_IMPORTA = '''
+        INSERT INTO richieste
+        (numero_cliente, auto, problema, problema_cod, urgenza,
+         spie_comportamenti, preferenza_orario, tipo_intervento,
+         diagnosi_controllo, categoria, data_richiesta, stato,
+         data_completamento)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                COALESCE(?, datetime('now', 'localtime')),
+                COALESCE(?, 'nuova'), ?)
+    '''
+
+    # Colonne esposte dall'API (anche per la proiezione con ?campi=)
+    COLONNE = ('id', 'numero_cliente', 'auto', 'problema', 'problema_cod',
+               'urgenza', 'spie_comportamenti', 'preferenza_orario',
+               'tipo_intervento', 'diagnosi_controllo', 'categoria',
+               'data_richiesta', 'stato', 'data_completamento')
+
+    # Colonne di SQL_IMPORTA, nell'ordine dei parametri (l'id è nuovo)
+    COLONNE_IMPORTA = COLONNE[1:]
+
+    def __init__(self, db_path=None):
         # Il database sarà salvato nella stessa cartella del progetto
-        self.db_path = 'richieste_officina.db'
-        self.crea_tabella()
+        self.db_path = db_path or DB_PATH
+        self._locale = threading.local()
+        self._osservatori = []
+        self.buffer = BufferRichieste(self)
+        self.inizializza_schema()
 
-    def crea_tabella(self):
-        """Crea la tabella se non esiste"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS richieste (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                numero_cliente TEXT NOT NULL,
-                auto TEXT,
-                problema TEXT,
-                problema_cod TEXT,
-                urgenza TEXT,
-                spie_comportamenti TEXT,
-                preferenza_orario TEXT,
-                tipo_intervento TEXT,
-                diagnosi_controllo TEXT,
-                categoria TEXT,
-                data_richiesta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                stato TEXT DEFAULT 'nuova'
-            )
-        ''')
-        conn.commit()
-        conn.close()
+    def al_cambiamento(self, funzione):
+        """Registra una funzione chiamata dopo ogni modifica alle richieste
+        fatta da questo processo"""
+        self._osservatori.append(funzione)
+
+    def _notifica_cambiamento(self):
+        for funzione in self._osservatori:
+            funzione()
+
+    # ---------- Connessioni ----------
+
+    def _apri_connessione(self):
+        """Apre una connessione configurata per l'uso concorrente"""
+        conn = sqlite3.connect(self.db_path,
+                               timeout=DB_BUSY_TIMEOUT,
+                               cached_statements=DB_CACHE_STATEMENT,
+                               check_same_thread=False)
+        conn.execute('PRAGMA synchronous = NORMAL')
+        return conn
+
+    def connessione(self):
+        """Ritorna la connessione del thread corrente, creandola al primo uso.
+
+        Il pid viene controllato per non riusare connessioni ereditate da un
+        fork (es: gunicorn --preload).
+        """
+        locale = self._locale
+        conn = getattr(locale, 'conn', None)
+        if conn is None or locale.pid != os.getpid():
+            conn = self._apri_connessione()
+            locale.conn = conn
+            locale.pid = os.getpid()
+        return conn
 
-    def salva_richiesta(self, numero_cliente, dati, categoria):
-        """Salva una nuova richiesta nel database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def chiudi(self):
+        """Chiude la connessione del thread corrente (se aperta)"""
+        conn = getattr(self._locale, 'conn', None)
+        if conn is not None:
+            if self._locale.pid == os.getpid():
+                conn.close()
+            self._locale.conn = None
 
+    def _scrivi(self, sql, parametri=()):
+        """Esegue uno statement di scrittura nella sua transazione"""
+        conn = self.connessione()
+        inizio = time.perf_counter()
         try:
-            cursor.execute(
-                '''
-                INSERT INTO richieste 
-                (numero_cliente, auto, problema, problema_cod, urgenza, 
-                 spie_comportamenti, preferenza_orario, tipo_intervento, 
-                 diagnosi_controllo, categoria, data_richiesta, stato)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (numero_cliente, dati.get('auto'), dati.get('problema'),
-                  dati.get('problema_cod'), dati.get('urgenza'),
-                  dati.get('spie_comportamenti'),
-                  dati.get('preferenza_orario'), dati.get('tipo_intervento'),
-                  dati.get('diagnosi_controllo'), categoria,
-                  datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'nuova'))
-            conn.commit()
-            print(f"✅ Richiesta salvata per {numero_cliente}")
-        except Exception as e:
-            print(f"❌ Errore salvataggio: {e}")
+            with conn:
+                return conn.execute(sql, parametri)
+        finally:
+            metriche.osserva('db_query_durata_secondi',
+                             time.perf_counter() - inizio,
+                             (('query', etichetta_sql(sql)), ))
+
+    def _leggi(self, sql, parametri=()):
+        """Esegue una query di lettura e ritorna tutte le righe"""
+        inizio = time.perf_counter()
+        try:
+            return self.connessione().execute(sql, parametri).fetchall()
+        finally:
+            metriche.osserva('db_query_durata_secondi',
+                             time.perf_counter() - inizio,
+                             (('query', etichetta_sql(sql)), ))
+
+    # ---------- Schema ----------
+
+    def inizializza_schema(self):
+        """Crea lo schema una sola volta per processo e per file"""
+        chiave = os.path.abspath(self.db_path)
+        if chiave in DatabaseRichieste._schemi_pronti:
+            return
+        with DatabaseRichieste._lock_schema:
+            if chiave not in DatabaseRichieste._schemi_pronti:
+                self.crea_tabella()
+                DatabaseRichieste._schemi_pronti.add(chiave)
+
+    def crea_tabella(self):
+        """Crea la tabella se non esiste e attiva il journal WAL"""
+        # Connessione dedicata: non resta aperta nel processo che crea lo schema
+        conn = self._apri_connessione()
+        try:
+            # Solo per i file nuovi (poi serve un VACUUM): lo spazio delle
+            # righe archiviate torna al filesystem (ArchivioRichieste)
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('PRAGMA journal_mode = WAL')
+            with conn:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS richieste (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        numero_cliente TEXT NOT NULL,
+                        auto TEXT,
+                        problema TEXT,
+                        problema_cod TEXT,
+                        urgenza TEXT,
+                        spie_comportamenti TEXT,
+                        preferenza_orario TEXT,
+                        tipo_intervento TEXT,
+                        diagnosi_controllo TEXT,
+                        categoria TEXT,
+                        data_richiesta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        stato TEXT DEFAULT 'nuova'
+                    )
+                ''')
+                # Impostata dal trigger del passaggio a 'completata'
+                self.aggiungi_colonna(conn, 'richieste', 'data_completamento',
+                                      'TIMESTAMP')
+                # Indici per filtri e ordinamento dell'API (id incluso via rowid)
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_richieste_data
+                    ON richieste (data_richiesta)
+                ''')
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_richieste_stato_data
+                    ON richieste (stato, data_richiesta)
+                ''')
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_richieste_categoria_data
+                    ON richieste (categoria, data_richiesta)
+                ''')
+                # Storico del cliente che torna (StoricoClienti)
+                conn.execute('''
+                    CREATE INDEX IF NOT EXISTS idx_richieste_cliente_data
+                    ON richieste (numero_cliente, data_richiesta)
+                ''')
         finally:
             conn.close()
 
+    # ---------- Operazioni ----------
+
+    def salva_richiesta(self, numero_cliente, dati, categoria, attendi=True):
+        """Salva una nuova richiesta nel database e ritorna il suo id.
+
+        La scrittura passa dal buffer (BufferRichieste): con attendi=False
+        ritorna subito None e la riga viene scritta entro pochi millisecondi
+        insieme alle altre.
+        """
+        return self.buffer.aggiungi(
+            numero_cliente,
+            (numero_cliente, dati.get('auto'), dati.get('problema'),
+             dati.get('problema_cod'), dati.get('urgenza'),
+             dati.get('spie_comportamenti'), dati.get('preferenza_orario'),
+             dati.get('tipo_intervento'), dati.get('diagnosi_controllo'),
+             categoria, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+             'nuova'), attendi)
+
     def leggi_tutte_richieste(self):
         """Legge tutte le richieste dal database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, numero_cliente, auto, problema, urgenza, 
-                   spie_comportamenti, preferenza_orario, tipo_intervento,
-                   diagnosi_controllo, categoria, data_richiesta, stato
-            FROM richieste 
-            ORDER BY data_richiesta DESC
-        ''')
-        richieste = cursor.fetchall()
-        conn.close()
-        return richieste
+        return self._leggi(self.SQL_LEGGI_TUTTE)
 
     def leggi_richieste_nuove(self):
         """Legge solo le richieste con stato 'nuova'"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, numero_cliente, auto, problema, urgenza,
-                   spie_comportamenti, preferenza_orario, tipo_intervento,
-                   diagnosi_controllo, categoria, data_richiesta, stato
-            FROM richieste 
-            WHERE stato = 'nuova'
-            ORDER BY data_richiesta DESC
-        ''')
-        richieste = cursor.fetchall()
-        conn.close()
-        return richieste
+        return self._leggi(self.SQL_LEGGI_NUOVE)
 
     def aggiorna_stato(self, id_richiesta, nuovo_stato):
         """Aggiorna lo stato di una richiesta (es: 'nuova' -> 'lavorata' -> 'completata')"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute(
-            '''
-            UPDATE richieste 
-            SET stato = ? 
-            WHERE id = ?
-        ''', (nuovo_stato, id_richiesta))
-        conn.commit()
-        conn.close()
+        self._scrivi(self.SQL_AGGIORNA_STATO, (nuovo_stato, id_richiesta))
+        self._notifica_cambiamento()
 
     def elimina_richiesta(self, id_richiesta):
         """Elimina una richiesta dal database"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM richieste WHERE id = ?', (id_richiesta, ))
-        conn.commit()
-        conn.close()
+        self._scrivi(self.SQL_ELIMINA, (id_richiesta, ))
+        self._notifica_cambiamento()
+
+    @staticmethod
+    def aggiungi_colonna(conn, tabella, colonna, definizione):
+        """Aggiunge una colonna a una tabella esistente se ancora manca;
+        ritorna True se l'ha aggiunta"""
+        esistenti = {
+            riga[1]
+            for riga in conn.execute(f'PRAGMA table_info({tabella})')
+        }
+        if colonna in esistenti:
+            return False
+        conn.execute(
+            f'ALTER TABLE {tabella} ADD COLUMN {colonna} {definizione}')
+        return True
 
     def conta_richieste_nuove(self):
         """Conta quante richieste nuove ci sono"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM richieste WHERE stato = "nuova"')
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count
+        return self._leggi(self.SQL_CONTA_NUOVE)[0][0]
 
+    def conta_richieste(self):
+        """Conta tutte le richieste"""
+        return self._leggi(self.SQL_CONTA_TUTTE)[0][0]
 
-# ==================== BOT WHATSAPP LOGIC ====================
+    def leggi_richiesta(self, id_richiesta, campi=COLONNE):
+        """Legge una singola richiesta come dizionario (None se non esiste)"""
+        righe = self._leggi(
+            f"SELECT {', '.join(campi)} FROM richieste WHERE id = ?",
+            (id_richiesta, ))
+        return dict(zip(campi, righe[0])) if righe else None
 
+    def cerca_richieste(self,
+                        categoria=None,
+                        stato=None,
+                        campi=COLONNE,
+                        dopo=None,
+                        since=None,
+                        limite=100):
+        """Legge una pagina di richieste, dalla più recente.
 
-class BotOfficina:
+        La paginazione è a cursore (keyset): `dopo` è la coppia
+        (data_richiesta, id) dell'ultima riga della pagina precedente, così
+        ogni pagina costa una discesa nell'indice invece di un OFFSET.
+        `since` restituisce solo le righe con id maggiore (nuove richieste).
 
-    def __init__(self):
-        self.steps = {
-            0:
-            "Ciao 👋\nSono l’assistente dell’officina.\nTi faccio 3 domande rapide per capire come aiutarti.",
-            1:
-            "🚗 Che auto hai?\n(Marca e modello)",
-            2:
-            "🔧 Che tipo di problema hai?\n\n1️⃣ Auto ferma / rumori strani\n2️⃣ Tagliando / controllo\n3️⃣ Preventivo / informazioni\n\nRispondi con 1, 2 o 3",
-            3:
-            "🚨 È urgente?\n\n1. Auto non parte\n2. Posso ancora circolare\n3. È solo un controllo\n\nRispondi con 1, 2 o 3",
-        }
+        Ritorna (righe, cursore) dove cursore è None all'ultima pagina.
+        """
+        condizioni = []
+        parametri = []
+        if categoria:
+            condizioni.append('categoria = ?')
+            parametri.append(categoria)
+        if stato:
+            condizioni.append('stato = ?')
+            parametri.append(stato)
+        if since is not None:
+            condizioni.append('id > ?')
+            parametri.append(since)
+        if dopo is not None:
+            condizioni.append('(data_richiesta, id) < (?, ?)')
+            parametri.extend(dopo)
+
+        # id e data_richiesta servono sempre per costruire il cursore
+        colonne = ['data_richiesta', 'id'] + [
+            c for c in campi if c not in ('data_richiesta', 'id')
+        ]
+        sql = f"SELECT {', '.join(colonne)} FROM richieste"
+        if since is not None:
+            # Poche righe nuove: meglio il range sull'id che l'indice per data
+            sql += ' NOT INDEXED'
+        if condizioni:
+            sql += ' WHERE ' + ' AND '.join(condizioni)
+        sql += ' ORDER BY data_richiesta DESC, id DESC LIMIT ?'
+        parametri.append(limite + 1)
+
+        righe = self._leggi(sql, parametri)
+        cursore = None
+        if len(righe) > limite:
+            righe = righe[:limite]
+            cursore = (righe[-1][0], righe[-1][1])
+
+        risultato = []
+        for riga in righe:
+            completa = dict(zip(colonne, riga))
+            risultato.append({c: completa[c] for c in campi})
+        return risultato, cursore
+
+    def esporta(self,
+                campi=COLONNE,
+                categoria=None,
+                stato=None,
+                dal=None,
+                al=None,
+                blocco=ESPORTA_BLOCCO):
+        """Genera le richieste dalla più vecchia, a blocchi di `blocco`
+        tuple (nell'ordine di `campi`); `dal` e `al` sono date AAAA-MM-GG
+        incluse.
+
+        Un solo SELECT letto con fetchmany su una connessione dedicata.
+        L'ordine (data_richiesta, id) è quello degli indici, con qualunque
+        filtro: niente ordinamento in un B-tree temporaneo, la prima riga
+        esce subito e la memoria non dipende dalla tabella. L'export è
+        un'istantanea coerente (WAL: i writer non vengono bloccati) e il
+        generatore si può consumare da thread diversi, come fa il ponte
+        ASGI. La connessione si chiude alla fine o con close().
+        """
+        condizioni = []
+        parametri = []
+        if categoria:
+            condizioni.append('categoria = ?')
+            parametri.append(categoria)
+        if stato:
+            condizioni.append('stato = ?')
+            parametri.append(stato)
+        if dal:
+            condizioni.append('data_richiesta >= ?')
+            parametri.append(dal)
+        if al:
+            condizioni.append("data_richiesta < date(?, '+1 day')")
+            parametri.append(al)
+        sql = f"SELECT {', '.join(campi)} FROM richieste"
+        if condizioni:
+            sql += ' WHERE ' + ' AND '.join(condizioni)
+        sql += ' ORDER BY data_richiesta, id'
+
+        conn = self._apri_connessione()
+        try:
+            cursore = conn.execute(sql, parametri)
+            while True:
+                righe = cursore.fetchmany(blocco)
+                if not righe:
+                    return
+                yield righe
+        finally:
+            conn.close()
+
+
+class _VoceBuffer:
+    """Richiesta in attesa di scrittura nel buffer"""
+
+    __slots__ = ('numero_cliente', 'parametri', 'scritta', 'id')
+
+    def __init__(self, numero_cliente, parametri, attendi):
+        self.numero_cliente = numero_cliente
+        self.parametri = parametri
+        self.scritta = threading.Event() if attendi else None
+        self.id = None
+
+
+class BufferRichieste:
+    """Write-behind delle nuove richieste con group commit.
+
+    Le chiusure di conversazione accodano la riga e un thread per processo
+    le scrive a lotti, una transazione per lotto: sotto carico cento INSERT
+    costano un solo commit e una sola acquisizione del lock di scrittura.
+
+    Durabilità per chiamata: con attendi=True il chiamante aspetta il commit
+    del lotto che contiene la sua riga e ne riceve l'id, e il lotto parte
+    subito. Con attendi=False ritorna immediatamente e la riga viene scritta
+    entro `attesa` secondi o appena il lotto raggiunge `dimensione` righe;
+    se il processo muore prima, quelle righe vanno perse.
+    """
+
+    def __init__(self,
+                 database,
+                 dimensione=RICHIESTE_LOTTO_MAX,
+                 attesa=RICHIESTE_LOTTO_ATTESA):
+        self.database = database
+        self.dimensione = dimensione
+        self.attesa = attesa
+        self._voci = []
+        self._subito = False
+        self._condizione = threading.Condition()
+        self._pid_scrittore = None
+        self._scrittore = None
+        self._contatori = Counter()
+
+    def _attivo(self):
+        return (self._pid_scrittore == os.getpid()
+                and self._scrittore.is_alive())
+
+    def avvia(self):
+        """Avvia il thread di scrittura (una volta per processo, di nuovo
+        se si è fermato)"""
+        if self._attivo():
+            return
+        with self._condizione:
+            if self._attivo():
+                return
+            if self._pid_scrittore is None:
+                atexit.register(self.svuota)
+            if self._pid_scrittore != os.getpid():
+                # Le voci ereditate da un fork appartengono al padre
+                self._voci = []
+            self._scrittore = threading.Thread(target=self._ciclo_scrittore,
+                                               name='buffer-richieste',
+                                               daemon=True)
+            self._scrittore.start()
+            self._pid_scrittore = os.getpid()
+
+    def aggiungi(self, numero_cliente, parametri, attendi=True):
+        """Accoda una riga di SQL_INSERISCI; ritorna l'id se attendi=True
+        (None in caso di errore), altrimenti None subito"""
+        self.avvia()
+        voce = _VoceBuffer(numero_cliente, parametri, attendi)
+        with self._condizione:
+            self._voci.append(voce)
+            if attendi:
+                self._subito = True
+            self._condizione.notify()
+        if not attendi:
+            return None
+        if voce.scritta.wait(RICHIESTE_ATTESA_MAX):
+            return voce.id
+        # Scrittore bloccato: se la riga non è ancora stata presa la si
+        # scrive qui, altrimenti la scrive lui (niente doppioni)
+        with self._condizione:
+            presa = voce not in self._voci
+            if not presa:
+                self._voci.remove(voce)
+        log.warning("Buffer richieste in ritardo",
+                    extra=campi(cliente=numero_cliente, in_scrittura=presa))
+        if not presa:
+            voce.id = self._scrivi_una(voce)
+            self._contatori['dirette'] += 1
+            self.database._notifica_cambiamento()
+        elif not voce.scritta.wait(RICHIESTE_ATTESA_MAX):
+            self._contatori['scadute'] += 1
+        return voce.id
+
+    def _ciclo_scrittore(self):
+        while True:
+            try:
+                with self._condizione:
+                    while not self._voci:
+                        self._condizione.wait()
+                    # Qualche millisecondo per raccogliere altre righe, salvo
+                    # che qualcuno stia aspettando il commit
+                    scadenza = time.monotonic() + self.attesa
+                    while (not self._subito
+                           and len(self._voci) < self.dimensione):
+                        resto = scadenza - time.monotonic()
+                        if resto <= 0:
+                            break
+                        self._condizione.wait(resto)
+                    lotto = self._voci[:self.dimensione]
+                    del self._voci[:self.dimensione]
+                    self._subito = any(v.scritta for v in self._voci)
+                self._scrivi_lotto(lotto)
+            except Exception:
+                log.exception("Errore scrittore buffer richieste")
+                time.sleep(0.1)
+
+    def svuota(self):
+        """Scrive subito le righe in attesa (uscita del processo)"""
+        if self._pid_scrittore != os.getpid():
+            return
+        with self._condizione:
+            lotto, self._voci = self._voci, []
+        if lotto:
+            self._scrivi_lotto(lotto)
+
+    def _scrivi_lotto(self, lotto):
+        inizio = time.perf_counter()
+        try:
+            try:
+                with self.database.connessione() as conn:
+                    for voce in lotto:
+                        voce.id = conn.execute(
+                            DatabaseRichieste.SQL_INSERISCI,
+                            voce.parametri).lastrowid
+            except Exception:
+                # Lotto annullato: riga per riga, così una riga non valida
+                # non fa perdere le altre
+                log.exception("Errore scrittura lotto richieste",
+                              extra=campi(righe=len(lotto)))
+                for voce in lotto:
+                    voce.id = self._scrivi_una(voce)
+            metriche.osserva('db_query_durata_secondi',
+                             time.perf_counter() - inizio,
+                             (('query', 'insert_richieste_lotto'), ))
+            self._contatori['lotti'] += 1
+            for voce in lotto:
+                self._contatori['scritte' if voce.id else 'errori'] += 1
+                log.debug("Richiesta salvata",
+                          extra=campi(cliente=voce.numero_cliente,
+                                      richiesta_id=voce.id))
+            self.database._notifica_cambiamento()
+        finally:
+            # Chi aspetta il commit non resta mai bloccato, qualunque cosa
+            # sia successa sopra
+            for voce in lotto:
+                if voce.scritta:
+                    voce.scritta.set()
+
+    def _scrivi_una(self, voce):
+        try:
+            return self.database._scrivi(DatabaseRichieste.SQL_INSERISCI,
+                                         voce.parametri).lastrowid
+        except Exception:
+            log.exception("Errore salvataggio richiesta",
+                          extra=campi(cliente=voce.numero_cliente))
+            return None
+
+    def statistiche(self):
+        """Lotti scritti, righe scritte/in errore e righe in attesa"""
+        return {**self._contatori, 'in_attesa': len(self._voci)}
+
+
+# ==================== STATO CONVERSAZIONI ====================
+
+
+class ConversazioniMemoria:
+    """Stato delle conversazioni in memoria, con limite LRU e scadenza (TTL).
+
+    Le conversazioni sono tenute in ordine di ultimo accesso, quindi quelle
+    abbandonate si trovano in testa: sia l'espulsione LRU sia la pulizia
+    delle scadute costano O(1) per conversazione rimossa. Va bene con un
+    solo worker; con più worker gunicorn usare ConversazioniSQLite.
+    """
+
+    def __init__(self, max_conversazioni, ttl):
+        self.max_conversazioni = max_conversazioni
+        self.ttl = ttl
+        self._conversazioni = OrderedDict()  # numero -> (scadenza, conv)
+        self._lock = threading.Lock()
+        self._contatori = Counter()
+
+    def leggi(self, numero_cliente):
+        """Ritorna lo stato della conversazione o None se assente/scaduta"""
+        adesso = time.time()
+        with self._lock:
+            voce = self._conversazioni.get(numero_cliente)
+            if voce is None:
+                self._contatori['miss'] += 1
+                return None
+            if voce[0] < adesso:
+                del self._conversazioni[numero_cliente]
+                self._contatori['scadute'] += 1
+                self._contatori['miss'] += 1
+                return None
+            self._conversazioni.move_to_end(numero_cliente)
+            self._contatori['hit'] += 1
+            return voce[1]
+
+    def salva(self, numero_cliente, conv, ttl=None):
+        """Salva lo stato e rinnova la scadenza della conversazione (tra
+        `ttl` secondi, se diverso da quello dell'archivio)"""
+        adesso = time.time()
+        with self._lock:
+            self._conversazioni[numero_cliente] = (adesso + (ttl or self.ttl),
+                                                   conv)
+            self._conversazioni.move_to_end(numero_cliente)
+            while len(self._conversazioni) > self.max_conversazioni:
+                self._conversazioni.popitem(last=False)
+                self._contatori['espulse'] += 1
+            self._pulisci(adesso)
+
+    def elimina(self, numero_cliente):
+        """Rimuove la conversazione (es: richiesta completata)"""
+        with self._lock:
+            self._conversazioni.pop(numero_cliente, None)
+
+    def pulisci_scadute(self):
+        """Rimuove le conversazioni abbandonate, ritorna quante"""
+        with self._lock:
+            return self._pulisci(time.time())
+
+    def _pulisci(self, adesso):
+        rimosse = 0
+        # In testa ci sono le meno recenti: ci si ferma alla prima valida
+        while self._conversazioni:
+            numero, (scadenza, _) = next(iter(self._conversazioni.items()))
+            if scadenza >= adesso:
+                break
+            del self._conversazioni[numero]
+            rimosse += 1
+        self._contatori['scadute'] += rimosse
+        return rimosse
+
+    def statistiche(self):
+        """Contatori di hit/miss/espulsioni/scadenze e hit rate"""
+        return _statistiche_conversazioni(self._contatori, len(self))
+
+    def __len__(self):
+        return len(self._conversazioni)
+
+
+class ConversazioniSQLite:
+    """Stato delle conversazioni nel database SQLite, condiviso tra i worker.
+
+    Ogni lettura/scrittura è un accesso per chiave primaria. Le scadute
+    vengono cancellate periodicamente e, oltre max_conversazioni, si
+    eliminano le meno recenti.
+    """
+
+    INTERVALLO_PULIZIA = 60  # secondi tra due pulizie
+
+    SQL_LEGGI = 'SELECT stato, scadenza FROM conversazioni WHERE numero = ?'
+
+    SQL_SALVA = '''
+        INSERT INTO conversazioni (numero, stato, scadenza)
+        VALUES (?, ?, ?)
+        ON CONFLICT (numero) DO UPDATE
+        SET stato = excluded.stato, scadenza = excluded.scadenza
+    '''
+
+    SQL_ELIMINA = 'DELETE FROM conversazioni WHERE numero = ?'
+
+    SQL_ELIMINA_SCADUTE = 'DELETE FROM conversazioni WHERE scadenza < ?'
+
+    SQL_ESPELLI = '''
+        DELETE FROM conversazioni WHERE numero IN (
+            SELECT numero FROM conversazioni
+            ORDER BY scadenza LIMIT max(0, (SELECT COUNT(*) FROM conversazioni) - ?)
+        )
+    '''
+
+    SQL_CONTA = 'SELECT COUNT(*) FROM conversazioni'
+
+    def __init__(self, database, max_conversazioni, ttl):
+        self.database = database
+        self.max_conversazioni = max_conversazioni
+        self.ttl = ttl
+        self._contatori = Counter()
+        self._prossima_pulizia = 0
+        with database.connessione() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversazioni (
+                    numero TEXT PRIMARY KEY,
+                    stato TEXT NOT NULL,
+                    scadenza REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_conversazioni_scadenza
+                ON conversazioni (scadenza)
+            ''')
+
+    def leggi(self, numero_cliente):
+        """Ritorna lo stato della conversazione o None se assente/scaduta"""
+        righe = self.database._leggi(self.SQL_LEGGI, (numero_cliente, ))
+        if not righe or righe[0][1] < time.time():
+            self._contatori['miss'] += 1
+            return None
+        self._contatori['hit'] += 1
+        return json.loads(righe[0][0])
+
+    def salva(self, numero_cliente, conv, ttl=None):
+        """Salva lo stato e rinnova la scadenza della conversazione (tra
+        `ttl` secondi, se diverso da quello dell'archivio)"""
+        adesso = time.time()
+        self.database._scrivi(
+            self.SQL_SALVA,
+            (numero_cliente, json.dumps(conv, ensure_ascii=False),
+             adesso + (ttl or self.ttl)))
+        if adesso >= self._prossima_pulizia:
+            self._prossima_pulizia = adesso + self.INTERVALLO_PULIZIA
+            self.pulisci_scadute()
+            espulse = self.database._scrivi(self.SQL_ESPELLI,
+                                            (self.max_conversazioni, ))
+            self._contatori['espulse'] += espulse.rowcount
+
+    def elimina(self, numero_cliente):
+        """Rimuove la conversazione (es: richiesta completata)"""
+        self.database._scrivi(self.SQL_ELIMINA, (numero_cliente, ))
+
+    def pulisci_scadute(self):
+        """Rimuove le conversazioni abbandonate, ritorna quante"""
+        rimosse = self.database._scrivi(self.SQL_ELIMINA_SCADUTE,
+                                        (time.time(), )).rowcount
+        self._contatori['scadute'] += rimosse
+        return rimosse
+
+    def statistiche(self):
+        """Contatori di hit/miss/espulsioni/scadenze e hit rate (per worker)"""
+        return _statistiche_conversazioni(self._contatori, len(self))
+
+    def __len__(self):
+        return self.database._leggi(self.SQL_CONTA)[0][0]
+
+
+def _statistiche_conversazioni(contatori, attive):
+    letture = contatori['hit'] + contatori['miss']
+    return {
+        'attive': attive,
+        'hit': contatori['hit'],
+        'miss': contatori['miss'],
+        'hit_rate': round(contatori['hit'] / letture, 3) if letture else None,
+        'espulse': contatori['espulse'],
+        'scadute': contatori['scadute'],
+    }
+
+
+def crea_archivio_conversazioni(database):
+    """Sceglie il backend delle conversazioni in base a CONVERSAZIONI_BACKEND"""
+    if CONVERSAZIONI_BACKEND == 'memoria':
+        return ConversazioniMemoria(CONVERSAZIONI_MAX, CONVERSAZIONI_TTL)
+    if CONVERSAZIONI_BACKEND == 'sqlite':
+        return ConversazioniSQLite(database, CONVERSAZIONI_MAX,
+                                   CONVERSAZIONI_TTL)
+    raise ValueError(
+        f"CONVERSAZIONI_BACKEND non valido: {CONVERSAZIONI_BACKEND}")
+
+
+# ==================== CODA INVII (OUTBOX) ====================
+
+
+class ErroreDefinitivo(Exception):
+    """Invio fallito in modo non recuperabile: niente altri tentativi"""
+
+
+class Rimanda(Exception):
+    """Invio da riprovare tra `attesa` secondi senza contarlo come tentativo
+    (es: limite di frequenza della destinazione)"""
+
+    def __init__(self, attesa):
+        super().__init__(f"rimandato di {attesa:.1f}s")
+        self.attesa = attesa
+
+
+class TokenBucket:
+    """Limitatore a token: `capacita` di burst, `al_secondo` di ricarica"""
+
+    def __init__(self, al_secondo, capacita):
+        self.al_secondo = al_secondo
+        self.capacita = capacita
+        self.token = capacita
+        self.ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consuma(self, n=1):
+        """Ritorna 0 se i token sono stati presi, altrimenti i secondi di
+        attesa prima che ce ne siano abbastanza"""
+        with self._lock:
+            adesso = time.monotonic()
+            self.token = min(self.capacita, self.token +
+                             (adesso - self.ultimo) * self.al_secondo)
+            self.ultimo = adesso
+            if self.token >= n:
+                self.token -= n
+                return 0
+            return (n - self.token) / self.al_secondo
+
+
+class CodaInvii:
+    """Outbox persistente per i messaggi WhatsApp e le notifiche push.
+
+    Gli handler HTTP accodano l'invio in SQLite e rispondono subito; un pool
+    di thread in background consegna i messaggi con timeout, riprova con
+    backoff esponenziale e, esauriti i tentativi, lascia l'invio in stato
+    'fallito' (dead letter) per l'ispezione da /api/invii. Ogni invio
+    ricorda l'officina che l'ha accodato: l'app di un'officina vede solo i
+    propri.
+
+    La chiave di idempotenza è unica: accodare due volte la stessa chiave
+    non produce un secondo invio. Ogni invio in corso ha un lease
+    (prossimo_tentativo), scaduto il quale un altro worker può riprenderlo.
+
+    I tipi registrati con raggruppa=True ricevono in un'unica chiamata
+    tutti gli invii in scadenza con lo stesso gruppo (es: stessa
+    destinazione FCM), fino a MAX_LOTTO.
+    """
+
+    MAX_LOTTO = 50
+
+    SQL_ACCODA = '''
+        INSERT OR IGNORE INTO outbox
+        (tipo, gruppo, chiave, officina, payload, stato, tentativi,
+         prossimo_tentativo, creato)
+        VALUES (?, ?, ?, ?, ?, 'in_attesa', 0, ?, ?)
+    '''
+
+    SQL_ID_DA_CHIAVE = 'SELECT id FROM outbox WHERE chiave = ?'
+
+    SQL_PROSSIMO = '''
+        SELECT id, tipo, gruppo, payload, tentativi FROM outbox
+        WHERE stato IN ('in_attesa', 'in_corso') AND prossimo_tentativo <= ?
+        ORDER BY prossimo_tentativo
+        LIMIT 1
+    '''
+
+    SQL_STESSO_GRUPPO = '''
+        SELECT id, tipo, gruppo, payload, tentativi FROM outbox
+        WHERE stato IN ('in_attesa', 'in_corso') AND prossimo_tentativo <= ?
+          AND tipo = ? AND gruppo = ? AND id != ?
+        ORDER BY prossimo_tentativo
+        LIMIT ?
+    '''
+
+    SQL_PRENDI = '''
+        UPDATE outbox SET stato = 'in_corso', prossimo_tentativo = ?,
+                          tentativi = tentativi + 1
+        WHERE id = ?
+    '''
+
+    SQL_ESITO = '''
+        UPDATE outbox SET stato = ?, prossimo_tentativo = ?,
+                          ultimo_errore = ?, aggiornato = ?
+        WHERE id = ?
+    '''
+
+    SQL_RIMANDA = '''
+        UPDATE outbox SET stato = 'in_attesa', prossimo_tentativo = ?,
+                          tentativi = tentativi - 1, aggiornato = ?
+        WHERE id = ?
+    '''
+
+    SQL_CONTA_PER_STATO = 'SELECT stato, COUNT(*) FROM outbox GROUP BY stato'
+
+    SQL_CONTA_OFFICINA = '''
+        SELECT stato, COUNT(*) FROM outbox WHERE officina = ? GROUP BY stato
+    '''
+
+    SQL_FALLITI = '''
+        SELECT id, tipo, chiave, payload, tentativi, ultimo_errore, aggiornato
+        FROM outbox WHERE officina = ? AND stato = 'fallito'
+        ORDER BY id DESC LIMIT ?
+    '''
+
+    SQL_LEGGI = '''
+        SELECT id, tipo, chiave, stato, tentativi, ultimo_errore
+        FROM outbox WHERE id = ? AND officina = ?
+    '''
+
+    # Invii accodati prima della colonna officina: l'officina è il secondo
+    # campo della chiave di idempotenza (es: risposta:<officina>:<id>:...)
+    SQL_OFFICINA_DA_CHIAVE = '''
+        UPDATE outbox SET officina = substr(
+            substr(chiave, instr(chiave, ':') + 1), 1,
+            instr(substr(chiave, instr(chiave, ':') + 1), ':') - 1)
+        WHERE officina IS NULL
+          AND instr(substr(chiave, instr(chiave, ':') + 1), ':') > 1
+    '''
+
+    def __init__(self, database, n_worker, max_tentativi, lease=60):
+        self.database = database
+        self.n_worker = n_worker
+        self.max_tentativi = max_tentativi
+        self.lease = lease  # secondi prima di riprendere un invio bloccato
+        self.gestori = {}
+        self._raggruppati = set()
+        self._sveglia = threading.Event()
+        self._al_risveglio = []
+        self._pid_worker = None
+        self._lock_avvio = threading.Lock()
+        with database.connessione() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tipo TEXT NOT NULL,
+                    gruppo TEXT,
+                    chiave TEXT UNIQUE,
+                    payload TEXT NOT NULL,
+                    stato TEXT NOT NULL,
+                    tentativi INTEGER NOT NULL DEFAULT 0,
+                    prossimo_tentativo REAL NOT NULL,
+                    ultimo_errore TEXT,
+                    creato REAL,
+                    aggiornato REAL
+                )
+            ''')
+            DatabaseRichieste.aggiungi_colonna(conn, 'outbox', 'gruppo',
+                                               'TEXT')
+            if DatabaseRichieste.aggiungi_colonna(conn, 'outbox',
+                                                  'officina', 'TEXT'):
+                conn.execute(self.SQL_OFFICINA_DA_CHIAVE)
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_stato_prossimo
+                ON outbox (stato, prossimo_tentativo)
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_officina
+                ON outbox (officina, stato)
+            ''')
+
+    def registra(self, tipo, gestore, raggruppa=False):
+        """Associa a un tipo di invio la funzione che lo consegna.
+
+        Con raggruppa=True il gestore riceve una lista di payload.
+        """
+        self.gestori[tipo] = gestore
+        if raggruppa:
+            self._raggruppati.add(tipo)
+
+    def al_risveglio(self, funzione):
+        """Registra una funzione chiamata quando c'è un invio da consegnare
+        (oltre a svegliare i worker: per consegne fuori da questi thread)"""
+        self._al_risveglio.append(funzione)
+
+    def risveglia(self):
+        self._sveglia.set()
+        for funzione in self._al_risveglio:
+            funzione()
+
+    def accoda(self,
+               tipo,
+               payload,
+               chiave=None,
+               ritardo=0,
+               gruppo=None,
+               officina=None):
+        """Accoda un invio e ritorna il suo id (quello esistente se la chiave
+        di idempotenza è già stata usata); `officina` è l'id di chi lo
+        accoda, per /api/invii"""
+        adesso = time.time()
+        cursore = self.database._scrivi(
+            self.SQL_ACCODA,
+            (tipo, gruppo, chiave, officina,
+             json.dumps(payload, ensure_ascii=False), adesso + ritardo,
+             adesso))
+        if cursore.rowcount:
+            id_invio = cursore.lastrowid
+        else:
+            id_invio = self.database._leggi(self.SQL_ID_DA_CHIAVE,
+                                            (chiave, ))[0][0]
+        self.avvia()
+        if ritardo:
+            # Sveglia i worker quando l'invio diventa consegnabile
+            timer = threading.Timer(ritardo, self.risveglia)
+            timer.daemon = True
+            timer.start()
+        else:
+            self.risveglia()
+        return id_invio
+
+    def avvia(self):
+        """Avvia i worker in background (una volta per processo)"""
+        if self._pid_worker == os.getpid():
+            return
+        with self._lock_avvio:
+            if self._pid_worker == os.getpid():
+                return
+            for i in range(self.n_worker):
+                threading.Thread(target=self._ciclo_worker,
+                                 name=f'outbox-{i}',
+                                 daemon=True).start()
+            self._pid_worker = os.getpid()
+
+    def _prendi(self):
+        """Prenota il prossimo invio da fare (con gli altri dello stesso
+        gruppo se il tipo è raggruppato); lista vuota se non ce ne sono"""
+        conn = self.database.connessione()
+        adesso = time.time()
+        # Controllo in sola lettura: a coda vuota non si prende il lock
+        if not conn.execute(self.SQL_PROSSIMO, (adesso, )).fetchone():
+            return []
+        # BEGIN IMMEDIATE: lettura e prenotazione atomiche tra i processi
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            righe = conn.execute(self.SQL_PROSSIMO, (adesso, )).fetchall()
+            if righe and righe[0][1] in self._raggruppati and righe[0][2]:
+                id_invio, tipo, gruppo = righe[0][:3]
+                righe += conn.execute(
+                    self.SQL_STESSO_GRUPPO,
+                    (adesso, tipo, gruppo, id_invio,
+                     self.MAX_LOTTO - 1)).fetchall()
+            for riga in righe:
+                conn.execute(self.SQL_PRENDI, (adesso + self.lease, riga[0]))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return righe
+
+    def _esito(self, id_invio, stato, prossimo=0, errore=None):
+        self.database._scrivi(self.SQL_ESITO,
+                              (stato, prossimo, errore, time.time(), id_invio))
+
+    def elabora_uno(self):
+        """Consegna un invio (o un lotto) in scadenza; ritorna False se la
+        coda è vuota"""
+        righe = self._prendi()
+        if not righe:
+            return False
+
+        tipo, payload = self.apri_lotto(righe)
+        try:
+            gestore = self.gestori.get(tipo)
+            if gestore is None:
+                raise ErroreDefinitivo(f"Nessun gestore per il tipo '{tipo}'")
+            gestore(payload)
+        except Exception as e:
+            self.registra_esito(righe, e)
+        else:
+            self.registra_esito(righe)
+        return True
+
+    def apri_lotto(self, righe):
+        """Tipo e payload da passare al gestore (lista se il tipo è
+        raggruppato) per le righe prese dalla coda"""
+        tipo = righe[0][1]
+        payloads = [json.loads(riga[3]) for riga in righe]
+        contesto_log.set({'invio_id': [riga[0] for riga in righe]
+                          if len(righe) > 1 else righe[0][0]})
+        return tipo, payloads if tipo in self._raggruppati else payloads[0]
+
+    def registra_esito(self, righe, errore=None):
+        """Salva l'esito della consegna di un lotto: inviato, rimandato
+        (Rimanda) o errore con retry/dead letter"""
+        tipo = righe[0][1]
+        if isinstance(errore, Rimanda):
+            metriche.incrementa('outbox_invii_totale',
+                                (('tipo', tipo), ('esito', 'rimandato')),
+                                len(righe))
+            for riga in righe:
+                self.database._scrivi(
+                    self.SQL_RIMANDA,
+                    (time.time() + errore.attesa, time.time(), riga[0]))
+        elif errore is not None:
+            metriche.incrementa('outbox_invii_totale',
+                                (('tipo', tipo), ('esito', 'errore')),
+                                len(righe))
+            for id_invio, _, _, _, tentativi in righe:
+                self._gestisci_errore(id_invio, tipo, tentativi + 1, errore)
+        else:
+            metriche.incrementa('outbox_invii_totale',
+                                (('tipo', tipo), ('esito', 'inviato')),
+                                len(righe))
+            for riga in righe:
+                self._esito(riga[0], 'inviato')
+
+    def _gestisci_errore(self, id_invio, tipo, tentativi, errore):
+        if isinstance(errore,
+                      ErroreDefinitivo) or tentativi >= self.max_tentativi:
+            self._esito(id_invio, 'fallito', errore=str(errore))
+            log.error("Invio fallito definitivamente",
+                      extra=campi(invio_id=id_invio,
+                                  tipo=tipo,
+                                  tentativi=tentativi,
+                                  errore=str(errore)))
+        else:
+            # Backoff esponenziale con jitter: 2s, 4s, 8s, ... max 10 minuti
+            attesa = min(2**tentativi, 600) * random.uniform(0.75, 1.25)
+            self._esito(id_invio, 'in_attesa', time.time() + attesa,
+                        str(errore))
+            log.warning("Invio da riprovare",
+                        extra=campi(invio_id=id_invio,
+                                    tipo=tipo,
+                                    tentativi=tentativi,
+                                    attesa_s=round(attesa, 1),
+                                    errore=str(errore)))
+
+    def _ciclo_worker(self):
+        while True:
+            try:
+                if self.elabora_uno():
+                    continue
+            except Exception:
+                log.exception("Errore worker outbox")
+            # Coda vuota: attende un nuovo invio o il prossimo retry
+            self._sveglia.wait(timeout=1)
+            self._sveglia.clear()
+
+    def conteggi(self, officina=None):
+        """Numero di invii per stato (di un'officina, o di tutte)"""
+        if officina is None:
+            return dict(self.database._leggi(self.SQL_CONTA_PER_STATO))
+        return dict(
+            self.database._leggi(self.SQL_CONTA_OFFICINA, (officina, )))
+
+    def leggi(self, id_invio, officina):
+        """Stato di un singolo invio dell'officina (None se non esiste o è
+        di un'altra)"""
+        righe = self.database._leggi(self.SQL_LEGGI, (id_invio, officina))
+        if not righe:
+            return None
+        return dict(
+            zip(('id', 'tipo', 'chiave', 'stato', 'tentativi',
+                 'ultimo_errore'), righe[0]))
+
+    def falliti(self, officina, limite=50):
+        """Ultimi invii dell'officina finiti in dead letter"""
+        colonne = ('id', 'tipo', 'chiave', 'payload', 'tentativi',
+                   'ultimo_errore', 'aggiornato')
+        falliti = []
+        for riga in self.database._leggi(self.SQL_FALLITI,
+                                         (officina, limite)):
+            invio = dict(zip(colonne, riga))
+            invio['payload'] = json.loads(invio['payload'])
+            falliti.append(invio)
+        return falliti
+
+
+def invia_whatsapp(payload):
+    """Gestore outbox: consegna un messaggio WhatsApp tramite Twilio"""
+    twilio_client = client_twilio()
+    if not TWILIO_CONFIGURATO:
+        raise ErroreDefinitivo('Twilio non configurato')
+    from twilio.base.exceptions import TwilioRestException
+    inizio = time.perf_counter()
+    try:
+        # Il mittente è il numero dell'officina (assente negli invii
+        # accodati prima del multi-officina)
+        message = twilio_client.messages.create(
+            from_=payload.get('from') or TWILIO_WHATSAPP_NUMBER,
+            body=payload['body'],
+            to=payload['to'])
+    except TwilioRestException as e:
+        raise errore_twilio(e) from e
+    finally:
+        metriche.osserva('twilio_invio_durata_secondi',
+                         time.perf_counter() - inizio)
+    log.info("WhatsApp inviato",
+             extra=campi(cliente=payload['to'], message_sid=message.sid))
+    return message.sid
+
+
+def errore_twilio(e):
+    """Eccezione da sollevare per un errore Twilio: i 4xx (numero errato,
+    messaggio rifiutato...) sono definitivi, riprovare non serve"""
+    if 400 <= e.status < 500 and e.status != 429:
+        return ErroreDefinitivo(str(e))
+    return e
+
+
+class NotificatorePush:
+    """Invio delle notifiche FCM su una sessione HTTP keep-alive condivisa.
+
+    Riceve dall'outbox i lotti di notifiche accodate verso la stessa
+    destinazione entro la finestra di coalescenza e, se sono più di una, le
+    unisce in un'unica notifica riepilogativa. Ogni destinazione ha un
+    proprio limite di frequenza; oltre il limite il lotto viene rimandato.
+    """
+
+    def __init__(self, url, timeout, al_secondo, burst, dimensione_pool):
+        self.url = url
+        self.timeout = timeout
+        self.al_secondo = al_secondo
+        self.burst = burst
+        self.dimensione_pool = dimensione_pool
+        self._sessione = None
+        self._limiti = {}
+        self._lock = threading.Lock()
+        self._contatori = Counter()
+        self._latenze = deque(maxlen=1000)
+
+    @property
+    def sessione(self):
+        """Sessione HTTP keep-alive, creata alla prima notifica"""
+        if self._sessione is None:
+            import requests.adapters
+            with self._lock:
+                if self._sessione is None:
+                    sessione = requests.Session()
+                    adattatore = requests.adapters.HTTPAdapter(
+                        pool_connections=1, pool_maxsize=self.dimensione_pool)
+                    sessione.mount('https://', adattatore)
+                    sessione.mount('http://', adattatore)
+                    self._sessione = sessione
+        return self._sessione
+
+    def _limite(self, destinazione):
+        with self._lock:
+            if destinazione not in self._limiti:
+                self._limiti[destinazione] = TokenBucket(
+                    self.al_secondo, self.burst)
+            return self._limiti[destinazione]
+
+    @staticmethod
+    def unisci(payloads):
+        """Combina più notifiche per la stessa destinazione in una sola"""
+        if len(payloads) == 1:
+            return payloads[0]
+        primo = payloads[0]
+        return {
+            "to": primo["to"],
+            "priority": "high",
+            "notification": {
+                "title": f"🚨 {len(payloads)} URGENZE",
+                "body": "\n".join(p["notification"]["body"]
+                                  for p in payloads),
+                "sound": "default",
+                "badge": str(len(payloads))
+            },
+            "data": {
+                "clienti": ",".join(p["data"]["cliente"] for p in payloads),
+                "categoria": primo["data"]["categoria"],
+                "officina": primo["data"].get("officina"),
+                "click_action": primo["data"]["click_action"],
+                "conteggio": str(len(payloads))
+            }
+        }
+
+    def invia(self, payloads):
+        """Gestore outbox (raggruppato): consegna un lotto di notifiche"""
+        import requests
+        payload, headers = self.prepara(payloads)
+        inizio = time.perf_counter()
+        try:
+            response = self.sessione.post(self.url,
+                                          headers=headers,
+                                          json=payload,
+                                          timeout=self.timeout)
+        except requests.RequestException:
+            self._contatori['errori'] += 1
+            raise
+        self.registra_risposta(payloads, response.status_code, response.text,
+                               time.perf_counter() - inizio)
+
+    def prepara(self, payloads):
+        """Notifica unita e header HTTP per un lotto; solleva Rimanda se la
+        destinazione ha superato il suo limite"""
+        payload = self.unisci(payloads)
+        attesa = self._limite(payload["to"]).consuma()
+        if attesa:
+            self._contatori['rimandate'] += 1
+            raise Rimanda(attesa)
+        headers = {
+            "Authorization": f"Bearer {FIREBASE_SERVER_KEY}",
+            "Content-Type": "application/json"
+        }
+        return payload, headers
+
+    def registra_risposta(self, payloads, stato_http, testo, durata):
+        """Contatori e latenze di una risposta FCM; solleva un errore
+        (definitivo per i 4xx) se la notifica non è stata accettata"""
+        self._latenze.append(durata)
+        metriche.osserva('fcm_invio_durata_secondi', durata)
+
+        if stato_http >= 400:
+            self._contatori['errori'] += 1
+            if stato_http < 500 and stato_http != 429:
+                raise ErroreDefinitivo(f"FCM ha rifiutato la notifica: "
+                                       f"{stato_http} {testo[:200]}")
+            import requests
+            raise requests.HTTPError(f"FCM ha risposto {stato_http}")
+
+        self._contatori['richieste_http'] += 1
+        self._contatori['notifiche'] += len(payloads)
+        log.info("Notifica push inviata",
+                 extra=campi(notifiche=len(payloads), stato_http=stato_http))
+
+    def statistiche(self):
+        """Contatori di invio e latenza HTTP (ms) sulle ultime 1000 chiamate"""
+        latenze = sorted(self._latenze)
+        statistiche = dict(self._contatori)
+        if latenze:
+            statistiche['latenza_ms'] = {
+                'p50': round(latenze[len(latenze) // 2] * 1000, 2),
+                'p95': round(latenze[int(len(latenze) * 0.95)] * 1000, 2),
+                'max': round(latenze[-1] * 1000, 2)
+            }
+        return statistiche
+
+
+# ==================== EVENTI RICHIESTE (CHANGE FEED) ====================
+
+
+class BusEventi:
+    """Flusso delle modifiche alle richieste per l'app del titolare.
+
+    I trigger SQLite scrivono un evento (creata/aggiornata/eliminata) nella
+    stessa transazione della modifica, qualunque worker la faccia. In ogni
+    processo un solo thread legge la coda della tabella eventi e sveglia i
+    client in attesa: cento client collegati costano una query per
+    intervallo, non cento. Gli id degli eventi sono crescenti, quindi un
+    client riprende da dove era rimasto (Last-Event-ID).
+    """
+
+    SQL_DOPO = '''
+        SELECT id, tipo, richiesta_id, stato, categoria, creato
+        FROM eventi WHERE id > ? ORDER BY id LIMIT ?
+    '''
+
+    SQL_ULTIMO = 'SELECT COALESCE(MAX(id), 0) FROM eventi'
+
+    SQL_PULISCI = 'DELETE FROM eventi WHERE id <= ?'
+
+    CAMPI = ('id', 'tipo', 'richiesta_id', 'stato', 'categoria', 'creato')
+
+    # Istante unix con millisecondi, anche su SQLite senza unixepoch()
+    _ADESSO = "(julianday('now') - 2440587.5) * 86400.0"
+
+    SQL_PULISCI_DOPO = 'DELETE FROM eventi WHERE id > ?'
+
+    SQL_RESET = f'''
+        INSERT INTO eventi (tipo, richiesta_id, creato)
+        VALUES ('reset', 0, {_ADESSO})
+    '''
+
+    def __init__(self,
+                 database,
+                 intervallo=EVENTI_INTERVALLO,
+                 memoria=EVENTI_MEMORIA,
+                 conservati=EVENTI_CONSERVATI):
+        self.database = database
+        self.intervallo = intervallo  # secondi tra due letture della tabella
+        self.conservati = conservati  # eventi tenuti per la ripresa
+        self._recenti = deque(maxlen=memoria)
+        self._ultimo_id = None
+        self._condizione = threading.Condition()
+        self._sveglia = threading.Event()
+        self._pid_lettore = None
+        self._clienti = 0
+        self._iscritti = set()
+        self._prossima_pulizia = 0
+        # Scritture di questo processo notificate / già viste dal lettore
+        self._scritture = 0
+        self._scritture_lette = 0
+        with database.connessione() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS eventi (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    tipo TEXT NOT NULL,
+                    richiesta_id INTEGER NOT NULL,
+                    stato TEXT,
+                    categoria TEXT,
+                    creato REAL NOT NULL
+                )
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS eventi_richiesta_creata
+                AFTER INSERT ON richieste BEGIN
+                    INSERT INTO eventi
+                    (tipo, richiesta_id, stato, categoria, creato)
+                    VALUES ('creata', NEW.id, NEW.stato, NEW.categoria,
+                            {self._ADESSO});
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS eventi_richiesta_aggiornata
+                AFTER UPDATE OF stato ON richieste
+                WHEN OLD.stato IS NOT NEW.stato BEGIN
+                    INSERT INTO eventi
+                    (tipo, richiesta_id, stato, categoria, creato)
+                    VALUES ('aggiornata', NEW.id, NEW.stato, NEW.categoria,
+                            {self._ADESSO});
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS eventi_richiesta_eliminata
+                AFTER DELETE ON richieste BEGIN
+                    INSERT INTO eventi
+                    (tipo, richiesta_id, stato, categoria, creato)
+                    VALUES ('eliminata', OLD.id, OLD.stato, OLD.categoria,
+                            {self._ADESSO});
+                END
+            ''')
+        # Le scritture di questo processo svegliano subito il lettore
+        database.al_cambiamento(self._cambiamento)
+
+    def _cambiamento(self):
+        self._scritture += 1
+        self._sveglia.set()
+
+    @property
+    def ultimo_id(self):
+        """Id dell'ultimo evento noto a questo processo"""
+        self.avvia()
+        return self._ultimo_id
+
+    def versione(self):
+        """Versione dei dati delle richieste per le cache delle letture:
+        l'id dell'ultimo evento, che cresce a ogni modifica.
+
+        Viene dalla memoria; dopo una scrittura di questo processo che il
+        lettore non ha ancora visto si legge dalla tabella (una discesa
+        nella chiave primaria). Le scritture degli altri processi arrivano
+        con il lettore, entro `intervallo` secondi.
+        """
+        self.avvia()
+        if self._scritture != self._scritture_lette:
+            return self.database._leggi(self.SQL_ULTIMO)[0][0]
+        return self._ultimo_id
+
+    @property
+    def clienti(self):
+        """Client in attesa di eventi in questo processo"""
+        return self._clienti
+
+    def avvia(self):
+        """Avvia il thread lettore (una volta per processo)"""
+        if self._pid_lettore == os.getpid():
+            return
+        with self._condizione:
+            if self._pid_lettore == os.getpid():
+                return
+            self._recenti.clear()
+            self._scritture_lette = self._scritture
+            self._ultimo_id = self.database._leggi(self.SQL_ULTIMO)[0][0]
+            threading.Thread(target=self._ciclo_lettore,
+                             name='eventi',
+                             daemon=True).start()
+            self._pid_lettore = os.getpid()
+
+    def _leggi_dopo(self, ultimo_id, limite):
+        righe = self.database._leggi(self.SQL_DOPO, (ultimo_id, limite))
+        return [dict(zip(self.CAMPI, riga)) for riga in righe]
+
+    def _ciclo_lettore(self):
+        """Porta in memoria i nuovi eventi e sveglia i client"""
+        while True:
+            self._sveglia.wait(self.intervallo)
+            self._sveglia.clear()
+            scritture = self._scritture
+            try:
+                nuovi = self._leggi_dopo(self._ultimo_id, 1000)
+                if nuovi:
+                    with self._condizione:
+                        self._recenti.extend(nuovi)
+                        self._ultimo_id = nuovi[-1]['id']
+                        self._condizione.notify_all()
+                        iscritti = list(self._iscritti)
+                    for funzione in iscritti:
+                        funzione()
+                if len(nuovi) == 1000:
+                    self._sveglia.set()
+                else:
+                    # Tutte le scritture notificate prima della lettura
+                    # sono ora in _ultimo_id
+                    self._scritture_lette = scritture
+                if time.time() >= self._prossima_pulizia:
+                    self._prossima_pulizia = time.time() + 600
+                    self.database._scrivi(
+                        self.SQL_PULISCI,
+                        (self._ultimo_id - self.conservati, ))
+            except Exception:
+                log.exception("Errore lettura eventi")
+                time.sleep(self.intervallo)
+
+    def iscrivi(self, funzione):
+        """Registra una funzione chiamata dal thread lettore a ogni nuovo
+        lotto di eventi (per i client asincroni: deve solo svegliarli)"""
+        with self._condizione:
+            self._iscritti.add(funzione)
+            self._clienti += 1
+
+    def disiscrivi(self, funzione):
+        with self._condizione:
+            if funzione in self._iscritti:
+                self._iscritti.discard(funzione)
+                self._clienti -= 1
+
+    def sostituisci_con_reset(self, conn, dopo_id):
+        """Dentro la transazione di una scrittura massiva (import): toglie
+        gli eventi scritti dai trigger dopo `dopo_id` e ne lascia uno solo,
+        'reset', così i client ricaricano l'elenco una volta invece di
+        ricevere un evento per riga"""
+        conn.execute(self.SQL_PULISCI_DOPO, (dopo_id, ))
+        conn.execute(self.SQL_RESET)
+
+    def _dalla_memoria(self, ultimo_visto):
+        """Eventi successivi a ultimo_visto, o None se la memoria non arriva
+        così indietro (chiamare con la condizione acquisita)"""
+        nuovi = []
+        for evento in reversed(self._recenti):
+            if evento['id'] <= ultimo_visto:
+                break
+            nuovi.append(evento)
+        else:
+            # Tutta la memoria è più nuova: serve che parta da ultimo_visto
+            if not self._recenti:
+                return [] if ultimo_visto >= self._ultimo_id else None
+            if self._recenti[0]['id'] > ultimo_visto + 1:
+                return None
+        nuovi.reverse()
+        return nuovi
+
+    def disponibili(self, ultimo_visto, limite=500):
+        """Eventi con id > ultimo_visto già in memoria, senza attendere:
+        una lista (vuota se non ce ne sono) o None se la memoria non arriva
+        così indietro e serve dalla_tabella()"""
+        with self._condizione:
+            nuovi = self._dalla_memoria(ultimo_visto)
+        return None if nuovi is None else nuovi[:limite]
+
+    def attendi(self, ultimo_visto=None, timeout=25, limite=500):
+        """Ritorna gli eventi con id > ultimo_visto, aspettando fino a
+        `timeout` secondi che ne arrivino. Senza ultimo_visto si parte
+        dall'ultimo evento attuale (solo le novità).
+
+        Se gli eventi richiesti sono già stati eliminati ritorna un solo
+        evento 'reset': il client deve ricaricare l'elenco completo.
+        """
+        self.avvia()
+        scadenza = time.monotonic() + timeout
+        with self._condizione:
+            if ultimo_visto is None or ultimo_visto > self._ultimo_id:
+                ultimo_visto = self._ultimo_id
+            self._clienti += 1
+            try:
+                while True:
+                    nuovi = self._dalla_memoria(ultimo_visto)
+                    if nuovi is None:
+                        break
+                    if nuovi:
+                        return nuovi[:limite]
+                    attesa = scadenza - time.monotonic()
+                    if attesa <= 0:
+                        return []
+                    self._condizione.wait(attesa)
+            finally:
+                self._clienti -= 1
+        return self.dalla_tabella(ultimo_visto, limite)
+
+    def dalla_tabella(self, ultimo_visto, limite=500):
+        """Ripresa più vecchia della memoria: eventi letti dalla tabella, o
+        un solo 'reset' se sono già stati eliminati"""
+        nuovi = self._leggi_dopo(ultimo_visto, limite)
+        if not nuovi or nuovi[0]['id'] > ultimo_visto + 1:
+            return [{
+                'id': self._ultimo_id,
+                'tipo': 'reset',
+                'richiesta_id': None,
+                'stato': None,
+                'categoria': None,
+                'creato': time.time()
+            }]
+        return nuovi
+
+
+# ==================== STATISTICHE (RIEPILOGHI) ====================
+
+
+class RiepiloghiRichieste:
+    """Conteggi delle richieste per giorno, categoria, stato e marca, e tempi
+    di completamento, tenuti aggiornati dai trigger SQLite.
+
+    Ogni inserimento, cambio di stato o cancellazione aggiorna le righe di
+    riepilogo nella stessa transazione, qualunque worker (o import) la
+    faccia: le statistiche costano una lettura per bucket, non una
+    scansione di richieste. Categoria, auto e data di una richiesta non
+    cambiano dopo l'inserimento. I tempi di completamento sono tenuti per
+    fasce: media esatta, mediana per fascia.
+    """
+
+    # Fasce del tempo di completamento: (limite in secondi, etichetta)
+    FASCE = ((3600, '<1h'), (4 * 3600, '1-4h'), (86400, '4-24h'),
+             (3 * 86400, '1-3g'), (7 * 86400, '3-7g'), (None, '>7g'))
+
+    # Chiavi dei bucket come espressioni SQL; {r} è NEW., OLD. o vuoto
+    _GIORNO = 'substr({r}data_richiesta, 1, 10)'
+    _CATEGORIA = "COALESCE({r}categoria, 'N/D')"
+    _STATO = "COALESCE({r}stato, 'N/D')"
+    # Marca: prima parola dell'auto in maiuscolo (es: 'Fiat Panda' -> FIAT)
+    _MARCA = ("COALESCE(NULLIF(upper(substr(trim({r}auto), 1, "
+              "instr(trim({r}auto) || ' ', ' ') - 1)), ''), 'N/D')")
+    _SECONDI = ("(julianday({r}data_completamento) - "
+                "julianday({r}data_richiesta)) * 86400.0")
+
+    SQL_PER_CATEGORIA_STATO = '''
+        SELECT categoria, stato, SUM(n) FROM riepilogo_richieste
+        WHERE giorno BETWEEN ? AND ? GROUP BY categoria, stato
+    '''
+
+    SQL_PER_GIORNO = '''
+        SELECT giorno, SUM(n) FROM riepilogo_richieste
+        WHERE giorno BETWEEN ? AND ? GROUP BY giorno ORDER BY giorno
+    '''
+
+    SQL_PER_MARCA = '''
+        SELECT marca, SUM(n) AS totale FROM riepilogo_marche
+        WHERE giorno BETWEEN ? AND ? GROUP BY marca
+        HAVING totale > 0 ORDER BY totale DESC LIMIT ?
+    '''
+
+    SQL_COMPLETAMENTO = '''
+        SELECT fascia, SUM(n), SUM(secondi) FROM riepilogo_completamento
+        WHERE giorno BETWEEN ? AND ? GROUP BY fascia
+    '''
+
+    def __init__(self, database):
+        self.database = database
+        conn = database.connessione()
+        # Creazione e ricostruzione dai dati esistenti nella stessa
+        # transazione: nessuna riga scritta nel frattempo va persa o contata
+        # due volte
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            nuovi = not conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'riepilogo_richieste'"
+            ).fetchone()
+            self._crea_tabelle(conn)
+            self._crea_trigger(conn)
+            if nuovi:
+                self._ricostruisci(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    @staticmethod
+    def _chiave(espressione, r):
+        return espressione.format(r=r)
+
+    @classmethod
+    def _fascia(cls, secondi):
+        """CASE SQL che assegna la fascia a una durata in secondi"""
+        casi = ' '.join(f"WHEN {secondi} < {limite} THEN '{etichetta}'"
+                        for limite, etichetta in cls.FASCE if limite)
+        return f"CASE {casi} ELSE '{cls.FASCE[-1][1]}' END"
+
+    @staticmethod
+    def _crea_tabelle(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS riepilogo_richieste (
+                giorno TEXT NOT NULL,
+                categoria TEXT NOT NULL,
+                stato TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (giorno, categoria, stato)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS riepilogo_marche (
+                giorno TEXT NOT NULL,
+                marca TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                PRIMARY KEY (giorno, marca)
+            ) WITHOUT ROWID
+        ''')
+        # Qui il giorno è quello del completamento
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS riepilogo_completamento (
+                giorno TEXT NOT NULL,
+                categoria TEXT NOT NULL,
+                fascia TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                secondi REAL NOT NULL,
+                PRIMARY KEY (giorno, categoria, fascia)
+            ) WITHOUT ROWID
+        ''')
+
+    def _somma(self, r, segno):
+        """Statement che aggiungono (+1) o tolgono (-1) la riga NEW./OLD.
+        nei riepiloghi di richieste e marche"""
+        giorno = self._chiave(self._GIORNO, r)
+        return f'''
+            INSERT INTO riepilogo_richieste (giorno, categoria, stato, n)
+            VALUES ({giorno}, {self._chiave(self._CATEGORIA, r)},
+                    {self._chiave(self._STATO, r)}, {segno})
+            ON CONFLICT (giorno, categoria, stato) DO UPDATE
+            SET n = n + {segno};
+            INSERT INTO riepilogo_marche (giorno, marca, n)
+            VALUES ({giorno}, {self._chiave(self._MARCA, r)}, {segno})
+            ON CONFLICT (giorno, marca) DO UPDATE SET n = n + {segno};
+        '''
+
+    def _somma_completamento(self, r, segno, origine=None):
+        """Statement che aggiunge/toglie il completamento della riga r (niente
+        se data_completamento è NULL); `origine` è la clausola FROM ... WHERE
+        quando r è una tabella"""
+        secondi = self._chiave(self._SECONDI, r)
+        return f'''
+            INSERT INTO riepilogo_completamento
+            (giorno, categoria, fascia, n, secondi)
+            SELECT substr({r}data_completamento, 1, 10),
+                   {self._chiave(self._CATEGORIA, r)},
+                   {self._fascia(secondi)}, {segno}, {segno} * {secondi}
+            {origine or 'WHERE true'}
+              AND {r}data_completamento IS NOT NULL
+            ON CONFLICT (giorno, categoria, fascia) DO UPDATE
+            SET n = n + excluded.n, secondi = secondi + excluded.secondi;
+        '''
+
+    def _crea_trigger(self, conn):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS riepilogo_richiesta_creata
+            AFTER INSERT ON richieste BEGIN
+                {self._somma('NEW.', 1)}
+                {self._somma_completamento('NEW.', 1)}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS riepilogo_richiesta_aggiornata
+            AFTER UPDATE OF stato ON richieste
+            WHEN OLD.stato IS NOT NEW.stato BEGIN
+                UPDATE riepilogo_richieste SET n = n - 1
+                WHERE giorno = {self._chiave(self._GIORNO, 'OLD.')}
+                  AND categoria = {self._chiave(self._CATEGORIA, 'OLD.')}
+                  AND stato = {self._chiave(self._STATO, 'OLD.')};
+                INSERT INTO riepilogo_richieste (giorno, categoria, stato, n)
+                VALUES ({self._chiave(self._GIORNO, 'NEW.')},
+                        {self._chiave(self._CATEGORIA, 'NEW.')},
+                        {self._chiave(self._STATO, 'NEW.')}, 1)
+                ON CONFLICT (giorno, categoria, stato) DO UPDATE
+                SET n = n + 1;
+            END
+        ''')
+        # Il momento del completamento lo segna il database, così vale per
+        # qualunque percorso che cambi lo stato
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS riepilogo_richiesta_completata
+            AFTER UPDATE OF stato ON richieste
+            WHEN NEW.stato = 'completata' AND OLD.stato IS NOT 'completata'
+            BEGIN
+                UPDATE richieste
+                SET data_completamento = datetime('now', 'localtime')
+                WHERE id = NEW.id;
+                {self._somma_completamento(
+                    'richieste.', 1, 'FROM richieste WHERE id = NEW.id')}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS riepilogo_richiesta_riaperta
+            AFTER UPDATE OF stato ON richieste
+            WHEN OLD.stato = 'completata' AND NEW.stato IS NOT 'completata'
+            BEGIN
+                {self._somma_completamento('OLD.', -1)}
+                UPDATE richieste SET data_completamento = NULL
+                WHERE id = NEW.id;
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS riepilogo_richiesta_eliminata
+            AFTER DELETE ON richieste BEGIN
+                {self._somma('OLD.', -1)}
+                {self._somma_completamento('OLD.', -1)}
+            END
+        ''')
+
+    def _ricostruisci(self, conn, dove='WHERE true', segno=1):
+        """Aggiunge ai riepiloghi (segno=-1: toglie) le richieste `dove`
+        (tutte, per riempirli dalle richieste già presenti)"""
+        giorno = self._chiave(self._GIORNO, '')
+        categoria = self._chiave(self._CATEGORIA, '')
+        secondi = self._chiave(self._SECONDI, '')
+        conn.execute(f'''
+            INSERT INTO riepilogo_richieste (giorno, categoria, stato, n)
+            SELECT {giorno}, {categoria}, {self._chiave(self._STATO, '')},
+                   {segno} * COUNT(*)
+            FROM richieste {dove} GROUP BY 1, 2, 3
+            ON CONFLICT (giorno, categoria, stato) DO UPDATE
+            SET n = n + excluded.n
+        ''')
+        conn.execute(f'''
+            INSERT INTO riepilogo_marche (giorno, marca, n)
+            SELECT {giorno}, {self._chiave(self._MARCA, '')},
+                   {segno} * COUNT(*)
+            FROM richieste {dove} GROUP BY 1, 2
+            ON CONFLICT (giorno, marca) DO UPDATE SET n = n + excluded.n
+        ''')
+        conn.execute(f'''
+            INSERT INTO riepilogo_completamento
+            (giorno, categoria, fascia, n, secondi)
+            SELECT substr(data_completamento, 1, 10), {categoria},
+                   {self._fascia(secondi)}, {segno} * COUNT(*),
+                   {segno} * SUM({secondi})
+            FROM richieste {dove} AND data_completamento IS NOT NULL
+            GROUP BY 1, 2, 3
+            ON CONFLICT (giorno, categoria, fascia) DO UPDATE
+            SET n = n + excluded.n, secondi = secondi + excluded.secondi
+        ''')
+
+    def conserva(self, conn, dove):
+        """Da chiamare nella transazione che cancella le richieste `dove`
+        per archiviarle: le riaggiunge, così il trigger di cancellazione le
+        toglie e le statistiche continuano a contarle"""
+        self._ricostruisci(conn, dove)
+
+    def gia_contate(self, conn, dove):
+        """Da chiamare nella transazione che rimette nel database le
+        richieste `dove` dall'archivio: il trigger di inserimento le ha
+        appena contate, ma i riepiloghi le contavano già (conserva)"""
+        self._ricostruisci(conn, dove, -1)
+
+    def riepilogo(self, dal=None, al=None, marche=20):
+        """Statistiche delle richieste create tra `dal` e `al` (date
+        AAAA-MM-GG incluse; i completamenti per data di completamento)"""
+        intervallo = (dal or '0000-00-00', al or '9999-12-31')
+
+        per_categoria = Counter()
+        per_stato = Counter()
+        for categoria, stato, n in self.database._leggi(
+                self.SQL_PER_CATEGORIA_STATO, intervallo):
+            per_categoria[categoria] += n
+            per_stato[stato] += n
+        totale = sum(per_categoria.values())
+
+        fasce = {etichetta: 0 for _, etichetta in self.FASCE}
+        completate = 0
+        secondi = 0.0
+        for fascia, n, somma in self.database._leggi(self.SQL_COMPLETAMENTO,
+                                                     intervallo):
+            fasce[fascia] += n
+            completate += n
+            secondi += somma
+        # Mediana: la fascia in cui si supera metà dei completamenti
+        mediana = None
+        cumulato = 0
+        for etichetta, n in fasce.items():
+            cumulato += n
+            if completate and cumulato * 2 >= completate:
+                mediana = etichetta
+                break
+
+        return {
+            'dal': dal,
+            'al': al,
+            'totale': totale,
+            'per_categoria': {c: n for c, n in per_categoria.items() if n},
+            'per_stato': {s: n for s, n in per_stato.items() if n},
+            'quota_urgenti': (round(per_categoria['URGENTE'] / totale, 4)
+                              if totale else None),
+            'per_giorno': {
+                giorno: n
+                for giorno, n in self.database._leggi(self.SQL_PER_GIORNO,
+                                                      intervallo) if n
+            },
+            # Liste e non dizionari: jsonify riordinerebbe le chiavi
+            'per_marca': [{
+                'marca': marca,
+                'richieste': n
+            } for marca, n in self.database._leggi(self.SQL_PER_MARCA,
+                                                   intervallo + (marche, ))],
+            'completamento': {
+                'completate': completate,
+                'media_ore': (round(secondi / completate / 3600, 2)
+                              if completate else None),
+                'mediana_fascia': mediana,
+                'fasce': [{
+                    'fascia': etichetta,
+                    'richieste': n
+                } for etichetta, n in fasce.items()]
+            }
+        }
+
+
+# ==================== RICERCA (FTS5) ====================
+
+
+class RicercaRichieste:
+    """Ricerca per testo libero nelle richieste con un indice FTS5.
+
+    L'indice è una tabella FTS5 a contenuto esterno: tiene solo i termini
+    (il testo resta in richieste) ed è aggiornato dai trigger nella stessa
+    transazione di ogni inserimento, modifica o cancellazione, qualunque
+    percorso la faccia. Il tokenizer unicode61 ignora maiuscole e accenti
+    (perché = perche); l'indice dei prefissi rende veloci le ricerche per
+    inizio di parola.
+    """
+
+    # Colonne di testo libero indicizzate e peso nel punteggio bm25
+    COLONNE = (('auto', 4.0), ('problema', 2.0), ('spie_comportamenti', 1.5),
+               ('tipo_intervento', 1.0), ('diagnosi_controllo', 1.0))
+
+    # Oltre questi risultati niente bm25: il punteggio richiede di contare
+    # le righe di ogni termine, e con termini così comuni distingue poco.
+    # Si restituiscono le più recenti
+    MAX_PER_PERTINENZA = 2000
+
+    # Conta fino a MAX_PER_PERTINENZA + 1, non tutte le righe trovate
+    SQL_CONTA = '''
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM richieste_fts WHERE richieste_fts MATCH ? LIMIT ?
+        )
+    '''
+
+    # Parole che non restringono la ricerca ("la spia del motore")
+    PAROLE_VUOTE = frozenset(
+        'il lo la i gli le un uno una di del dello della dei degli delle da '
+        'dal dalla dai in nel nella con su sul sulla per tra fra e ed o che '
+        'al allo alla ai mi si ho ha ma'.split())
+
+    def __init__(self, database):
+        self.database = database
+        colonne = ', '.join(nome for nome, _ in self.COLONNE)
+        nuove = ', '.join(f'NEW.{nome}' for nome, _ in self.COLONNE)
+        vecchie = ', '.join(f'OLD.{nome}' for nome, _ in self.COLONNE)
+        conn = database.connessione()
+        # Creazione e indicizzazione delle righe esistenti nella stessa
+        # transazione, come per i riepiloghi
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            nuovo = not conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'richieste_fts'"
+            ).fetchone()
+            conn.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS richieste_fts USING fts5(
+                    {colonne},
+                    content = 'richieste', content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2',
+                    prefix = '2 3'
+                )
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS ricerca_richiesta_creata
+                AFTER INSERT ON richieste BEGIN
+                    INSERT INTO richieste_fts (rowid, {colonne})
+                    VALUES (NEW.id, {nuove});
+                END
+            ''')
+            # Con il contenuto esterno si cancella ripassando i vecchi valori
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS ricerca_richiesta_modificata
+                AFTER UPDATE OF {colonne} ON richieste BEGIN
+                    INSERT INTO richieste_fts (richieste_fts, rowid, {colonne})
+                    VALUES ('delete', OLD.id, {vecchie});
+                    INSERT INTO richieste_fts (rowid, {colonne})
+                    VALUES (NEW.id, {nuove});
+                END
+            ''')
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS ricerca_richiesta_eliminata
+                AFTER DELETE ON richieste BEGIN
+                    INSERT INTO richieste_fts (richieste_fts, rowid, {colonne})
+                    VALUES ('delete', OLD.id, {vecchie});
+                END
+            ''')
+            if nuovo:
+                conn.execute('INSERT INTO richieste_fts (richieste_fts) '
+                             "VALUES ('rebuild')")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    @classmethod
+    def query_fts(cls, testo):
+        """Query FTS5 dal testo scritto dal titolare; solleva ValueError se
+        non resta nessuna parola utile.
+
+        Ogni parola diventa un termine tra virgolette (la sintassi FTS5 non
+        arriva dall'esterno) cercato per prefisso, e tutte devono esserci.
+        Ogni parola perde la vocale finale, una radice alla buona per
+        l'italiano: 'freni' trova anche freno e frenata, 'spie' trova spia,
+        'oli' trova olio. Restano almeno due lettere, la radice più corta
+        dell'indice dei prefissi.
+        """
+        termini = []
+        for parola in re.findall(r'\w+', testo.lower()):
+            if parola in cls.PAROLE_VUOTE or len(parola) < 2:
+                continue
+            if len(parola) > 2 and parola[-1] in 'aeiouàèéìòù':
+                parola = parola[:-1]
+            termini.append(f'"{parola}"*')
+        if not termini:
+            raise ValueError(f"Niente da cercare in: {testo}")
+        return ' '.join(termini)
+
+    def cerca(self,
+              testo,
+              categoria=None,
+              stato=None,
+              campi=DatabaseRichieste.COLONNE,
+              limite=20):
+        """Richieste che contengono tutte le parole di `testo`, dalla più
+        pertinente (bm25, poi la più recente) o, se sono più di
+        MAX_PER_PERTINENZA, dalla più recente. Ogni risultato ha anche il
+        `punteggio` (più alto, più pertinente; None se ordinate per data)"""
+        query = self.query_fts(testo)
+        trovate = self.database._leggi(
+            self.SQL_CONTA, (query, self.MAX_PER_PERTINENZA + 1))[0][0]
+        if trovate <= self.MAX_PER_PERTINENZA:
+            pesi = ', '.join(str(peso) for _, peso in self.COLONNE)
+            punteggio = f'-bm25(richieste_fts, {pesi})'
+            ordine = 'punteggio DESC, richieste.id DESC'
+        else:
+            # Il rowid decrescente lo dà l'indice FTS5: ci si ferma al limite
+            punteggio = 'NULL'
+            ordine = 'richieste_fts.rowid DESC'
+
+        condizioni = ['richieste_fts MATCH ?']
+        parametri = [query]
+        if categoria:
+            condizioni.append('richieste.categoria = ?')
+            parametri.append(categoria)
+        if stato:
+            condizioni.append('richieste.stato = ?')
+            parametri.append(stato)
+        parametri.append(limite)
+
+        colonne = ', '.join(f'richieste.{c}' for c in campi)
+        righe = self.database._leggi(
+            f'''
+            SELECT {colonne}, {punteggio} AS punteggio
+            FROM richieste_fts
+            JOIN richieste ON richieste.id = richieste_fts.rowid
+            WHERE {' AND '.join(condizioni)}
+            ORDER BY {ordine} LIMIT ?
+            ''', parametri)
+        risultato = []
+        for riga in righe:
+            richiesta = dict(zip(campi, riga))
+            richiesta['punteggio'] = (round(riga[-1], 3)
+                                      if riga[-1] is not None else None)
+            risultato.append(richiesta)
+        return risultato
+
+
+# ==================== ESPORTAZIONE E IMPORTAZIONE ====================
+
+# Formati di export e import, con il loro Content-Type
+FORMATI_ESPORTAZIONE = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def formato_da_file(percorso):
+    """Formato ('csv', 'ndjson' o None) e compressione gzip dedotti
+    dall'estensione di un file (es: richieste.ndjson.gz)"""
+    nome = percorso.lower()
+    compresso = nome.endswith('.gz')
+    if compresso:
+        nome = nome[:-3]
+    formato = {
+        '.csv': 'csv',
+        '.ndjson': 'ndjson',
+        '.jsonl': 'ndjson'
+    }.get(os.path.splitext(nome)[1])
+    return formato, compresso
+
+
+def righe_esportate(blocchi, campi, formato):
+    """Byte del file esportato, un pezzo per blocco di righe di
+    DatabaseRichieste.esporta: CSV con intestazione o un oggetto JSON per
+    riga"""
+    if formato == 'ndjson':
+        for righe in blocchi:
+            yield ''.join(
+                json.dumps(dict(zip(campi, riga)), ensure_ascii=False) + '\n'
+                for riga in righe).encode()
+        return
+    buffer = io.StringIO()
+    scrittore = csv.writer(buffer)
+    scrittore.writerow(campi)
+    yield buffer.getvalue().encode()
+    for righe in blocchi:
+        buffer.seek(0)
+        buffer.truncate()
+        scrittore.writerows(righe)
+        yield buffer.getvalue().encode()
+
+
+def comprimi(pezzi, livello=6):
+    """Comprime in gzip un flusso di byte, pezzo per pezzo"""
+    compressore = zlib.compressobj(livello, zlib.DEFLATED, 31)
+    for pezzo in pezzi:
+        compresso = compressore.compress(pezzo)
+        if compresso:
+            yield compresso
+    yield compressore.flush()
+
+
+def _riga_importata(valori):
+    """Tupla per SQL_IMPORTA da un record (dizionario colonna -> valore);
+    solleva ValueError se il record non è valido"""
+    riga = []
+    for colonna in DatabaseRichieste.COLONNE_IMPORTA:
+        valore = valori.get(colonna)
+        if isinstance(valore, (dict, list)):
+            raise ValueError(f"{colonna} non è un valore semplice")
+        if valore is None or valore == '':
+            valore = None
+        elif colonna in ('data_richiesta', 'data_completamento'):
+            # Stesso formato delle date scritte dall'app, per l'ordinamento
+            try:
+                valore = datetime.fromisoformat(str(valore)).strftime(
+                    '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise ValueError(f"{colonna} non valida: {valore}") from None
+        else:
+            valore = str(valore)
+        riga.append(valore)
+    if not riga[0]:
+        raise ValueError('numero_cliente mancante')
+    return tuple(riga)
+
+
+def leggi_importazione(flusso, formato, esito):
+    """Tuple per SQL_IMPORTA lette una alla volta da un file binario CSV
+    (con intestazione) o NDJSON, con le colonne dell'export (l'id viene
+    ignorato). Le righe non valide vengono saltate e contate in
+    esito['scartate'], le prime con il motivo in esito['errori']"""
+    testo = io.TextIOWrapper(flusso,
+                             encoding='utf-8-sig',
+                             newline='' if formato == 'csv' else None)
+    if formato == 'csv':
+        lettore = csv.DictReader(testo)
+        if 'numero_cliente' not in (lettore.fieldnames or ()):
+            raise ValueError("Intestazione CSV senza la colonna numero_cliente")
+        record = enumerate(lettore, 2)
+    else:
+        record = ((numero, riga) for numero, riga in enumerate(testo, 1)
+                  if riga.strip())
+    for numero, valori in record:
+        try:
+            if formato == 'ndjson':
+                valori = json.loads(valori)
+                if not isinstance(valori, dict):
+                    raise ValueError('non è un oggetto JSON')
+            riga = _riga_importata(valori)
+        except ValueError as e:
+            esito['scartate'] += 1
+            if len(esito['errori']) < 20:
+                esito['errori'].append(f"riga {numero}: {e}")
+            continue
+        yield riga
+
+
+def importa_richieste(officina, righe, blocco=IMPORTA_BLOCCO):
+    """Scrive le tuple di `righe` nel database dell'officina con
+    executemany, `blocco` righe per transazione; ritorna quante.
+
+    I trigger di riepiloghi ed eventi girano comunque riga per riga, ma
+    commit e lock di scrittura si pagano una volta per blocco, e il blocco
+    si prepara prima di prendere il lock. Gli eventi del blocco diventano un
+    solo 'reset' per l'app. Un errore annulla solo il blocco in corso: i
+    precedenti restano scritti.
+    """
+    database = officina.db
+    conn = database.connessione()
+    righe = iter(righe)
+    totale = 0
+    while True:
+        lotto = list(itertools.islice(righe, blocco))
+        if not lotto:
+            return totale
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            ultimo_evento = conn.execute(BusEventi.SQL_ULTIMO).fetchone()[0]
+            conn.executemany(DatabaseRichieste.SQL_IMPORTA, lotto)
+            officina.eventi.sostituisci_con_reset(conn, ultimo_evento)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        totale += len(lotto)
+        database._notifica_cambiamento()
+
+
+# ==================== ARCHIVIO (RETENTION) ====================
+
+
+class ArchivioRichieste:
+    """Lavoro di fondo che tiene piccola la tabella richieste di un'officina.
+
+    Le richieste completate da più di `giorni` giorni passano in archivi
+    mensili (per data_richiesta): un file SQLite per mese in
+    ARCHIVIO_DIR/<officina>/ con blocchi NDJSON compressi in gzip, lo stesso
+    formato dell'export (`flask esporta-archivio`). Un mese si rimette nel
+    database con `flask ripristina-archivio`, che tiene id e statistiche
+    (importa-richieste conterebbe due volte le righe). Le righe vengono
+    prima scritte nell'archivio e poi cancellate: un'interruzione a metà o
+    due worker sullo stesso lotto non perdono dati, e l'indice degli id
+    dell'archivio punta sempre alla copia più recente. Le statistiche
+    continuano a contare le richieste archiviate; elenco e ricerca no.
+
+    Dopo ogni giro l'auto_vacuum incrementale restituisce al filesystem le
+    pagine liberate, e vengono misurate righe, dimensione del file e
+    latenza della prima pagina dell'API, esposte come metriche.
+    """
+
+    SQL_SCADUTE = f'''
+        SELECT {', '.join(DatabaseRichieste.COLONNE)} FROM richieste
+        WHERE stato = 'completata' AND data_richiesta < ?
+          AND COALESCE(data_completamento, data_richiesta) < ?
+        ORDER BY data_richiesta LIMIT ?
+    '''
+
+    SQL_BLOCCO = '''
+        INSERT INTO blocchi (righe, archiviato, dati) VALUES (?, ?, ?)
+    '''
+
+    SQL_ARCHIVIATA = '''
+        INSERT INTO archiviate (id, blocco) VALUES (?, ?)
+        ON CONFLICT (id) DO UPDATE SET blocco = excluded.blocco
+    '''
+
+    # Solo le righe ancora completate: una riaperta nel frattempo resta
+    SQL_RIMUOVI_RIAPERTE = '''
+        DELETE FROM temp.da_archiviare WHERE NOT EXISTS (
+            SELECT 1 FROM richieste
+            WHERE richieste.id = da_archiviare.id
+              AND richieste.stato = 'completata'
+        )
+    '''
+
+    DA_ARCHIVIARE = 'WHERE id IN (SELECT id FROM temp.da_archiviare)'
+
+    # Ripristino con l'id originale; un id già presente resta com'è
+    SQL_RIPRISTINA = f'''
+        INSERT OR IGNORE INTO richieste
+        (id, {', '.join(DatabaseRichieste.COLONNE_IMPORTA)})
+        VALUES (?, {', '.join('?' * len(DatabaseRichieste.COLONNE_IMPORTA))})
+    '''
+
+    SQL_DA_RIPRISTINARE = '''
+        INSERT INTO temp.da_ripristinare (id)
+        SELECT ? WHERE NOT EXISTS (SELECT 1 FROM richieste WHERE id = ?)
+    '''
+
+    DA_RIPRISTINARE = 'WHERE id IN (SELECT id FROM temp.da_ripristinare)'
+
+    def __init__(self,
+                 officina,
+                 giorni=ARCHIVIO_DOPO_GIORNI,
+                 cartella=None,
+                 intervallo=ARCHIVIO_INTERVALLO,
+                 blocco=ARCHIVIO_BLOCCO):
+        self.officina = officina
+        self.database = officina.db
+        self.giorni = giorni  # 0: niente archiviazione, solo misure
+        self.cartella = cartella or os.path.join(ARCHIVIO_DIR, officina.id)
+        self.intervallo = intervallo
+        self.blocco = blocco
+        self.misure = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def avvia(self):
+        """Avvia il lavoro di fondo (una volta per processo)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._ciclo,
+                             name=f'archivio-{self.officina.id}',
+                             daemon=True).start()
+            self._pid = os.getpid()
+
+    def _ciclo(self):
+        # Primo giro dopo un ritardo casuale: i worker appena avviati non
+        # archiviano tutti insieme
+        attesa = random.uniform(1, min(self.intervallo, 60))
+        while True:
+            time.sleep(attesa)
+            attesa = self.intervallo * random.uniform(0.9, 1.1)
+            try:
+                self.esegui()
+            except Exception:
+                log.exception("Errore archiviazione",
+                              extra=campi(officina=self.officina.id))
+
+    def esegui(self, giorni=None):
+        """Un giro: archivia le richieste scadute, compatta il file e
+        aggiorna le misure; ritorna quante richieste sono state archiviate"""
+        giorni = self.giorni if giorni is None else giorni
+        inizio = time.perf_counter()
+        archiviate = 0
+        if giorni:
+            limite = (datetime.now() -
+                      timedelta(days=giorni)).strftime('%Y-%m-%d %H:%M:%S')
+            while True:
+                lette, n = self._archivia_lotto(limite)
+                archiviate += n
+                if lette < self.blocco:
+                    break
+        liberate = self.compatta()
+        self._misura()
+        if archiviate or liberate:
+            metriche.incrementa('archivio_richieste_totale',
+                                (('officina', self.officina.id), ),
+                                archiviate)
+            log.info("Archiviazione",
+                     extra=campi(officina=self.officina.id,
+                                 archiviate=archiviate,
+                                 pagine_liberate=liberate,
+                                 durata_ms=round(
+                                     (time.perf_counter() - inizio) * 1000)))
+        return archiviate
+
+    def _archivia_lotto(self, limite):
+        """Archivia un lotto di richieste scadute; ritorna quante ne ha
+        lette e quante ne ha cancellate (non quelle riaperte nel frattempo)"""
+        righe = self.database._leggi(self.SQL_SCADUTE,
+                                     (limite, limite, self.blocco))
+        per_mese = {}
+        indice_data = DatabaseRichieste.COLONNE.index('data_richiesta')
+        for riga in righe:
+            per_mese.setdefault(riga[indice_data][:7], []).append(riga)
+        for mese, righe_mese in per_mese.items():
+            self._scrivi_archivio(mese, righe_mese)
+        if not righe:
+            return 0, 0
+        return len(righe), self._rimuovi([riga[0] for riga in righe])
+
+    def _percorso(self, mese):
+        return os.path.join(self.cartella, f'richieste-{mese}.db')
+
+    def _apri(self, percorso):
+        """Connessione al file di un mese, creandolo se manca"""
+        os.makedirs(os.path.dirname(percorso), exist_ok=True)
+        conn = sqlite3.connect(percorso, timeout=DB_BUSY_TIMEOUT)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blocchi (
+                id INTEGER PRIMARY KEY,
+                righe INTEGER NOT NULL,
+                archiviato REAL NOT NULL,
+                dati BLOB NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archiviate (
+                id INTEGER PRIMARY KEY,
+                blocco INTEGER NOT NULL
+            )
+        ''')
+        return conn
+
+    def _scrivi_archivio(self, mese, righe):
+        dati = gzip.compress(b''.join(
+            righe_esportate([righe], DatabaseRichieste.COLONNE, 'ndjson')))
+        conn = self._apri(self._percorso(mese))
+        try:
+            with conn:
+                blocco = conn.execute(self.SQL_BLOCCO,
+                                      (len(righe), time.time(),
+                                       dati)).lastrowid
+                conn.executemany(self.SQL_ARCHIVIATA,
+                                 ((riga[0], blocco) for riga in righe))
+        finally:
+            conn.close()
+
+    def _rimuovi(self, ids):
+        """Cancella dal database le righe già archiviate, in una transazione
+        che lascia invariati i riepiloghi e al posto di un evento per riga
+        manda all'app un solo 'reset'; ritorna quante ne ha cancellate"""
+        conn = self.database.connessione()
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS da_archiviare '
+                     '(id INTEGER PRIMARY KEY)')
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM temp.da_archiviare')
+            conn.executemany('INSERT INTO temp.da_archiviare VALUES (?)',
+                             ((id_richiesta, ) for id_richiesta in ids))
+            conn.execute(self.SQL_RIMUOVI_RIAPERTE)
+            rimosse = conn.execute(
+                'SELECT COUNT(*) FROM temp.da_archiviare').fetchone()[0]
+            ultimo_evento = conn.execute(BusEventi.SQL_ULTIMO).fetchone()[0]
+            self.officina.riepiloghi.conserva(conn, self.DA_ARCHIVIARE)
+            conn.execute(f'DELETE FROM richieste {self.DA_ARCHIVIARE}')
+            self.officina.eventi.sostituisci_con_reset(conn, ultimo_evento)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        self.database._notifica_cambiamento()
+        return rimosse
+
+    def compatta(self, pagine=ARCHIVIO_VACUUM_PAGINE):
+        """Restituisce al filesystem fino a `pagine` pagine libere, se il
+        database ha l'auto_vacuum incrementale; ritorna quante"""
+        conn = self.database.connessione()
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return 0
+        libere = min(conn.execute('PRAGMA freelist_count').fetchone()[0],
+                     pagine)
+        if libere:
+            # Il pragma libera una pagina per riga letta
+            conn.execute(f'PRAGMA incremental_vacuum({libere})').fetchall()
+        return libere
+
+    def vacuum_completo(self):
+        """Attiva l'auto_vacuum incrementale e ricostruisce il file: serve
+        una volta per i database creati prima. Blocca le scritture per
+        tutta la durata"""
+        conn = self.database._apri_connessione()
+        try:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+
+    def _misura(self):
+        conn = self.database.connessione()
+        dimensione_pagina = conn.execute('PRAGMA page_size').fetchone()[0]
+        pagine = conn.execute('PRAGMA page_count').fetchone()[0]
+        libere = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        inizio = time.perf_counter()
+        self.database.cerca_richieste()
+        self.misure = {
+            'righe': self.database.conta_richieste(),
+            'byte': pagine * dimensione_pagina,
+            'byte_liberi': libere * dimensione_pagina,
+            'prima_pagina_secondi': time.perf_counter() - inizio,
+            'misurato': time.time()
+        }
+
+    def mesi(self):
+        """Mesi archiviati (AAAA-MM), dal più vecchio"""
+        if not os.path.isdir(self.cartella):
+            return []
+        return sorted(
+            nome[len('richieste-'):-len('.db')]
+            for nome in os.listdir(self.cartella)
+            if re.fullmatch(r'richieste-\d{4}-\d{2}\.db', nome))
+
+    def leggi(self, mese):
+        """Righe NDJSON (byte) archiviate in un mese, una volta sola anche
+        se una richiesta è stata archiviata più volte"""
+        conn = self._apri(self._percorso(mese))
+        try:
+            for blocco, righe, dati in conn.execute(
+                    'SELECT id, righe, dati FROM blocchi ORDER BY id'):
+                valide = {
+                    id_richiesta
+                    for id_richiesta, in conn.execute(
+                        'SELECT id FROM archiviate WHERE blocco = ?',
+                        (blocco, ))
+                }
+                for riga in gzip.decompress(dati).splitlines(keepends=True):
+                    if (len(valide) == righe
+                            or json.loads(riga)['id'] in valide):
+                        yield riga
+        finally:
+            conn.close()
+
+    def ripristina(self, mese):
+        """Rimette nel database le richieste archiviate in un mese, con il
+        loro id, e ritorna quante. Le righe il cui id c'è già (ripristino
+        ripetuto) restano invariate. I riepiloghi non cambiano: contavano
+        già le richieste archiviate.
+
+        Le righe ripristinate restano completate e vecchie: il prossimo giro
+        le archivia di nuovo se ARCHIVIO_DOPO_GIORNI non viene alzato.
+        """
+        righe = (json.loads(riga) for riga in self.leggi(mese))
+        conn = self.database.connessione()
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS da_ripristinare '
+                     '(id INTEGER PRIMARY KEY)')
+        totale = 0
+        while True:
+            lotto = [(valori['id'], ) + _riga_importata(valori)
+                     for valori in itertools.islice(righe, self.blocco)]
+            if not lotto:
+                return totale
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM temp.da_ripristinare')
+                ultimo_evento = conn.execute(
+                    BusEventi.SQL_ULTIMO).fetchone()[0]
+                conn.executemany(self.SQL_DA_RIPRISTINARE,
+                                 ((riga[0], riga[0]) for riga in lotto))
+                conn.executemany(self.SQL_RIPRISTINA, lotto)
+                self.officina.riepiloghi.gia_contate(conn,
+                                                     self.DA_RIPRISTINARE)
+                totale += conn.execute(
+                    'SELECT COUNT(*) FROM temp.da_ripristinare').fetchone()[0]
+                self.officina.eventi.sostituisci_con_reset(
+                    conn, ultimo_evento)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            self.database._notifica_cambiamento()
+
+
+# ==================== STORICO CLIENTI ====================
+
+
+class StoricoClienti:
+    """Ultima richiesta di ogni cliente, per riconoscere chi torna.
+
+    Una lettura sull'indice (numero_cliente, data_richiesta) all'inizio di
+    ogni conversazione, con davanti una LRU dei profili recenti (anche dei
+    clienti nuovi, come None). Le richieste salvate dal bot di questo
+    processo aggiornano subito la voce del cliente; quelle salvate da altri
+    worker si vedono alla scadenza della voce (`durata`).
+    """
+
+    SQL_ULTIMA = '''
+        SELECT id, auto, problema, categoria, data_richiesta
+        FROM richieste WHERE numero_cliente = ?
+        ORDER BY data_richiesta DESC, id DESC LIMIT 1
+    '''
+
+    CAMPI = ('id', 'auto', 'problema', 'categoria', 'data_richiesta')
+
+    def __init__(self,
+                 database,
+                 capacita=STORICO_CLIENTI_MAX,
+                 durata=STORICO_CLIENTI_DURATA):
+        self.database = database
+        self.capacita = capacita
+        self.durata = durata
+        self._profili = OrderedDict()  # numero -> (scadenza, profilo)
+        self._lock = threading.Lock()
+        self._contatori = Counter()
+
+    def profilo(self, numero_cliente):
+        """Ultima richiesta del cliente come dizionario (CAMPI), None se
+        non ne ha"""
+        adesso = time.monotonic()
+        with self._lock:
+            voce = self._profili.get(numero_cliente)
+            if voce is not None and voce[0] > adesso:
+                self._profili.move_to_end(numero_cliente)
+                self._contatori['hit'] += 1
+                return voce[1]
+            self._contatori['miss'] += 1
+        righe = self.database._leggi(self.SQL_ULTIMA, (numero_cliente, ))
+        profilo = dict(zip(self.CAMPI, righe[0])) if righe else None
+        # Una registra() arrivata durante la lettura è più nuova: resta lei
+        self._memorizza(numero_cliente, profilo, adesso)
+        return profilo
+
+    def registra(self, numero_cliente, profilo):
+        """Sostituisce la voce del cliente dopo una sua nuova richiesta"""
+        self._memorizza(numero_cliente, profilo)
+
+    def _memorizza(self, numero_cliente, profilo, letto=None):
+        with self._lock:
+            voce = self._profili.get(numero_cliente)
+            if (letto is not None and voce is not None
+                    and voce[0] - self.durata > letto):
+                return
+            self._profili[numero_cliente] = (time.monotonic() + self.durata,
+                                             profilo)
+            self._profili.move_to_end(numero_cliente)
+            while len(self._profili) > self.capacita:
+                self._profili.popitem(last=False)
+                self._contatori['espulse'] += 1
+
+    def statistiche(self):
+        """Hit/miss/espulsioni della LRU e voci presenti"""
+        with self._lock:
+            return dict(self._contatori, voci=len(self._profili))
+
+
+# ==================== CAMPAGNE (INVII MASSIVI) ====================
+
+
+class CampagneOfficina:
+    """Messaggi WhatsApp a molti clienti di un'officina (es: promemoria del
+    tagliando a chi ha chiesto una MANUTENZIONE l'anno scorso).
+
+    Creare una campagna salva messaggio e filtri e ritorna subito. In
+    background i destinatari vengono letti da richieste con
+    DatabaseRichieste.esporta (a blocchi, senza caricare la tabella in
+    memoria) e salvati una volta per numero (chiave primaria). Poi un pool
+    di CAMPAGNE_THREAD thread li invia tramite Twilio, al massimo
+    CAMPAGNE_AL_SECONDO al secondo per officina. I messaggi al singolo
+    cliente restano nell'outbox e non aspettano la campagna.
+
+    Le campagne di un'officina vanno una alla volta, e ognuna ha un lease:
+    la invia un solo processo, quindi il limite vale anche con più worker
+    gunicorn. Lo stato di ogni
+    destinatario è nel database: dopo un riavvio la campagna riprende
+    dai destinatari non ancora inviati. Come l'outbox, la consegna è
+    almeno una volta: un invio interrotto a metà può ripetersi.
+    """
+
+    LEASE = 60  # secondi di possesso di una campagna o di un destinatario
+
+    SQL_CREA = '''
+        INSERT INTO campagne (nome, messaggio, filtri, stato, creata,
+                              aggiornata)
+        VALUES (?, ?, ?, 'preparazione', ?, ?)
+    '''
+
+    # Le campagne partono in ordine, una alla volta per officina
+    SQL_PROSSIMA = '''
+        SELECT id, lease FROM campagne
+        WHERE stato IN ('preparazione', 'in_corso')
+        ORDER BY id LIMIT 1
+    '''
+
+    SQL_PRENDI = '''
+        UPDATE campagne SET lease = ?
+        WHERE id = ? AND stato IN ('preparazione', 'in_corso')
+          AND (lease < ? OR lease = ?)
+    '''
+
+    SQL_STATO = '''
+        UPDATE campagne SET stato = ?, aggiornata = ?
+        WHERE id = ? AND stato IN ('preparazione', 'in_corso')
+    '''
+
+    SQL_LEGGI = '''
+        SELECT id, nome, messaggio, filtri, stato, destinatari, creata,
+               aggiornata
+        FROM campagne WHERE id = ?
+    '''
+
+    SQL_ELENCO = '''
+        SELECT id, nome, messaggio, filtri, stato, destinatari, creata,
+               aggiornata
+        FROM campagne ORDER BY id DESC LIMIT ?
+    '''
+
+    SQL_AGGIUNGI = '''
+        INSERT OR IGNORE INTO campagne_destinatari
+        (campagna, numero, stato, tentativi, prossimo_tentativo)
+        VALUES (?, ?, 'in_attesa', 0, 0)
+    '''
+
+    SQL_CONTA_DESTINATARI = '''
+        UPDATE campagne SET destinatari = (
+            SELECT COUNT(*) FROM campagne_destinatari WHERE campagna = ?1
+        ) WHERE id = ?1
+    '''
+
+    SQL_DA_INVIARE = '''
+        SELECT numero, tentativi FROM campagne_destinatari
+        WHERE campagna = ? AND stato = 'in_attesa'
+          AND prossimo_tentativo <= ?
+        ORDER BY prossimo_tentativo LIMIT ?
+    '''
+
+    SQL_PROSSIMO_TENTATIVO = '''
+        SELECT MIN(prossimo_tentativo) FROM campagne_destinatari
+        WHERE campagna = ? AND stato = 'in_attesa'
+    '''
+
+    SQL_PRENOTA = '''
+        UPDATE campagne_destinatari
+        SET prossimo_tentativo = ?, tentativi = tentativi + 1
+        WHERE campagna = ? AND numero = ?
+    '''
+
+    SQL_ESITO = '''
+        UPDATE campagne_destinatari
+        SET stato = ?, tentativi = tentativi - ?, prossimo_tentativo = ?,
+            errore = ?, message_sid = ?, aggiornato = ?
+        WHERE campagna = ? AND numero = ?
+    '''
+
+    SQL_CONTA_PER_STATO = '''
+        SELECT stato, COUNT(*) FROM campagne_destinatari
+        WHERE campagna = ? GROUP BY stato
+    '''
+
+    COLONNE = ('id', 'nome', 'messaggio', 'filtri', 'stato', 'destinatari',
+               'creata', 'aggiornata')
+
+    def __init__(self,
+                 officina,
+                 n_thread=CAMPAGNE_THREAD,
+                 al_secondo=CAMPAGNE_AL_SECONDO,
+                 burst=CAMPAGNE_BURST,
+                 max_tentativi=CAMPAGNE_MAX_TENTATIVI,
+                 invia=None):
+        self.officina = officina
+        self.database = officina.db
+        self.n_thread = n_thread
+        self.limite = TokenBucket(al_secondo, burst)
+        # Destinatari per lotto: al massimo circa 10 secondi di invii al
+        # limite e 20 per thread, ben dentro il lease anche se Twilio
+        # rallenta
+        self.lotto = max(n_thread, min(int(al_secondo * 10), n_thread * 20))
+        self.max_tentativi = max_tentativi
+        self.invia = invia or invia_whatsapp
+        self._contatori = Counter()
+        self._thread = None
+        self._lease = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        with self.database.connessione() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS campagne (
+                    id INTEGER PRIMARY KEY,
+                    nome TEXT,
+                    messaggio TEXT NOT NULL,
+                    filtri TEXT NOT NULL,
+                    stato TEXT NOT NULL,
+                    destinatari INTEGER NOT NULL DEFAULT 0,
+                    lease REAL NOT NULL DEFAULT 0,
+                    creata REAL NOT NULL,
+                    aggiornata REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS campagne_destinatari (
+                    campagna INTEGER NOT NULL,
+                    numero TEXT NOT NULL,
+                    stato TEXT NOT NULL,
+                    tentativi INTEGER NOT NULL,
+                    prossimo_tentativo REAL NOT NULL,
+                    errore TEXT,
+                    message_sid TEXT,
+                    aggiornato REAL,
+                    PRIMARY KEY (campagna, numero)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_destinatari_da_inviare
+                ON campagne_destinatari (campagna, stato, prossimo_tentativo)
+            ''')
+
+    def crea(self, messaggio, nome=None, categoria=None, stato=None,
+             dal=None, al=None):
+        """Salva una nuova campagna e avvia l'invio; ritorna il suo id.
+        I filtri sono quelli dell'export (date AAAA-MM-GG incluse)"""
+        filtri = {
+            chiave: valore
+            for chiave, valore in (('categoria', categoria), ('stato', stato),
+                                   ('dal', dal), ('al', al)) if valore
+        }
+        adesso = time.time()
+        id_campagna = self.database._scrivi(
+            self.SQL_CREA, (nome, messaggio, json.dumps(filtri), adesso,
+                            adesso)).lastrowid
+        log.info("Campagna creata",
+                 extra=campi(officina=self.officina.id,
+                             campagna=id_campagna,
+                             filtri=filtri))
+        self.avvia()
+        return id_campagna
+
+    def annulla(self, id_campagna):
+        """Ferma una campagna alla fine del lotto in corso; False se era già
+        finita o non esiste"""
+        return bool(
+            self.database._scrivi(self.SQL_STATO,
+                                  ('annullata', time.time(),
+                                   id_campagna)).rowcount)
+
+    def leggi(self, id_campagna):
+        """Campagna con l'avanzamento dei destinatari per stato (None se
+        non esiste)"""
+        righe = self.database._leggi(self.SQL_LEGGI, (id_campagna, ))
+        if not righe:
+            return None
+        campagna = self._campagna(righe[0])
+        campagna['avanzamento'] = dict(
+            self.database._leggi(self.SQL_CONTA_PER_STATO, (id_campagna, )))
+        return campagna
+
+    def elenco(self, limite=50):
+        """Ultime campagne, dalla più recente"""
+        return [
+            self._campagna(riga)
+            for riga in self.database._leggi(self.SQL_ELENCO, (limite, ))
+        ]
+
+    def _campagna(self, riga):
+        campagna = dict(zip(self.COLONNE, riga))
+        campagna['filtri'] = json.loads(campagna['filtri'])
+        return campagna
+
+    def statistiche(self):
+        """Messaggi inviati/rimandati/falliti da questo processo"""
+        return dict(self._contatori)
+
+    def riprendi(self):
+        """Alla prima chiamata nel processo riprende le campagne lasciate a
+        metà (es: da un riavvio)"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.avvia()
+
+    def avvia(self):
+        """Avvia in background l'invio delle campagne in corso, se in questo
+        processo non è già attivo; il thread finisce con le campagne"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._ciclo,
+                name=f'campagne-{self.officina.id}',
+                daemon=True)
+            self._thread.start()
+
+    def _ciclo(self):
+        try:
+            while True:
+                righe = self.database._leggi(self.SQL_PROSSIMA)
+                if not righe:
+                    return
+                id_campagna, lease = righe[0]
+                # In mano a un altro processo: subentra se il lease scade
+                attesa = lease - time.time()
+                if attesa > 0:
+                    time.sleep(attesa + random.uniform(0.1, 1))
+                elif self._prendi(id_campagna):
+                    self.esegui(id_campagna)
+        except Exception:
+            log.exception("Errore campagne",
+                          extra=campi(officina=self.officina.id))
+
+    def _prendi(self, id_campagna):
+        """Prende il lease della campagna, se è libero o scaduto, oppure
+        rinnova il nostro; False se la campagna è di un altro processo o
+        non è più da inviare"""
+        adesso = time.time()
+        nuovo = adesso + self.LEASE
+        if not self.database._scrivi(
+                self.SQL_PRENDI,
+            (nuovo, id_campagna, adesso, self._lease)).rowcount:
+            return False
+        self._lease = nuovo
+        return True
+
+    def esegui(self, id_campagna):
+        """Prepara (se serve) e invia una campagna di cui si ha il lease,
+        fino alla fine o finché un altro processo o un annullamento non la
+        ferma"""
+        campagna = self.leggi(id_campagna)
+        inizio = time.perf_counter()
+        if campagna['stato'] == 'preparazione':
+            if not self._prepara(id_campagna, campagna['filtri']):
+                return
+            self.database._scrivi(self.SQL_STATO,
+                                  ('in_corso', time.time(), id_campagna))
+        payload = {
+            'from': self.officina.numero_whatsapp,
+            'body': campagna['messaggio']
+        }
+        with ThreadPoolExecutor(self.n_thread,
+                                thread_name_prefix='campagna') as pool:
+            while self._prendi(id_campagna):
+                adesso = time.time()
+                righe = self.database._leggi(
+                    self.SQL_DA_INVIARE, (id_campagna, adesso, self.lotto))
+                if not righe:
+                    prossimo = self.database._leggi(
+                        self.SQL_PROSSIMO_TENTATIVO, (id_campagna, ))[0][0]
+                    if prossimo is None:
+                        break
+                    # Restano solo retry in backoff
+                    time.sleep(
+                        min(max(prossimo - adesso, 0.1), self.LEASE / 2))
+                    continue
+                self._prenota(id_campagna, righe)
+                esiti = pool.map(
+                    lambda riga: self._invia_uno(payload, riga), righe)
+                self._registra(id_campagna, righe, list(esiti))
+            else:
+                return  # lease perso o campagna annullata
+        self.database._scrivi(self.SQL_STATO,
+                              ('completata', time.time(), id_campagna))
+        log.info("Campagna completata",
+                 extra=campi(officina=self.officina.id,
+                             campagna=id_campagna,
+                             durata_s=round(time.perf_counter() - inizio, 1)))
+
+    def _prepara(self, id_campagna, filtri):
+        """Salva i destinatari della campagna leggendo le richieste a
+        blocchi; un numero compare una volta sola anche se ripreso dopo
+        un'interruzione. False se nel frattempo il lease è stato perso"""
+        blocchi = self.database.esporta(('numero_cliente', ),
+                                        blocco=CAMPAGNE_BLOCCO,
+                                        **filtri)
+        try:
+            for righe in blocchi:
+                if not self._prendi(id_campagna):
+                    return False
+                with self.database.connessione() as conn:
+                    conn.executemany(self.SQL_AGGIUNGI,
+                                     ((id_campagna, numero)
+                                      for numero in {riga[0]
+                                                     for riga in righe}))
+        finally:
+            blocchi.close()
+        self.database._scrivi(self.SQL_CONTA_DESTINATARI, (id_campagna, ))
+        return True
+
+    def _prenota(self, id_campagna, righe):
+        """Sposta avanti di un lease i destinatari in invio: se il processo
+        muore a metà, dopo il lease vengono ripresi"""
+        conn = self.database.connessione()
+        with conn:
+            conn.executemany(self.SQL_PRENOTA,
+                             ((time.time() + self.LEASE, id_campagna, numero)
+                              for numero, _ in righe))
+
+    def _invia_uno(self, payload, riga):
+        """Invia a un destinatario rispettando il limite dell'officina;
+        ritorna (esito, stato, prossimo tentativo, errore, message_sid)"""
+        numero, tentativi = riga
+        while True:
+            attesa = self.limite.consuma()
+            if not attesa:
+                break
+            time.sleep(attesa)
+        try:
+            sid = self.invia(dict(payload, to=numero))
+        except Rimanda as e:
+            return 'rimandato', 'in_attesa', time.time() + e.attesa, str(
+                e), None
+        except Exception as e:
+            tentativi += 1
+            if (isinstance(e, ErroreDefinitivo)
+                    or tentativi >= self.max_tentativi):
+                return 'fallito', 'fallito', 0, str(e), None
+            # Backoff esponenziale con jitter, come l'outbox
+            attesa = min(2**tentativi, 600) * random.uniform(0.75, 1.25)
+            return 'errore', 'in_attesa', time.time() + attesa, str(e), None
+        return 'inviato', 'inviato', 0, None, sid
+
+    def _registra(self, id_campagna, righe, esiti):
+        adesso = time.time()
+        conn = self.database.connessione()
+        with conn:
+            # Il tentativo è contato dalla prenotazione; un invio rimandato
+            # non conta
+            conn.executemany(self.SQL_ESITO,
+                             ((stato, int(esito == 'rimandato'), prossimo,
+                               errore, sid, adesso, id_campagna, numero)
+                              for (numero, _), (esito, stato, prossimo,
+                                                errore, sid) in zip(
+                                                    righe, esiti)))
+        for esito, n in Counter(esito for esito, *_ in esiti).items():
+            self._contatori[esito] += n
+            metriche.incrementa('campagne_invii_totale',
+                                (('officina', self.officina.id),
+                                 ('esito', esito)), n)
+
+
+# ==================== BOT WHATSAPP LOGIC ====================
+
+# Flusso della conversazione dichiarato come dati. Ogni step ha la domanda
+# da inviare, il campo dove salvare la risposta e la transizione: 'prossimo'
+# per le risposte libere, 'opzioni' per le scelte numerate (ogni opzione ha
+# il valore salvato, il prossimo step ed eventualmente la categoria).
+# Uno step senza prossimo chiude la conversazione e salva la richiesta.
+# Se il primo step chiede l'auto, a chi torna si propone quella dell'ultima
+# richiesta ('stessa_auto') insieme alla domanda successiva.
+# Si può sostituire con un file JSON con la stessa struttura (FLUSSO_PATH).
+FLUSSO_PREDEFINITO = {
+    'introduzione':
+    "Ciao 👋\nSono l’assistente dell’officina.\nTi faccio 3 domande rapide per capire come aiutarti.",
+    'inizio': 'auto',
+    'stessa_auto':
+    "🚗 È per la {auto}, come l'ultima volta? Allora rispondi già qui sotto.\nSe è un'altra auto scrivi 0.",
+    'chiusura':
+    "Perfetto, abbiamo preso in carico la tua richiesta 👍\nTi ricontatteremo al più presto su questo numero.",
+    'step': {
+        'auto': {
+            'domanda': "🚗 Che auto hai?\n(Marca e modello)",
+            'campo': 'auto',
+            'prossimo': 'problema'
+        },
+        'problema': {
+            'domanda':
+            "🔧 Che tipo di problema hai?\n\n1️⃣ Auto ferma / rumori strani\n2️⃣ Tagliando / controllo\n3️⃣ Preventivo / informazioni\n\nRispondi con 1, 2 o 3",
+            'campo': 'problema',
+            'campo_codice': 'problema_cod',
+            'errore': "Per favore rispondi con 1, 2 o 3",
+            'opzioni': {
+                '1': {
+                    'valore': 'Auto ferma / rumori strani',
+                    'prossimo': 'urgenza'
+                },
+                '2': {
+                    'valore': 'Tagliando / controllo',
+                    'prossimo': 'spie'
+                },
+                '3': {
+                    'valore': 'Preventivo / informazioni',
+                    'prossimo': 'tipo_intervento'
+                }
+            }
+        },
+        'urgenza': {
+            'domanda':
+            "🚨 È urgente?\n\n1. Auto non parte\n2. Posso ancora circolare\n3. È solo un controllo\n\nRispondi con 1, 2 o 3",
+            'campo': 'urgenza',
+            'errore': "Per favore rispondi con 1, 2 o 3",
+            'opzioni': {
+                '1': {
+                    'valore': 'Auto non parte',
+                    'categoria': 'URGENTE'
+                },
+                '2': {
+                    'valore': 'Posso ancora circolare',
+                    'categoria': 'MANUTENZIONE'
+                },
+                '3': {
+                    'valore': 'È solo un controllo',
+                    'categoria': 'MANUTENZIONE'
+                }
+            }
+        },
+        'spie': {
+            'domanda':
+            "Hai notato qualche spia accesa sul cruscotto o comportamenti strani dell'auto?",
+            'campo': 'spie_comportamenti',
+            'prossimo': 'orario'
+        },
+        'orario': {
+            'domanda': "Hai preferenze di orario? Mattina o pomeriggio?",
+            'campo': 'preferenza_orario',
+            'categoria': 'MANUTENZIONE'
+        },
+        'tipo_intervento': {
+            'domanda':
+            "Di che tipo di intervento si tratta? (es: freni, gomme, carrozzeria, climatizzatore...)",
+            'campo': 'tipo_intervento',
+            'prossimo': 'diagnosi'
+        },
+        'diagnosi': {
+            'domanda':
+            "Hai già una diagnosi o serve prima un controllo per capire il problema?",
+            'campo': 'diagnosi_controllo',
+            'categoria': 'PREVENTIVO'
+        }
+    }
+}
+
+
+class Step:
+    """Step compilato: tutto ciò che serve per gestire un messaggio"""
+
+    __slots__ = ('nome', 'domanda', 'campo', 'campo_codice', 'errore',
+                 'formato', 'opzioni', 'prossimo', 'categoria')
+
+    def __init__(self, nome, definizione, errore_predefinito):
+        self.nome = nome
+        self.domanda = definizione['domanda']
+        self.campo = definizione['campo']
+        self.campo_codice = definizione.get('campo_codice')
+        self.errore = definizione.get('errore', errore_predefinito)
+        self.prossimo = definizione.get('prossimo')
+        self.categoria = definizione.get('categoria')
+        # Validatore opzionale per le risposte libere (regex)
+        formato = definizione.get('formato')
+        self.formato = re.compile(formato) if formato else None
+        # risposta -> (valore salvato, prossimo step, categoria)
+        self.opzioni = None
+        if 'opzioni' in definizione:
+            self.opzioni = {
+                risposta: (opzione['valore'], opzione.get('prossimo'),
+                           opzione.get('categoria'))
+                for risposta, opzione in definizione['opzioni'].items()
+            }
+
+
+class FlussoCompilato:
+    """Flusso della conversazione compilato in una tabella di dispatch.
+
+    La compilazione, fatta una volta all'avvio, verifica che tutte le
+    transizioni puntino a step esistenti: gestire un messaggio è poi una
+    sola lookup per nome di step.
+    """
+
+    def __init__(self, definizione):
+        errore = definizione.get('errore', "Scusa, non ho capito. Riprova.")
+        self.introduzione = definizione['introduzione']
+        self.chiusura = definizione['chiusura']
+        self.inizio = definizione['inizio']
+        self.steps = {
+            nome: Step(nome, step, errore)
+            for nome, step in definizione['step'].items()
+        }
+
+        for step in self.steps.values():
+            destinazioni = [step.prossimo]
+            if step.opzioni:
+                destinazioni = [prossimo for _, prossimo, _ in
+                                step.opzioni.values()]
+            for prossimo in destinazioni:
+                if prossimo is not None and prossimo not in self.steps:
+                    raise ValueError(
+                        f"Step '{step.nome}': prossimo '{prossimo}' inesistente")
+        if self.inizio not in self.steps:
+            raise ValueError(f"Step iniziale '{self.inizio}' inesistente")
+
+        # Prima risposta di ogni conversazione: introduzione + prima domanda
+        self.benvenuto = (self.introduzione + "\n\n" +
+                          self.steps[self.inizio].domanda)
+        # Percorso breve per chi torna: serve un primo step a risposta
+        # libera sul campo 'auto', e uno step successivo dove lo 0 non sia
+        # già una risposta valida
+        primo = self.steps[self.inizio]
+        self.dopo_auto = None
+        if primo.campo == 'auto' and primo.opzioni is None and primo.prossimo:
+            successivo = self.steps[primo.prossimo]
+            if not (successivo.opzioni and '0' in successivo.opzioni):
+                self.dopo_auto = primo.prossimo
+        self.stessa_auto = definizione.get('stessa_auto',
+                                           FLUSSO_PREDEFINITO['stessa_auto'])
+        try:
+            self.stessa_auto.format(auto='')
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(
+                f"Testo 'stessa_auto' non valido: solo {{auto}} ({e})")
+
+    def bentornato(self, auto):
+        """Primo messaggio per chi torna: introduzione, conferma dell'auto
+        e già la domanda dopo quella sull'auto"""
+        return (self.introduzione + "\n\n" +
+                self.stessa_auto.format(auto=auto) + "\n\n" +
+                self.steps[self.dopo_auto].domanda)
+
+
+def carica_flusso(percorso=None):
+    """Legge il flusso da un file JSON (default FLUSSO_PATH) o usa quello
+    predefinito"""
+    percorso = percorso or FLUSSO_PATH
+    if percorso:
+        with open(percorso, encoding='utf-8') as f:
+            return json.load(f)
+    return FLUSSO_PREDEFINITO
+
+
+class BotOfficina:
+    """Conversazione WhatsApp di una officina: il flusso compilato e i dati
+    (archivio conversazioni, database) dell'officina"""
+
+    def __init__(self, officina, flusso=None):
+        self.officina = officina
+        self.flusso = flusso or FlussoCompilato(carica_flusso())
 
-    def gestisci_messaggio(self, numero_cliente, messaggio):
-        # Inizializza conversazione se nuova
-        if numero_cliente not in conversazioni:
-            conversazioni[numero_cliente] = {
-                'step': 0,
+    def gestisci_messaggio(self, numero_cliente, messaggio, message_sid=None):
+        inizio = time.perf_counter()
+        try:
+            return self._gestisci_messaggio(numero_cliente, messaggio,
+                                            message_sid)
+        finally:
+            metriche.osserva('bot_messaggio_durata_secondi',
+                             time.perf_counter() - inizio)
+
+    def _gestisci_messaggio(self, numero_cliente, messaggio, message_sid):
+        # Inizializza conversazione se nuova (o scaduta)
+        conversazioni = self.officina.conversazioni
+        conv = conversazioni.leggi(numero_cliente)
+        if conv is None:
+            conv = {
+                'step': None,
                 'dati': {},
-                'timestamp': datetime.now()
+                'timestamp': datetime.now().isoformat()
             }
 
-        conv = conversazioni[numero_cliente]
-        step_corrente = conv['step']
-
-        # STEP 0: Benvenuto
-        if step_corrente == 0:
-            conv['step'] = 1
-            return self.steps[0] + "\n\n" + self.steps[1]
-
-        # STEP 1: Raccolta auto
-        elif step_corrente == 1:
-            conv['dati']['auto'] = messaggio
-            conv['step'] = 2
-            return self.steps[2]
-
-        # STEP 2: Tipo problema
-        elif step_corrente == 2:
-            problemi = {
-                '1': 'Auto ferma / rumori strani',
-                '2': 'Tagliando / controllo',
-                '3': 'Preventivo / informazioni'
-            }
+        # Retry già elaborato da un altro worker: lo stato condiviso lo sa
+        if message_sid and conv.get('ultimo_sid') == message_sid:
+            return conv['ultima_risposta']
 
-            if messaggio in problemi:
-                conv['dati']['problema'] = problemi[messaggio]
-                conv['dati']['problema_cod'] = messaggio
+        risposta = self.avanza_conversazione(numero_cliente, conv, messaggio)
+        if message_sid:
+            conv['ultimo_sid'] = message_sid
+            conv['ultima_risposta'] = risposta
 
-                # Se è urgenza (1), chiedi dettagli urgenza
-                if messaggio == '1':
-                    conv['step'] = 3
-                    return self.steps[3]
+        if not conv.get('chiusa'):
+            conversazioni.salva(numero_cliente, conv)
+        elif message_sid:
+            # Della conversazione chiusa resta per poco solo l'ultima
+            # risposta: un retry di Twilio che arriva a un altro worker
+            # riceve la conferma, non il benvenuto. Il messaggio successivo
+            # ne inizia una nuova
+            chiusa = {
+                'step': None,
+                'dati': {},
+                'timestamp': datetime.now().isoformat(),
+                'ultimo_sid': message_sid,
+                'ultima_risposta': risposta
+            }
+            conversazioni.salva(numero_cliente,
+                                chiusa,
+                                ttl=CONVERSAZIONI_TTL_CHIUSE)
+        else:
+            conversazioni.elimina(numero_cliente)
 
-                # Se è tagliando (2), prima domanda
-                elif messaggio == '2':
-                    conv['step'] = 4
-                    return "Hai notato qualche spia accesa sul cruscotto o comportamenti strani dell'auto?"
+        return risposta
 
-                # Se è preventivo (3), prima domanda
-                elif messaggio == '3':
-                    conv['step'] = 6
-                    return "Di che tipo di intervento si tratta? (es: freni, gomme, carrozzeria, climatizzatore...)"
-            else:
-                return "Per favore rispondi con 1, 2 o 3"
-
-        # STEP 3: Urgenza (solo se problema = 1)
-        elif step_corrente == 3:
-            urgenze = {
-                '1': 'Auto non parte',
-                '2': 'Posso ancora circolare',
-                '3': 'È solo un controllo'
-            }
+    def avanza_conversazione(self, numero_cliente, conv, messaggio):
+        """Applica il messaggio allo step corrente e ritorna la risposta"""
+        flusso = self.flusso
+        step = flusso.steps.get(conv['step'])
 
-            if messaggio in urgenze:
-                conv['dati']['urgenza'] = urgenze[messaggio]
-                return self.chiudi_conversazione(numero_cliente,
-                                                 urgenze[messaggio])
-            else:
-                return "Per favore rispondi con 1, 2 o 3"
-
-        # STEP 4: Prima domanda tagliando (NUOVO)
-        elif step_corrente == 4:
-            conv['dati']['spie_comportamenti'] = messaggio
-            conv['step'] = 5
-            return "Hai preferenze di orario? Mattina o pomeriggio?"
-
-        # STEP 5: Seconda domanda tagliando (NUOVO)
-        elif step_corrente == 5:
-            conv['dati']['preferenza_orario'] = messaggio
-            return self.chiudi_conversazione(numero_cliente, None)
-
-        # STEP 6: Prima domanda preventivo (NUOVO)
-        elif step_corrente == 6:
-            conv['dati']['tipo_intervento'] = messaggio
-            conv['step'] = 7
-            return "Hai già una diagnosi o serve prima un controllo per capire il problema?"
-
-        # STEP 7: Seconda domanda preventivo (NUOVO)
-        elif step_corrente == 7:
-            conv['dati']['diagnosi_controllo'] = messaggio
-            return self.chiudi_conversazione(numero_cliente, None)
+        # Conversazione nuova (o step non più esistente): benvenuto
+        if step is None:
+            return self.inizia_conversazione(numero_cliente, conv)
 
-        else:
-            return "Scusa, non ho capito. Riprova."
+        # Chi torna e ha un'altra auto: si riparte dalla domanda sull'auto
+        if conv.get('stessa_auto') and messaggio.strip() == '0':
+            del conv['stessa_auto']
+            del conv['dati'][flusso.steps[flusso.inizio].campo]
+            conv['step'] = flusso.inizio
+            return flusso.steps[flusso.inizio].domanda
 
-    def chiudi_conversazione(self, numero_cliente, urgenza):
-        """Chiude la conversazione e salva la richiesta"""
-        conv = conversazioni[numero_cliente]
-        dati = conv['dati']
+        if step.opzioni is not None:
+            scelta = step.opzioni.get(messaggio)
+            if scelta is None:
+                return step.errore
+            valore, prossimo, categoria = scelta
+            if step.campo_codice:
+                conv['dati'][step.campo_codice] = messaggio
+        else:
+            if step.formato and not step.formato.fullmatch(messaggio):
+                return step.errore
+            valore, prossimo, categoria = messaggio, step.prossimo, step.categoria
 
-        # Classifica richiesta
-        categoria = self.classifica_richiesta(dati.get('problema_cod'),
-                                              urgenza)
+        conv['dati'][step.campo] = valore
+        conv.pop('stessa_auto', None)
 
-        # SALVA NEL DATABASE
-        db = DatabaseRichieste()
-        db.salva_richiesta(numero_cliente, dati, categoria)
+        if prossimo is None:
+            return self.chiudi_conversazione(numero_cliente, conv, categoria)
 
-        # Prepara il messaggio riepilogativo per il titolare
-        riepilogo = "📋 NUOVA RICHIESTA\n\n"
-        riepilogo += f"🚗 Auto: {dati.get('auto', 'N/D')}\n"
-        riepilogo += f"❗ Problema: {dati.get('problema', 'N/D')}\n"
+        conv['step'] = prossimo
+        return flusso.steps[prossimo].domanda
 
-        # Aggiungi dettagli specifici in base al tipo di problema
-        if dati.get('problema_cod') == '1':
-            riepilogo += f"🚨 Urgenza: {urgenza}\n"
-            riepilogo += f"🏷️ Categoria: {categoria}\n"
+    def inizia_conversazione(self, numero_cliente, conv):
+        """Primo messaggio: il benvenuto con la prima domanda o, per chi ha
+        già fatto una richiesta, la conferma dell'auto insieme alla domanda
+        successiva (un messaggio in meno per richiesta)"""
+        flusso = self.flusso
+        conv['step'] = flusso.inizio
+        if flusso.dopo_auto is None:
+            return flusso.benvenuto
+        profilo = self.officina.storico.profilo(numero_cliente)
+        auto = profilo and profilo['auto']
+        if not auto:
+            return flusso.benvenuto
+        conv['step'] = flusso.dopo_auto
+        conv['dati'][flusso.steps[flusso.inizio].campo] = auto
+        conv['stessa_auto'] = True
+        return flusso.bentornato(auto)
 
-        elif dati.get('problema_cod') == '2':
-            riepilogo += f"💡 Spie/Comportamenti: {dati.get('spie_comportamenti', 'N/D')}\n"
-            riepilogo += f"🕐 Preferenza orario: {dati.get('preferenza_orario', 'N/D')}\n"
-            riepilogo += f"🏷️ Categoria: {categoria}\n"
+    def chiudi_conversazione(self, numero_cliente, conv, categoria=None):
+        """Chiude la conversazione e salva la richiesta"""
+        dati = conv['dati']
 
-        elif dati.get('problema_cod') == '3':
-            riepilogo += f"🔧 Tipo intervento: {dati.get('tipo_intervento', 'N/D')}\n"
-            riepilogo += f"📋 Diagnosi: {dati.get('diagnosi_controllo', 'N/D')}\n"
-            riepilogo += f"🏷️ Categoria: {categoria}\n"
+        # Classifica richiesta (se il flusso non ha già deciso la categoria)
+        if categoria is None:
+            categoria = self.classifica_richiesta(dati.get('problema_cod'),
+                                                  dati.get('urgenza'))
 
-        riepilogo += f"\n📱 Cliente: {numero_cliente}"
+        # SALVA NEL DATABASE: attende il commit solo per le categorie che
+        # lo richiedono (es: URGENTE, serve l'id per la notifica)
+        id_richiesta = self.officina.db.salva_richiesta(
+            numero_cliente,
+            dati,
+            categoria,
+            attendi=categoria in RICHIESTE_SINCRONE)
+        self.officina.storico.registra(
+            numero_cliente, {
+                'id': id_richiesta,
+                'auto': dati.get('auto'),
+                'problema': dati.get('problema'),
+                'categoria': categoria,
+                'data_richiesta': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            })
 
-        # NOTIFICA AL TITOLARE - PASSA CATEGORIA NON RIEPILOGO
+        # Le urgenze arrivano subito al titolare con una notifica push
         if categoria == 'URGENTE':
-            self.invia_notifica_titolare(numero_cliente, dati, categoria)
+            self.invia_notifica_titolare(numero_cliente, dati, categoria,
+                                         id_richiesta)
 
-        print(f"📱 Richiesta salvata: {categoria} - {dati.get('auto')}")
+        log.info("Conversazione chiusa",
+                 extra=campi(categoria=categoria,
+                             auto=dati.get('auto'),
+                             richiesta_id=id_richiesta))
 
-        # Resetta conversazione
-        del conversazioni[numero_cliente]
+        # Resetta conversazione (la rimuove gestisci_messaggio)
+        conv['chiusa'] = True
 
-        return "Perfetto, abbiamo preso in carico la tua richiesta 👍\nTi ricontatteremo al più presto su questo numero."
+        return self.flusso.chiusura
 
     def classifica_richiesta(self, problema_cod, urgenza):
         """Classifica la richiesta in URGENTE, MANUTENZIONE o PREVENTIVO"""
@@ -327,13 +3885,18 @@ class BotOfficina:
         else:
             return 'MANUTENZIONE'
 
-    def invia_notifica_titolare(self, numero_cliente, dati, categoria):
+    def invia_notifica_titolare(self,
+                                numero_cliente,
+                                dati,
+                                categoria,
+                                id_richiesta=None):
         """Invia notifica push all'app del titolare"""
 
         # Se è URGENTE, invia notifica push immediata
         if categoria == 'URGENTE':
             # Prepara dati per notifica
             richiesta_notifica = {
+                'id': id_richiesta,
                 'cliente': numero_cliente,
                 'auto': dati.get('auto'),
                 'urgenza': dati.get('urgenza'),
@@ -341,24 +3904,18 @@ class BotOfficina:
             }
             self.invia_push_notification(richiesta_notifica)
 
-        print(f"📱 Notifica inviata: {categoria} - {dati.get('auto')}")
+        log.debug("Notifica accodata",
+                  extra=campi(categoria=categoria, auto=dati.get('auto')))
 
     def invia_push_notification(self, richiesta):
-        """Invia notifica push Firebase all'app mobile"""
+        """Accoda la notifica push Firebase per l'app mobile"""
 
         if not FIREBASE_SERVER_KEY:
-            print("⚠️ Firebase non configurato - notifica simulata")
+            log.warning("Firebase non configurato: notifica simulata")
             return
 
-        url = "https://fcm.googleapis.com/fcm/send"
-
-        headers = {
-            "Authorization": f"Bearer {FIREBASE_SERVER_KEY}",
-            "Content-Type": "application/json"
-        }
-
         payload = {
-            "to": "/topics/titolare_officina",
+            "to": self.officina.topic_push,
             "priority": "high",
             "notification": {
                 "title": "🚨 URGENZA",
@@ -369,54 +3926,524 @@ class BotOfficina:
             "data": {
                 "cliente": richiesta['cliente'],
                 "categoria": richiesta['categoria'],
+                "officina": self.officina.id,
                 "click_action": "OPEN_URGENZE"
             }
         }
 
+        # Una sola notifica per richiesta, anche se la chiusura si ripete.
+        # Il ritardo apre la finestra in cui le urgenze vengono raggruppate
+        chiave = (f"push:{self.officina.id}:{richiesta['id']}"
+                  if richiesta.get('id') else None)
         try:
-            response = requests.post(url, headers=headers, json=payload)
-            print(f"✅ Notifica inviata: {response.status_code}")
+            coda_invii.accoda('push',
+                              payload,
+                              chiave,
+                              ritardo=FCM_FINESTRA,
+                              gruppo=payload['to'],
+                              officina=self.officina.id)
         except Exception as e:
-            print(f"❌ Errore notifica: {e}")
+            log.exception("Errore accodamento notifica")
+
+
+# ==================== OFFICINE (MULTI-TENANT) ====================
+
+# Messaggio al cliente quando l'auto è pronta (sovrascrivibile per officina)
+MESSAGGIO_COMPLETATO = "🚗 La sua auto è pronta per il ritiro.\nGrazie per aver scelto la nostra officina!"
+
+
+def normalizza_numero(numero):
+    """Numero WhatsApp senza prefisso 'whatsapp:' e spazi, per i confronti"""
+    return (numero or '').replace('whatsapp:', '').replace(' ', '')
+
+
+class Officina:
+    """Una officina servita dal deployment: numero WhatsApp, dati e bot.
+
+    Richieste, conversazioni ed eventi stanno nel database dell'officina:
+    le scritture di un'officina molto attiva non prendono il lock di
+    scrittura degli altri file. Outbox, rate limiting e metriche restano
+    nel database principale (DB_PATH), comuni a tutte.
+    """
+
+    def __init__(self, configurazione, database, flusso):
+        self.id = configurazione['id']
+        self.nome = configurazione.get('nome', self.id)
+        # Mittente degli invii Twilio, sempre nella forma whatsapp:+39...
+        numero = normalizza_numero(
+            configurazione.get('numero_whatsapp') or TWILIO_WHATSAPP_NUMBER)
+        self.numero_whatsapp = f'whatsapp:{numero}' if numero else None
+        self.topic_push = configurazione.get('topic_push', FCM_TOPIC)
+        self.messaggio_completato = configurazione.get(
+            'messaggio_completato', MESSAGGIO_COMPLETATO)
+        self.db = database
+        self.conversazioni = crea_archivio_conversazioni(database)
+        self.eventi = BusEventi(database)
+        self.riepiloghi = RiepiloghiRichieste(database)
+        self.ricerca = RicercaRichieste(database)
+        self.storico = StoricoClienti(database)
+        self.archivio = ArchivioRichieste(self)
+        self.campagne = CampagneOfficina(self)
+        self.bot = BotOfficina(self, flusso)
+
+
+class RegistroOfficine:
+    """Configurazione delle officine, letta e validata una volta all'avvio.
+
+    Il numero Twilio `To` del webhook individua l'officina, l'app del
+    titolare la indica per id. Database, archivio conversazioni e bot
+    vengono aperti al primo uso: un deployment con cento officine non apre
+    cento file in ogni worker se ne lavorano solo dieci.
+    """
+
+    def __init__(self, configurazioni, database_principale=None):
+        self.database_principale = database_principale
+        self._configurazioni = {}
+        self._flussi = {}
+        self._per_numero = {}
+        percorsi = set()
+        for configurazione in configurazioni:
+            id_officina = configurazione['id']
+            if id_officina in self._configurazioni:
+                raise ValueError(f"Officina '{id_officina}' ripetuta")
+            percorso = os.path.abspath(
+                configurazione.get('database')
+                or os.path.join(OFFICINE_DB_DIR, f'{id_officina}.db'))
+            # Un file condiviso mescolerebbe i dati di due officine
+            if percorso in percorsi:
+                raise ValueError(
+                    f"Officina '{id_officina}': database {percorso} già usato")
+            percorsi.add(percorso)
+            self._configurazioni[id_officina] = dict(configurazione,
+                                                     database=percorso)
+            # Flusso compilato subito: un errore di configurazione ferma
+            # l'avvio invece del primo messaggio
+            self._flussi[id_officina] = FlussoCompilato(
+                self._definizione_flusso(configurazione))
+            numero = normalizza_numero(configurazione.get('numero_whatsapp'))
+            if numero:
+                self._per_numero[numero] = id_officina
+        self._aperte = {}
+        self._lock = threading.Lock()
+        # Lavori di fondo delle officine (archivio, campagne); no nella CLI
+        self.lavori_di_fondo = True
+
+    @staticmethod
+    def _definizione_flusso(configurazione):
+        """Flusso dell'officina: file o dizionario in 'flusso' (altrimenti
+        quello comune), con introduzione/chiusura/errore/stessa_auto
+        personalizzabili"""
+        flusso = configurazione.get('flusso')
+        if not isinstance(flusso, dict):
+            flusso = carica_flusso(flusso)
+        testi = {
+            chiave: configurazione[chiave]
+            for chiave in ('introduzione', 'chiusura', 'errore',
+                           'stessa_auto')
+            if chiave in configurazione
+        }
+        return dict(flusso, **testi)
+
+    def officina(self, id_officina):
+        """Officina con questo id (aperta al primo uso), None se non esiste"""
+        officina = self._aperte.get(id_officina)
+        if officina is None and id_officina in self._configurazioni:
+            with self._lock:
+                officina = self._aperte.get(id_officina)
+                if officina is None:
+                    officina = self._apri(id_officina)
+                    self._aperte[id_officina] = officina
+        if officina is not None and self.lavori_di_fondo:
+            # Avviati nel processo che usa l'officina
+            officina.archivio.avvia()
+            officina.campagne.riprendi()
+        return officina
+
+    def da_numero(self, numero):
+        """Officina a cui è arrivato un messaggio (parametro `To` di
+        Twilio); con una sola officina è sempre quella"""
+        id_officina = self._per_numero.get(normalizza_numero(numero))
+        if id_officina is None:
+            return self.predefinita
+        return self.officina(id_officina)
+
+    @property
+    def predefinita(self):
+        """L'unica officina configurata, None se ce n'è più d'una"""
+        if len(self._configurazioni) != 1:
+            return None
+        return self.officina(next(iter(self._configurazioni)))
+
+    def _apri(self, id_officina):
+        configurazione = self._configurazioni[id_officina]
+        percorso = configurazione['database']
+        principale = self.database_principale
+        if principale and os.path.abspath(principale.db_path) == percorso:
+            database = principale
+        else:
+            os.makedirs(os.path.dirname(percorso), exist_ok=True)
+            database = DatabaseRichieste(percorso)
+        log.info("Officina aperta",
+                 extra=campi(officina=id_officina, database=percorso))
+        return Officina(configurazione, database, self._flussi[id_officina])
+
+    def aperte(self):
+        """Officine già aperte da questo processo"""
+        return list(self._aperte.values())
+
+    def __len__(self):
+        return len(self._configurazioni)
+
+    def __contains__(self, id_officina):
+        return id_officina in self._configurazioni
+
+
+# Formato di OFFICINE_PATH: una lista di officine, es:
+# [{"id": "rossi", "nome": "Officina Rossi",
+#   "numero_whatsapp": "whatsapp:+390212345678",
+#   "topic_push": "/topics/officina_rossi",
+#   "flusso": "flussi/rossi.json",
+#   "introduzione": "Ciao 👋 Sono l'assistente di Officina Rossi.",
+#   "messaggio_completato": "La sua auto è pronta!"}]
+# Obbligatori solo id e numero_whatsapp; "database" sceglie il file SQLite
+# (default OFFICINE_DB_DIR/<id>.db). Le credenziali Twilio e Firebase sono
+# quelle del deployment, comuni a tutte le officine.
+def carica_officine():
+    """Legge le officine da OFFICINE_PATH (lista JSON) o ne configura una
+    sola dalle variabili d'ambiente, sul database principale"""
+    if OFFICINE_PATH:
+        with open(OFFICINE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    return [{
+        'id': 'officina',
+        'numero_whatsapp': TWILIO_WHATSAPP_NUMBER,
+        'database': DB_PATH
+    }]
+
+
+# Inizializza database principale (schema creato una volta all'avvio) e
+# officine
+
+db = DatabaseRichieste()
+coda_invii = CodaInvii(db, OUTBOX_WORKER, OUTBOX_MAX_TENTATIVI)
+coda_invii.registra('whatsapp', invia_whatsapp)
+notificatore = NotificatorePush(FCM_URL, HTTP_TIMEOUT, FCM_AL_SECONDO,
+                                FCM_BURST, OUTBOX_WORKER)
+coda_invii.registra('push', notificatore.invia, raggruppa=True)
+officine = RegistroOfficine(carica_officine(), db)
+metriche.collega(db)
+metriche.registra_gauge(
+    'conversazioni_attive', 'Conversazioni in corso per officina',
+    lambda: {(('officina', officina.id), ): len(officina.conversazioni)
+             for officina in officine.aperte()})
+metriche.registra_gauge(
+    'outbox_invii', 'Invii nella coda per stato', lambda: {
+        (('stato', stato), ): n
+        for stato, n in coda_invii.conteggi().items()
+    })
+metriche.registra_gauge(
+    'conversazioni_eventi', 'Hit/miss/espulsioni dell\'archivio conversazioni',
+    lambda: {(('officina', officina.id), ('tipo', chiave)): valore
+             for officina in officine.aperte()
+             for chiave, valore in officina.conversazioni.statistiche().items()
+             if chiave in ('hit', 'miss', 'espulse', 'scadute')})
+metriche.registra_gauge(
+    'storico_clienti_eventi', 'Hit/miss/espulsioni della cache dei profili '
+    'dei clienti per officina',
+    lambda: {(('officina', officina.id), ('tipo', chiave)): valore
+             for officina in officine.aperte()
+             for chiave, valore in officina.storico.statistiche().items()
+             if chiave in ('hit', 'miss', 'espulse')})
+metriche.registra_gauge(
+    'database_righe_richieste',
+    'Righe della tabella richieste per officina (ultima misura '
+    'dell\'archiviazione)',
+    lambda: {(('officina', officina.id), ): officina.archivio.misure['righe']
+             for officina in officine.aperte() if officina.archivio.misure})
+metriche.registra_gauge(
+    'database_byte', 'Dimensione del database per officina: totale e pagine '
+    'libere', lambda: {(('officina', officina.id), ('tipo', tipo)):
+                       officina.archivio.misure[chiave]
+                       for officina in officine.aperte()
+                       if officina.archivio.misure
+                       for tipo, chiave in (('totale', 'byte'),
+                                            ('liberi', 'byte_liberi'))})
+metriche.registra_gauge(
+    'database_prima_pagina_secondi',
+    'Latenza della prima pagina di /api/richieste misurata a ogni giro '
+    'dell\'archiviazione', lambda: {
+        (('officina', officina.id), ):
+        officina.archivio.misure['prima_pagina_secondi']
+        for officina in officine.aperte() if officina.archivio.misure
+    })
+metriche.registra_gauge(
+    'limiti_eventi', 'Controlli del rate limiting per limitatore ed esito',
+    lambda: {(('limitatore', nome), ('esito', chiave)): valore
+             for nome, limitatore in (('numeri', limite_numeri),
+                                      ('ip', limite_ip))
+             for chiave, valore in limitatore.statistiche().items()})
+metriche.registra_gauge(
+    'eventi_clienti_connessi',
+    'Client in attesa sul change feed (SSE/long-poll) per officina',
+    lambda: {(('officina', officina.id), ): officina.eventi.clienti
+             for officina in officine.aperte()})
+
+# ==================== SICUREZZA WEBHOOK ====================
+
+
+class ValidatoreTwilio:
+    """Verifica dell'header X-Twilio-Signature (HMAC-SHA1 di URL + parametri).
+
+    Lo stato HMAC con la chiave (auth token) è calcolato una sola volta:
+    per ogni richiesta si copia e si aggiungono solo URL e parametri.
+    """
+
+    def __init__(self, auth_token):
+        self._hmac = hmac.new(auth_token.encode(), digestmod=hashlib.sha1)
+
+    def firma(self, url, parametri):
+        """Firma attesa per un URL e i parametri POST (MultiDict)"""
+        mac = self._hmac.copy()
+        mac.update(url.encode())
+        for chiave in sorted(parametri.keys()):
+            for valore in sorted(set(parametri.getlist(chiave))):
+                mac.update((chiave + valore).encode())
+        return base64.b64encode(mac.digest()).decode()
+
+    def valida(self, url, parametri, firma):
+        """True se la firma corrisponde all'URL, con o senza porta esplicita
+        (Twilio non è coerente su questo punto)"""
+        if not firma:
+            return False
+        if hmac.compare_digest(self.firma(url, parametri), firma):
+            return True
+        alternativo = _url_porta_alternativa(url)
+        return alternativo is not None and hmac.compare_digest(
+            self.firma(alternativo, parametri), firma)
+
+
+def _url_porta_alternativa(url):
+    """Lo stesso URL con la porta standard aggiunta o tolta"""
+    parti = urlsplit(url)
+    porta = {'https': 443, 'http': 80}.get(parti.scheme)
+    if porta is None:
+        return None
+    host = parti.hostname or ''
+    netloc = host if parti.port else f'{host}:{porta}'
+    return urlunsplit(parti._replace(netloc=netloc))
+
+
+def url_webhook(url=None, protocollo=None):
+    """URL pubblico chiamato da Twilio (quello usato per la firma).
 
-    def visualizza_richieste_titolare():
-        """Funzione per mostrare le richieste al titolare"""
-        db = DatabaseRichieste()
+    Senza argomenti usa la richiesta Flask corrente; `protocollo` è
+    l'header X-Forwarded-Proto.
+    """
+    if TWILIO_WEBHOOK_URL:
+        return TWILIO_WEBHOOK_URL
+    if url is None:
+        url = request.url
+        protocollo = request.headers.get('X-Forwarded-Proto')
+    # Dietro il proxy di Cloud Run l'app vede http: Twilio ha firmato https
+    if protocollo and not url.startswith(protocollo + '://'):
+        url = protocollo + url[url.index('://'):]
+    return url
 
-        # Mostra solo le nuove
-        richieste_nuove = db.leggi_richieste_nuove()
 
-        print(f"\n{'='*50}")
-        print(f"📋 RICHIESTE NUOVE: {len(richieste_nuove)}")
-        print(f"{'='*50}\n")
+class CacheMessaggi:
+    """Ultimi MessageSid elaborati con la risposta data, per rispondere ai
+    retry di Twilio senza far avanzare di nuovo la conversazione.
 
-        for richiesta in richieste_nuove:
-            id_r, numero, auto, problema, urgenza, spie, orario, intervento, diagnosi, categoria, data, stato = richiesta
+    Limitata a `dimensione` voci (LRU) e `ttl` secondi.
+    """
 
-            print(f"ID: {id_r}")
-            print(f"📱 Cliente: {numero}")
-            print(f"🚗 Auto: {auto}")
-            print(f"❗ Problema: {problema}")
+    def __init__(self, dimensione, ttl):
+        self.dimensione = dimensione
+        self.ttl = ttl
+        self._voci = OrderedDict()  # sid -> (scadenza, risposta)
+        self._lock = threading.Lock()
+        self.duplicati = 0
 
-            if urgenza:
-                print(f"🚨 Urgenza: {urgenza}")
-            if spie:
-                print(f"💡 Spie: {spie}")
-            if orario:
-                print(f"🕐 Orario: {orario}")
-            if intervento:
-                print(f"🔧 Intervento: {intervento}")
-            if diagnosi:
-                print(f"📋 Diagnosi: {diagnosi}")
+    def leggi(self, sid):
+        """Risposta già data per questo sid, o None"""
+        with self._lock:
+            voce = self._voci.get(sid)
+            if voce is None or voce[0] < time.time():
+                return None
+            self.duplicati += 1
+            return voce[1]
 
-                print(f"🏷️ {categoria}")
-                print(f"📅 Data: {data}")
-                print(f"{'-'*50}\n")
+    def salva(self, sid, risposta):
+        with self._lock:
+            self._voci[sid] = (time.time() + self.ttl, risposta)
+            self._voci.move_to_end(sid)
+            while len(self._voci) > self.dimensione:
+                self._voci.popitem(last=False)
 
 
-# Inizializza bot
+class LimitatoreMemoria:
+    """Rate limiting a token bucket per chiave (numero cliente, IP).
+
+    Un bucket inattivo abbastanza a lungo da essersi ricaricato equivale a
+    uno nuovo, quindi i bucket sono tenuti in ordine LRU ed espulsi oltre
+    `max_chiavi`: memoria limitata e controllo O(1).
+    """
+
+    bloccante = False  # consenti() non fa I/O
+
+    def __init__(self, al_minuto, burst, max_chiavi=50000):
+        self.al_secondo = al_minuto / 60
+        self.burst = burst
+        self.max_chiavi = max_chiavi
+        self._bucket = OrderedDict()
+        self._lock = threading.Lock()
+        self._contatori = Counter()
+
+    def consenti(self, chiave):
+        """True se la chiave ha ancora token (e ne consuma uno)"""
+        with self._lock:
+            bucket = self._bucket.get(chiave)
+            if bucket is None:
+                bucket = self._bucket[chiave] = TokenBucket(
+                    self.al_secondo, self.burst)
+                if len(self._bucket) > self.max_chiavi:
+                    self._bucket.popitem(last=False)
+                    self._contatori['espulse'] += 1
+            else:
+                self._bucket.move_to_end(chiave)
+        consentito = bucket.consuma() == 0
+        self._contatori['consentite' if consentito else 'bloccate'] += 1
+        return consentito
+
+    def statistiche(self):
+        return dict(self._contatori, chiavi=len(self._bucket))
+
+
+class LimitatoreSQLite:
+    """Rate limiting a token bucket condiviso tra i worker tramite SQLite.
+
+    Ogni controllo è una transazione su una riga (chiave primaria); i
+    bucket inattivi da più di `inattivita` secondi vengono cancellati
+    periodicamente.
+    """
+
+    INTERVALLO_PULIZIA = 60  # secondi tra due pulizie
+
+    # consenti() aspetta il lock di scrittura (fino a DB_BUSY_TIMEOUT)
+    bloccante = True
+
+    SQL_LEGGI = 'SELECT token, ultimo FROM limiti WHERE chiave = ?'
+
+    SQL_SALVA = '''
+        INSERT INTO limiti (chiave, token, ultimo) VALUES (?, ?, ?)
+        ON CONFLICT (chiave) DO UPDATE
+        SET token = excluded.token, ultimo = excluded.ultimo
+    '''
+
+    SQL_PULISCI = 'DELETE FROM limiti WHERE ultimo < ?'
+
+    def __init__(self, database, al_minuto, burst):
+        self.database = database
+        self.al_secondo = al_minuto / 60
+        self.burst = burst
+        # Dopo questo tempo un bucket è di nuovo pieno: inutile tenerlo
+        self.inattivita = burst / self.al_secondo
+        self._contatori = Counter()
+        self._prossima_pulizia = 0
+        with database.connessione() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS limiti (
+                    chiave TEXT PRIMARY KEY,
+                    token REAL NOT NULL,
+                    ultimo REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_limiti_ultimo
+                ON limiti (ultimo)
+            ''')
+
+    def consenti(self, chiave):
+        """True se la chiave ha ancora token (e ne consuma uno)"""
+        adesso = time.time()
+        conn = self.database.connessione()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            riga = conn.execute(self.SQL_LEGGI, (chiave, )).fetchone()
+            token = self.burst
+            if riga:
+                token = min(self.burst,
+                            riga[0] + (adesso - riga[1]) * self.al_secondo)
+            consentito = token >= 1
+            if consentito:
+                token -= 1
+            conn.execute(self.SQL_SALVA, (chiave, token, adesso))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+        if adesso >= self._prossima_pulizia:
+            self._prossima_pulizia = adesso + self.INTERVALLO_PULIZIA
+            self._contatori['espulse'] += self.database._scrivi(
+                self.SQL_PULISCI, (adesso - self.inattivita, )).rowcount
+        self._contatori['consentite' if consentito else 'bloccate'] += 1
+        return consentito
+
+    def statistiche(self):
+        return dict(self._contatori)
+
+
+def crea_limitatore(database, al_minuto, burst):
+    """Sceglie il backend del rate limiting in base a LIMITE_BACKEND"""
+    if LIMITE_BACKEND == 'memoria':
+        return LimitatoreMemoria(al_minuto, burst)
+    if LIMITE_BACKEND == 'sqlite':
+        return LimitatoreSQLite(database, al_minuto, burst)
+    raise ValueError(f"LIMITE_BACKEND non valido: {LIMITE_BACKEND}")
+
+
+validatore_twilio = (ValidatoreTwilio(TWILIO_AUTH_TOKEN)
+                     if TWILIO_AUTH_TOKEN and TWILIO_VALIDA_FIRMA else None)
+messaggi_elaborati = CacheMessaggi(dimensione=10000, ttl=3600)
+limite_numeri = crea_limitatore(db, LIMITE_NUMERO_AL_MINUTO,
+                                LIMITE_NUMERO_BURST)
+limite_ip = crea_limitatore(db, LIMITE_IP_AL_MINUTO, LIMITE_IP_BURST)
+
+# ==================== STRUMENTAZIONE HTTP ====================
+
+
+@app.before_request
+def inizio_richiesta():
+    # Thread di fondo avviati alla prima richiesta di ogni processo: niente
+    # thread nel master di gunicorn --preload prima del fork
+    metriche.avvia()
+    coda_invii.avvia()
+    request.environ['officina.inizio'] = time.perf_counter()
+
+
+@app.after_request
+def fine_richiesta(risposta):
+    inizio = request.environ.get('officina.inizio')
+    if inizio is not None:
+        route = request.url_rule.rule if request.url_rule else 'sconosciuta'
+        metriche.osserva('http_durata_secondi',
+                         time.perf_counter() - inizio, (('route', route), ))
+        metriche.incrementa('http_richieste_totale',
+                            (('route', route), ('metodo', request.method),
+                             ('stato', str(risposta.status_code))))
+    # Il thread servirà altre richieste: niente correlazione residua
+    contesto_log.set(None)
+    return risposta
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metriche in formato Prometheus (somma di tutti i worker)"""
+    return metriche.esporta(), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    }
 
-bot = BotOfficina()
 
 # ==================== WEBHOOK WHATSAPP ====================
 
@@ -424,116 +4451,713 @@ bot = BotOfficina()
 @app.route('/webhook/whatsapp', methods=['POST'])
 def webhook_whatsapp():
     """Riceve messaggi WhatsApp da Twilio"""
+    officina = officine.da_numero(request.form.get('To'))
+    return controlla_webhook(
+        officina,
+        ip_client(request.headers.get('X-Forwarded-For'),
+                  request.remote_addr), url_webhook, request.form,
+        request.headers.get('X-Twilio-Signature')) or rispondi_webhook(
+            officina, request.form)
+
+
+def ip_client(inoltrato, remoto):
+    """IP del client per il rate limiting, come ProxyFix(x_for=PROXY_FIDATI).
+
+    Il client può scrivere quello che vuole in X-Forwarded-For: conta solo
+    la voce aggiunta dal più esterno dei proxy fidati (contando da destra).
+    Se la catena è più corta del previsto si usa l'indirizzo della
+    connessione.
+    """
+    if PROXY_FIDATI and inoltrato:
+        voci = [voce.strip() for voce in inoltrato.split(',')]
+        if len(voci) >= PROXY_FIDATI and voci[-PROXY_FIDATI]:
+            return voci[-PROXY_FIDATI]
+    return remoto or ''
+
+
+def controlla_webhook(officina, ip, url, form, firma):
+    """Controlli prima del bot: rate limiting, firma, officina, retry di
+    Twilio.
+
+    `officina` è quella del numero `To` (None se il numero non è di
+    nessuna officina); `url` è una funzione che ritorna l'URL firmato
+    (calcolato solo se la firma va verificata). Ritorna (corpo, stato) se
+    la richiesta finisce qui, altrimenti None e il messaggio va passato a
+    rispondi_webhook. Fa I/O bloccante solo se uno dei limitatori è
+    `bloccante` (LIMITE_BACKEND=sqlite): asgi.py allora la chiama nel pool
+    di thread invece che nell'event loop.
+    """
+    # Flood da un singolo indirizzo (visto dal proxy fidato, ip_client)
+    if not limite_ip.consenti(f"ip:{ip}"):
+        return twiml_risposta(), 429
+
+    # Scarta le richieste non firmate da Twilio
+    if validatore_twilio and not validatore_twilio.valida(url(), form, firma):
+        log.warning("Firma Twilio non valida: richiesta scartata",
+                    extra=campi(ip=ip))
+        return 'Firma non valida', 403
+
+    # Numero Twilio non associato a nessuna officina
+    if officina is None:
+        log.warning("Messaggio per un numero senza officina",
+                    extra=campi(numero=form.get('To')))
+        return twiml_risposta(), 404
 
     # Estrai dati da Twilio
-    numero_cliente = request.form.get('From')  # es:    whatsapp:+393331234567
-    messaggio = request.form.get('Body', '').strip()
+    numero_cliente = form.get('From')  # es:    whatsapp:+393331234567
+    message_sid = form.get('MessageSid')
+    contesto_log.set({
+        'message_sid': message_sid,
+        'cliente': numero_cliente,
+        'officina': officina.id
+    })
 
-    print(f"📩 Messaggio da {numero_cliente}: {messaggio}")
+    # Retry di Twilio per un messaggio già elaborato: stessa risposta
+    risposta_bot = messaggi_elaborati.leggi(message_sid) if message_sid else None
+    if risposta_bot is not None:
+        return twiml_risposta(risposta_bot), 200
+
+    # Troppi messaggi dallo stesso numero: nessuna risposta
+    if not limite_numeri.consenti(f"numero:{officina.id}:{numero_cliente}"):
+        log.warning("Limite messaggi superato")
+        return twiml_risposta(), 429
+    return None
+
+
+def rispondi_webhook(officina, form):
+    """Passa il messaggio al bot dell'officina e ritorna il TwiML della
+    risposta"""
+    numero_cliente = form.get('From')
+    messaggio = form.get('Body', '').strip()
+    message_sid = form.get('MessageSid')
+
+    debug_campionato("Messaggio ricevuto", testo=messaggio)
 
     # Processa con il bot
-    risposta_bot = bot.gestisci_messaggio(numero_cliente, messaggio)
+    risposta_bot = officina.bot.gestisci_messaggio(numero_cliente, messaggio,
+                                                   message_sid)
+    if message_sid:
+        messaggi_elaborati.salva(message_sid, risposta_bot)
+    return twiml_risposta(risposta_bot)
 
-    # Invia risposta su WhatsApp
-    twiml = MessagingResponse()
-    twiml.message(risposta_bot)
 
+def twiml_risposta(testo=None):
+    """Risposta su WhatsApp in formato TwiML (vuota senza testo)"""
+    from twilio.twiml.messaging_response import MessagingResponse
+    twiml = MessagingResponse()
+    if testo is not None:
+        twiml.message(testo)
     return str(twiml)
 
 
+# ==================== CACHE LETTURE (ETAG) ====================
+
+
+class CacheRisposte:
+    """Risposte delle letture dell'app del titolare, valide finché non
+    cambia la versione dei dati dell'officina (BusEventi.versione).
+
+    La chiave è officina + route + parametri: un poll che trova la stessa
+    versione riusa il corpo già serializzato invece di rifare query e
+    JSON. LRU limitata a `capacita` byte di corpi, per worker.
+    """
+
+    def __init__(self, capacita):
+        self.capacita = capacita
+        self._voci = OrderedDict()  # chiave -> (versione, valore, byte)
+        self._byte = 0
+        self._lock = threading.Lock()
+
+    def leggi(self, chiave, versione):
+        """Valore salvato per questa chiave e versione, o None"""
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None or voce[0] != versione:
+                return None
+            self._voci.move_to_end(chiave)
+            return voce[1]
+
+    def salva(self, chiave, versione, valore, byte=0):
+        # Un corpo enorme svuoterebbe la cache per una sola voce
+        if byte > self.capacita // 4:
+            return
+        with self._lock:
+            vecchia = self._voci.get(chiave)
+            if vecchia is not None:
+                # Un altro thread ha già salvato dati più nuovi
+                if vecchia[0] > versione:
+                    return
+                self._byte -= vecchia[2]
+            self._voci[chiave] = (versione, valore, byte)
+            self._voci.move_to_end(chiave)
+            self._byte += byte
+            while self._byte > self.capacita:
+                _, (_, _, tolti) = self._voci.popitem(last=False)
+                self._byte -= tolti
+
+
+cache_risposte = CacheRisposte(CACHE_RISPOSTE_BYTE)
+
+
+def risposta_versionata(officina, crea):
+    """Risposta di una lettura con ETag legato alla versione dei dati
+    dell'officina, per route e parametri della richiesta Flask corrente.
+
+    Se If-None-Match contiene l'ETag attuale risponde 304 senza query né
+    JSON; altrimenti riusa il corpo in cache o chiama crea() (che ritorna
+    come una view Flask). Solo le risposte 200 vanno in cache.
+    """
+    chiave = (officina.id, request.path,
+              tuple(sorted(request.args.items(multi=True))))
+    # Versione letta prima dei dati: un corpo può essere più nuovo del suo
+    # ETag (al poll dopo si rilegge), mai più vecchio
+    versione = officina.eventi.versione()
+    firma = hashlib.sha1(repr(chiave).encode()).hexdigest()[:16]
+    etag = f'{versione}-{firma}'
+
+    if request.if_none_match.contains_weak(etag):
+        esito = 'non_modificata'
+        risposta = app.response_class(status=304)
+    else:
+        voce = cache_risposte.leggi(chiave, versione)
+        if voce is not None:
+            esito = 'hit'
+            corpo, intestazioni = voce
+            risposta = app.response_class(corpo,
+                                          mimetype='application/json',
+                                          headers=intestazioni)
+        else:
+            esito = 'miss'
+            risposta = make_response(crea())
+            if risposta.status_code != 200:
+                return risposta
+            corpo = risposta.get_data()
+            # Le intestazioni dell'API (cursore, ultimo id) vanno col corpo
+            intestazioni = {
+                nome: valore
+                for nome, valore in risposta.headers.items()
+                if nome.startswith('X-')
+            }
+            cache_risposte.salva(chiave, versione, (corpo, intestazioni),
+                                 len(corpo))
+
+    metriche.incrementa('cache_risposte_totale',
+                        (('route', request.url_rule.rule), ('esito', esito)))
+    risposta.set_etag(etag)
+    # Il client può tenere la risposta ma deve sempre rivalidarla
+    risposta.headers['Cache-Control'] = 'private, no-cache'
+    return risposta
+
+
 # ==================== API PER APP MOBILE ====================
 
 
+def scegli_officina(id_officina):
+    """Officina indicata dall'app del titolare; con una sola officina l'id
+    si può omettere. Ritorna (officina, None) oppure (None, (corpo JSON,
+    stato HTTP))"""
+    if not id_officina:
+        officina = officine.predefinita
+        if officina is None:
+            return None, ({
+                'error': 'Officina non indicata (header X-Officina)'
+            }, 400)
+        return officina, None
+    officina = officine.officina(id_officina)
+    if officina is None:
+        return None, ({'error': 'Officina non trovata'}, 404)
+    return officina, None
+
+
+def officina_richiesta():
+    """Officina della richiesta Flask corrente: header X-Officina o
+    ?officina= (EventSource non può mandare header); interrompe la
+    richiesta con 400/404 se manca o non esiste"""
+    officina, errore = scegli_officina(
+        request.headers.get('X-Officina') or request.args.get('officina'))
+    if officina is None:
+        corpo, stato = errore
+        abort(make_response(jsonify(corpo), stato))
+    return officina
+
+
+def codifica_cursore(cursore):
+    """Trasforma (data_richiesta, id) in un token opaco per l'app"""
+    data_richiesta, id_richiesta = cursore
+    testo = f"{data_richiesta}|{id_richiesta}"
+    return base64.urlsafe_b64encode(testo.encode()).decode()
+
+
+def decodifica_cursore(token):
+    """Inverso di codifica_cursore, solleva ValueError se il token è invalido"""
+    try:
+        data_richiesta, id_richiesta = base64.urlsafe_b64decode(
+            token.encode()).decode().rsplit('|', 1)
+        return data_richiesta, int(id_richiesta)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Cursore non valido: {token}") from e
+
+
+def leggi_campi(valore):
+    """Colonne richieste con ?campi= (tutte se assente), senza ripetizioni e
+    nell'ordine indicato; solleva ValueError se ce ne sono di sconosciute"""
+    if not valore:
+        return DatabaseRichieste.COLONNE
+    campi = tuple(dict.fromkeys(c.strip() for c in valore.split(',')))
+    sconosciuti = [c for c in campi if c not in DatabaseRichieste.COLONNE]
+    if sconosciuti:
+        raise ValueError(f"Campi sconosciuti: {', '.join(sconosciuti)}")
+    return campi
+
+
 @app.route('/api/richieste', methods=['GET'])
 def get_richieste():
-    """Ritorna tutte le richieste per l’app del titolare"""
+    """Ritorna le richieste per l’app del titolare, una pagina alla volta.
 
-    categoria = request.args.get(
-        'categoria')  # URGENTE, APPUNTAMENTO,      PREVENTIVO
-    stato = request.args.get('stato')  # nuova, risposta, completata
+    Parametri opzionali:
+        officina   id dell'officina (o header X-Officina)
+        categoria  URGENTE, MANUTENZIONE, PREVENTIVO
+        stato      nuova, risposta, completata
+        campi      colonne da restituire, separate da virgola
+        cursore    token X-Cursore-Successivo della pagina precedente
+        since      solo richieste con id maggiore (header X-Ultimo-Id)
+        limite     righe per pagina (default 100, massimo 500)
 
-    richieste_filtrate = richieste
+    Con If-None-Match risponde 304 se nessuna richiesta è cambiata
+    dall'ETag ricevuto.
+    """
+    officina = officina_richiesta()
+    return risposta_versionata(officina, lambda: _pagina_richieste(officina))
 
-    if categoria:
-        richieste_filtrate = [
-            r for r in richieste_filtrate if r['categoria'] == categoria
-        ]
 
-    if stato:
-        richieste_filtrate = [
-            r for r in richieste_filtrate if r['stato'] == stato
-        ]
+def _pagina_richieste(officina):
+    categoria = request.args.get('categoria')
+    stato = request.args.get('stato')
+
+    try:
+        campi = leggi_campi(request.args.get('campi'))
+        limite = min(int(request.args.get('limite', 100)), 500)
+        since = request.args.get('since')
+        since = int(since) if since else None
+        dopo = None
+        if request.args.get('cursore'):
+            dopo = decodifica_cursore(request.args['cursore'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    righe, cursore = officina.db.cerca_richieste(categoria=categoria,
+                                                 stato=stato,
+                                                 campi=campi,
+                                                 dopo=dopo,
+                                                 since=since,
+                                                 limite=max(limite, 1))
 
-    return jsonify(richieste_filtrate)
+    risposta = jsonify(righe)
+    if cursore:
+        risposta.headers['X-Cursore-Successivo'] = codifica_cursore(cursore)
+    ultimo_id = max([r['id'] for r in righe if 'id' in r] + [since or 0])
+    if ultimo_id:
+        risposta.headers['X-Ultimo-Id'] = str(ultimo_id)
+    return risposta
+
+
+@app.route('/api/richieste/<int:id_richiesta>', methods=['GET'])
+def get_richiesta(id_richiesta):
+    """Una singola richiesta (parametri opzionali officina e campi come in
+    /api/richieste); 304 se non è cambiato nulla dall'ETag ricevuto"""
+    officina = officina_richiesta()
+
+    def leggi():
+        try:
+            campi = leggi_campi(request.args.get('campi'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        richiesta = officina.db.leggi_richiesta(id_richiesta, campi)
+        if not richiesta:
+            return jsonify({'error': 'Richiesta non trovata'}), 404
+        return jsonify(richiesta)
+
+    return risposta_versionata(officina, leggi)
+
+
+@app.route('/api/richieste/esporta', methods=['GET'])
+def esporta_richieste():
+    """Tutte le richieste dell'officina in un file CSV o NDJSON.
+
+    Parametri opzionali:
+        officina   id dell'officina (o header X-Officina)
+        formato    csv (default) o ndjson
+        categoria  URGENTE, MANUTENZIONE, PREVENTIVO
+        stato      nuova, risposta, completata
+        dal, al    date AAAA-MM-GG (incluse) di data_richiesta
+        campi      colonne da esportare, separate da virgola
+
+    La risposta è in streaming: le righe partono a blocchi mentre vengono
+    lette, con memoria costante per qualunque dimensione della tabella.
+    Compressa in gzip se il client lo accetta (Accept-Encoding).
+    """
+    officina = officina_richiesta()
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATI_ESPORTAZIONE:
+        return jsonify({'error': f"Formato non valido: {formato}"}), 400
+    try:
+        campi = leggi_campi(request.args.get('campi'))
+        dal = leggi_data(request.args.get('dal'))
+        al = leggi_data(request.args.get('al'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    blocchi = officina.db.esporta(campi,
+                                  categoria=request.args.get('categoria'),
+                                  stato=request.args.get('stato'),
+                                  dal=dal,
+                                  al=al)
+    corpo = righe_esportate(blocchi, campi, formato)
+    intestazioni = {
+        'Content-Disposition':
+        f'attachment; filename="richieste-{officina.id}.{formato}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+        'Vary': 'Accept-Encoding'
+    }
+    if request.accept_encodings['gzip']:
+        corpo = comprimi(corpo)
+        intestazioni['Content-Encoding'] = 'gzip'
+
+    risposta = Response(corpo,
+                        content_type=FORMATI_ESPORTAZIONE[formato],
+                        headers=intestazioni)
+    # Client disconnesso a metà: la connessione dell'export si chiude subito
+    risposta.call_on_close(blocchi.close)
+    return risposta
+
+
+@app.route('/api/richieste/cerca', methods=['GET'])
+def ricerca_richieste():
+    """Ricerca per testo libero (auto, problema, spie, intervento,
+    diagnosi), dalla richiesta più pertinente.
+
+    Parametri:
+        q          testo da cercare, es: "panda spia olio" (obbligatorio)
+        officina   id dell'officina (o header X-Officina)
+        categoria  URGENTE, MANUTENZIONE, PREVENTIVO
+        stato      nuova, risposta, completata
+        campi      colonne da restituire, separate da virgola
+        limite     risultati (default 20, massimo 100)
+    """
+    officina = officina_richiesta()
+    try:
+        campi = leggi_campi(request.args.get('campi'))
+        limite = min(int(request.args.get('limite', 20)), 100)
+        risultati = officina.ricerca.cerca(request.args.get('q', ''),
+                                           request.args.get('categoria'),
+                                           request.args.get('stato'), campi,
+                                           max(limite, 1))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(risultati)
 
 
 @app.route('/api/risposta', methods=['POST'])
 def invia_risposta():
-    """Riceve risposta dal titolare e la invia al cliente su WhatsApp"""
+    """Riceve risposta dal titolare e la accoda per il cliente su WhatsApp"""
+    corpo, stato = accoda_risposta(officina_richiesta(), request.json,
+                                   request.headers.get('Idempotency-Key'))
+    return jsonify(corpo), stato
 
-    data = request.json
+
+def accoda_risposta(officina, data, chiave=None):
+    """Accoda la risposta del titolare; ritorna (corpo JSON, stato HTTP)"""
     richiesta_id = data.get('richiesta_id')
     messaggio_risposta = data.get('messaggio')
 
     # Trova richiesta
-    richiesta = next((r for r in richieste if r['id'] == richiesta_id), None)
+    richiesta = officina.db.leggi_richiesta(richiesta_id)
 
     if not richiesta:
-        return jsonify({'error': 'Richiesta non trovata'}), 404
+        return {'error': 'Richiesta non trovata'}, 404
 
-    if not twilio_client:
-        return jsonify({'error': 'Twilio non configurato'}), 500
+    if not TWILIO_CONFIGURATO:
+        return {'error': 'Twilio non configurato'}, 500
 
-    # Invia messaggio WhatsApp al cliente
+    # L'app può passare una propria chiave per evitare doppi invii sui retry
+    chiave = chiave or data.get('chiave_idempotenza')
+
+    # Accoda messaggio WhatsApp al cliente: la consegna avviene in background
     try:
-        message = twilio_client.messages.create(from_=TWILIO_WHATSAPP_NUMBER,
-                                                body=messaggio_risposta,
-                                                to=richiesta['cliente'])
+        id_invio = coda_invii.accoda(
+            'whatsapp', {
+                'from': officina.numero_whatsapp,
+                'to': richiesta['numero_cliente'],
+                'body': messaggio_risposta
+            },
+            f"risposta:{officina.id}:{richiesta_id}:{chiave}"
+            if chiave else None,
+            officina=officina.id)
 
         # Aggiorna stato richiesta
-        richiesta['stato'] = 'risposta'
-        richiesta['risposta'] = messaggio_risposta
-        richiesta['risposta_timestamp'] = datetime.now().isoformat()
+        officina.db.aggiorna_stato(richiesta_id, 'risposta')
 
-        print(f"✅ Risposta inviata a {richiesta['cliente']}")
+        log.info("Risposta accodata",
+                 extra=campi(richiesta_id=richiesta_id, invio_id=id_invio))
 
-        return jsonify({'success': True, 'message_sid': message.sid})
+        return {'success': True, 'invio_id': id_invio}, 202
 
     except Exception as e:
-        print(f"❌ Errore invio WhatsApp: {e}")
-        return jsonify({'error': str(e)}), 500
+        log.exception("Errore accodamento risposta WhatsApp")
+        return {'error': str(e)}, 500
 
 
 @app.route('/api/completa', methods=['POST'])
 def completa_richiesta():
-    """Segna richiesta come completata e invia messaggio automatico"""
+    """Segna richiesta come completata e accoda il messaggio automatico"""
+    corpo, stato = accoda_completamento(officina_richiesta(), request.json)
+    return jsonify(corpo), stato
 
-    data = request.json
+
+def accoda_completamento(officina, data):
+    """Completa la richiesta e accoda l'avviso al cliente; ritorna (corpo
+    JSON, stato HTTP)"""
     richiesta_id = data.get('richiesta_id')
 
-    richiesta = next((r for r in richieste if r['id'] == richiesta_id), None)
+    richiesta = officina.db.leggi_richiesta(richiesta_id)
 
     if not richiesta:
-        return jsonify({'error': 'Richiesta non trovata'}), 404
+        return {'error': 'Richiesta non trovata'}, 404
+
+    try:
+        if not TWILIO_CONFIGURATO:
+            log.warning("Twilio non configurato: impossibile inviare messaggio")
+            return {'error': 'Twilio non configurato'}, 500
+
+        # Chiave fissa: completare due volte non manda due messaggi
+        id_invio = coda_invii.accoda(
+            'whatsapp', {
+                'from': officina.numero_whatsapp,
+                'to': richiesta['numero_cliente'],
+                'body': officina.messaggio_completato
+            },
+            f"completa:{officina.id}:{richiesta_id}",
+            officina=officina.id)
+        officina.db.aggiorna_stato(richiesta_id, 'completata')
+
+        return {'success': True, 'invio_id': id_invio}, 202
+
+    except Exception as e:
+        return {'error': str(e)}, 500
 
-    # Messaggio automatico
-    messaggio_completato = "🚗 La sua auto è pronta per il ritiro.\nGrazie per aver scelto la nostra officina!"
 
+@app.route('/api/campagne', methods=['POST'])
+def crea_campagna():
+    """Crea una campagna: lo stesso messaggio WhatsApp a tutti i clienti
+    delle richieste che corrispondono ai filtri, una volta per numero.
+
+    Corpo JSON:
+        messaggio  testo da inviare (obbligatorio)
+        nome       descrizione per l'app (facoltativo)
+        categoria, stato, dal, al   filtri come in /api/richieste/esporta
+
+    Risponde 202 subito; destinatari e invii avanzano in background (vedi
+    GET /api/campagne/<id>).
+    """
+    officina = officina_richiesta()
+    data = request.json or {}
+    messaggio = (data.get('messaggio') or '').strip()
+    if not messaggio:
+        return jsonify({'error': 'Messaggio mancante'}), 400
     try:
-        if not twilio_client:
-            print("⚠️ Twilio non configurato - impossibile inviare messaggio")
-            return jsonify({'error': 'Twilio non configurato'}), 500
+        dal = leggi_data(data.get('dal'))
+        al = leggi_data(data.get('al'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not TWILIO_CONFIGURATO:
+        return jsonify({'error': 'Twilio non configurato'}), 500
+
+    id_campagna = officina.campagne.crea(messaggio, data.get('nome'),
+                                         data.get('categoria'),
+                                         data.get('stato'), dal, al)
+    return jsonify({'success': True, 'campagna_id': id_campagna}), 202
 
-        message = twilio_client.messages.create(from_=TWILIO_WHATSAPP_NUMBER,
-                                                body=messaggio_completato,
-                                                to=richiesta['cliente'])
-        richiesta['stato'] = 'completata'
-        richiesta['completato_timestamp'] = datetime.now().isoformat()
 
+@app.route('/api/campagne', methods=['GET'])
+def get_campagne():
+    """Ultime campagne dell'officina, dalla più recente"""
+    officina = officina_richiesta()
+    return jsonify({
+        'campagne': officina.campagne.elenco(),
+        'invii': officina.campagne.statistiche()
+    })
+
+
+@app.route('/api/campagne/<int:id_campagna>', methods=['GET'])
+def get_campagna(id_campagna):
+    """Una campagna con l'avanzamento: destinatari per stato (in_attesa,
+    inviato, fallito)"""
+    campagna = officina_richiesta().campagne.leggi(id_campagna)
+    if not campagna:
+        return jsonify({'error': 'Campagna non trovata'}), 404
+    return jsonify(campagna)
+
+
+@app.route('/api/campagne/<int:id_campagna>/annulla', methods=['POST'])
+def annulla_campagna(id_campagna):
+    """Ferma una campagna: gli invii si fermano alla fine del lotto in
+    corso (una decina di secondi)"""
+    campagne = officina_richiesta().campagne
+    if campagne.annulla(id_campagna):
         return jsonify({'success': True})
+    if not campagne.leggi(id_campagna):
+        return jsonify({'error': 'Campagna non trovata'}), 404
+    return jsonify({'error': 'Campagna già conclusa'}), 409
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/invii', methods=['GET'])
+def get_invii():
+    """Stato degli invii dell'officina: conteggi per stato e ultimi invii
+    falliti. L'outbox è comune a tutte le officine, ma ognuna vede solo i
+    propri invii (numeri e testi dei suoi clienti).
+    """
+    officina = officina_richiesta()
+    return jsonify({
+        'conteggi': coda_invii.conteggi(officina.id),
+        'falliti': coda_invii.falliti(officina.id),
+        'push': notificatore.statistiche()
+    })
+
+
+@app.route('/api/invii/<int:id_invio>', methods=['GET'])
+def get_invio(id_invio):
+    """Stato di un singolo invio accodato dall'officina"""
+    invio = coda_invii.leggi(id_invio, officina_richiesta().id)
+    if not invio:
+        return jsonify({'error': 'Invio non trovato'}), 404
+    return jsonify(invio)
+
+
+# Thread del processo occupabili da flussi SSE e long-poll
+posti_eventi = threading.BoundedSemaphore(EVENTI_MAX_CONNESSIONI)
+
+
+def eventi_occupati():
+    """Risposta 503 quando i posti per i flussi di eventi sono finiti: il
+    client riprova più tardi invece di togliere thread alle altre route"""
+    risposta = jsonify({'error': 'Troppi client collegati agli eventi'})
+    risposta.status_code = 503
+    risposta.headers['Retry-After'] = '5'
+    return risposta
+
+
+@app.route('/api/eventi', methods=['GET'])
+def stream_eventi():
+    """Change feed delle richieste in Server-Sent Events.
+
+    Ogni evento ha `id` crescente, tipo creata/aggiornata/eliminata (o reset)
+    e come dati richiesta_id, stato e categoria. Alla riconnessione
+    EventSource rimanda Last-Event-ID e il flusso riprende da lì; in
+    alternativa si può passare ?dopo=<id>. L'officina va indicata con
+    ?officina= (EventSource non manda header personalizzati).
+
+    Ogni flusso tiene un thread per EVENTI_DURATA_SSE secondi: al massimo
+    EVENTI_MAX_CONNESSIONI per processo, poi 503 (EventSource riprova).
+    """
+    eventi = officina_richiesta().eventi
+    try:
+        ultimo_visto = request.headers.get('Last-Event-ID',
+                                           request.args.get('dopo'))
+        ultimo_visto = int(ultimo_visto) if ultimo_visto else None
+    except ValueError:
+        return jsonify({'error': 'Id evento non valido'}), 400
+    if not posti_eventi.acquire(blocking=False):
+        return eventi_occupati()
+
+    def genera(ultimo_visto):
+        # La connessione viene chiusa periodicamente: il client si ricollega
+        # da solo e il worker non resta occupato per sempre
+        fine = time.monotonic() + EVENTI_DURATA_SSE
+        ultimo_visto = eventi.ultimo_id if ultimo_visto is None else ultimo_visto
+        yield f"retry: 3000\nid: {ultimo_visto}\n\n"
+        while time.monotonic() < fine:
+            nuovi = eventi.attendi(ultimo_visto, timeout=EVENTI_TIMEOUT)
+            if not nuovi:
+                yield ": ping\n\n"
+                continue
+            for evento in nuovi:
+                ultimo_visto = evento['id']
+                yield (f"id: {evento['id']}\nevent: {evento['tipo']}\n"
+                       f"data: {json.dumps(evento)}\n\n")
+
+    risposta = Response(genera(ultimo_visto),
+                        mimetype='text/event-stream',
+                        headers={
+                            'Cache-Control': 'no-cache',
+                            'X-Accel-Buffering': 'no'
+                        })
+    # Il posto si libera alla chiusura, anche se il flusso non è mai partito
+    risposta.call_on_close(posti_eventi.release)
+    return risposta
+
+
+@app.route('/api/eventi/attendi', methods=['GET'])
+def attendi_eventi():
+    """Long-poll per i client senza SSE: ritorna gli eventi dopo ?dopo=<id>
+    (senza, dopo l'ultimo attuale) appena ce ne sono, o una lista vuota
+    dopo ?timeout= secondi.
+
+    L'id dell'ultimo evento è nell'header X-Ultimo-Id, da ripassare come
+    ?dopo= alla chiamata successiva. Come per /api/eventi, al massimo
+    EVENTI_MAX_CONNESSIONI attese per processo, poi 503.
+    """
+    eventi = officina_richiesta().eventi
+    try:
+        dopo = request.args.get('dopo')
+        dopo = int(dopo) if dopo else None
+        timeout = min(float(request.args.get('timeout', EVENTI_TIMEOUT)),
+                      EVENTI_TIMEOUT)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not posti_eventi.acquire(blocking=False):
+        return eventi_occupati()
+    try:
+        if dopo is None:
+            dopo = eventi.ultimo_id
+        nuovi = eventi.attendi(dopo, timeout=max(timeout, 0))
+    finally:
+        posti_eventi.release()
+    ultimo_id = nuovi[-1]['id'] if nuovi else dopo
+
+    risposta = jsonify(nuovi)
+    risposta.headers['X-Ultimo-Id'] = str(ultimo_id)
+    return risposta
+
+
+def leggi_data(valore):
+    """Data AAAA-MM-GG di un parametro (None se assente); solleva
+    ValueError se il formato non è valido"""
+    if not valore:
+        return None
+    try:
+        return datetime.strptime(valore, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError as e:
+        raise ValueError(f"Data non valida: {valore} (AAAA-MM-GG)") from e
+
+
+@app.route('/api/statistiche', methods=['GET'])
+def get_statistiche():
+    """Statistiche per la dashboard del titolare, lette dai riepiloghi.
+
+    Parametri opzionali:
+        dal, al    date AAAA-MM-GG (incluse) delle richieste da contare
+        marche     quante marche restituire (default 20, massimo 200)
+    """
+    officina = officina_richiesta()
+    try:
+        dal = leggi_data(request.args.get('dal'))
+        al = leggi_data(request.args.get('al'))
+        marche = min(int(request.args.get('marche', 20)), 200)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(officina.riepiloghi.riepilogo(dal, al, max(marche, 1)))
 
 
 # ==================== HEALTH CHECK ====================
@@ -541,12 +5165,39 @@ def completa_richiesta():
 
 @app.route('/', methods=['GET'])
 def home():
-    return jsonify({
+    stato = {
         'status': 'online',
         'service': 'Bot WhatsApp Officina',
-        'richieste_totali': len(richieste),
-        'conversazioni_attive': len(conversazioni)
-    })
+        'officine': len(officine),
+        'limiti': {
+            'numeri': limite_numeri.statistiche(),
+            'ip': limite_ip.statistiche()
+        }
+    }
+    # Dettaglio dell'officina indicata (o dell'unica configurata)
+    officina, _ = scegli_officina(request.headers.get('X-Officina'))
+    if officina:
+        # Il conteggio cambia solo con la versione dei dati
+        versione = officina.eventi.versione()
+        totali = cache_risposte.leggi((officina.id, 'totali'), versione)
+        if totali is None:
+            totali = officina.db.conta_richieste()
+            cache_risposte.salva((officina.id, 'totali'), versione, totali)
+        stato.update({
+            'officina': officina.id,
+            'richieste_totali': totali,
+            'conversazioni_attive': len(officina.conversazioni),
+            'sessioni': officina.conversazioni.statistiche(),
+            'storico_clienti': officina.storico.statistiche(),
+            'archivio': officina.archivio.misure,
+            'scritture': officina.db.buffer.statistiche()
+        })
+    # Contatori in memoria che nessuna versione copre: ETag dal contenuto,
+    # il 304 risparmia solo il trasferimento
+    risposta = jsonify(stato)
+    risposta.add_etag()
+    risposta.headers['Cache-Control'] = 'private, no-cache'
+    return risposta.make_conditional(request)
 
 
 @app.route('/test', methods=['GET'])
@@ -554,17 +5205,17 @@ def test():
     """Route di test per verificare che tutto funzioni"""
     try:
         # Test database
-        db = DatabaseRichieste()
         count = db.conta_richieste_nuove()
 
-        # Test bot
-        bot_test = BotOfficina()
+        # Test bot: i flussi di tutte le officine sono compilati all'avvio
+        bot_test = FlussoCompilato(carica_flusso())
 
         return jsonify({
             'status': 'OK',
             'database': 'funziona',
             'richieste_nuove': count,
             'bot': 'funziona',
+            'officine': len(officine),
             'twilio_configured': bool(TWILIO_ACCOUNT_SID)
         })
     except Exception as e:
@@ -576,6 +5227,236 @@ def test():
         }), 500
 
 
+# ==================== COMANDI (flask --app main ...) ====================
+
+
+def officina_comando(id_officina):
+    """Officina indicata con --officina (facoltativa se ce n'è una sola)"""
+    officine.lavori_di_fondo = False
+    officina, _ = scegli_officina(id_officina)
+    if officina is None:
+        raise click.UsageError(
+            f"Officina non trovata: {id_officina}" if id_officina else
+            "Più officine configurate: indicare --officina")
+    return officina
+
+
+def apri_file(percorso, modalita):
+    """File binario in lettura o scrittura ('rb'/'wb'); con estensione .gz
+    viene (de)compresso in gzip. Niente stdin/stdout: su stdout ci sono i
+    log"""
+    if formato_da_file(percorso)[1]:
+        return gzip.open(percorso, modalita)
+    return open(percorso, modalita)
+
+
+@app.cli.command('esporta-richieste')
+@click.argument('file')
+@click.option('--officina', 'id_officina', help="Id dell'officina")
+@click.option('--formato',
+              type=click.Choice(sorted(FORMATI_ESPORTAZIONE)),
+              help="Default: dall'estensione di FILE, altrimenti csv")
+@click.option('--categoria')
+@click.option('--stato')
+@click.option('--dal', help='Data AAAA-MM-GG (inclusa)')
+@click.option('--al', help='Data AAAA-MM-GG (inclusa)')
+def comando_esporta(file, id_officina, formato, categoria, stato, dal, al):
+    """Esporta le richieste in FILE (.csv, .ndjson, anche .gz)"""
+    officina = officina_comando(id_officina)
+    try:
+        dal, al = leggi_data(dal), leggi_data(al)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    formato = formato or formato_da_file(file)[0] or 'csv'
+
+    esportate = 0
+
+    def contati(blocchi):
+        nonlocal esportate
+        for righe in blocchi:
+            esportate += len(righe)
+            yield righe
+
+    campi_export = DatabaseRichieste.COLONNE
+    blocchi = officina.db.esporta(campi_export, categoria, stato, dal, al)
+    with apri_file(file, 'wb') as uscita:
+        for pezzo in righe_esportate(contati(blocchi), campi_export, formato):
+            uscita.write(pezzo)
+    click.echo(f"Esportate {esportate} richieste", err=True)
+
+
+@app.cli.command('importa-richieste')
+@click.argument('file')
+@click.option('--officina', 'id_officina', help="Id dell'officina")
+@click.option('--formato',
+              type=click.Choice(sorted(FORMATI_ESPORTAZIONE)),
+              help="Default: dall'estensione di FILE")
+@click.option('--blocco',
+              type=click.IntRange(1),
+              default=IMPORTA_BLOCCO,
+              show_default=True,
+              help='Righe per transazione')
+def comando_importa(file, id_officina, formato, blocco):
+    """Importa richieste storiche da FILE (.csv, .ndjson, anche .gz), con
+    le colonne dell'export.
+
+    Ogni riga riceve un id nuovo; le righe senza numero_cliente o con date
+    non valide vengono saltate e segnalate. Le richieste archiviate si
+    rimettono con ripristina-archivio: contate qui, le statistiche le
+    vedrebbero due volte.
+    """
+    officina = officina_comando(id_officina)
+    formato = formato or formato_da_file(file)[0]
+    if formato is None:
+        raise click.UsageError("Formato non riconosciuto: indicare --formato")
+
+    esito = {'scartate': 0, 'errori': []}
+    inizio = time.perf_counter()
+    with apri_file(file, 'rb') as ingresso:
+        try:
+            importate = importa_richieste(
+                officina, leggi_importazione(ingresso, formato, esito),
+                blocco)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    for errore in esito['errori']:
+        click.echo(f"Scartata {errore}", err=True)
+    click.echo(
+        f"Importate {importate} richieste in "
+        f"{time.perf_counter() - inizio:.1f}s, scartate {esito['scartate']}",
+        err=True)
+
+
+@app.cli.command('archivia-richieste')
+@click.option('--officina', 'id_officina', help="Id dell'officina")
+@click.option('--giorni',
+              type=click.IntRange(1),
+              default=ARCHIVIO_DOPO_GIORNI or None,
+              show_default=True,
+              help='Archivia le completate più vecchie di tanti giorni')
+@click.option('--vacuum',
+              is_flag=True,
+              help='Poi VACUUM completo (blocca le scritture): attiva '
+              "l'auto_vacuum incrementale sui database creati prima")
+def comando_archivia(id_officina, giorni, vacuum):
+    """Archivia subito le richieste completate, come il lavoro di fondo"""
+    officina = officina_comando(id_officina)
+    if giorni is None and not vacuum:
+        raise click.UsageError("Archiviazione disattivata: indicare --giorni")
+    archiviate = officina.archivio.esegui(giorni or 0)
+    if vacuum:
+        officina.archivio.vacuum_completo()
+        officina.archivio._misura()
+    misure = officina.archivio.misure
+    click.echo(
+        f"Archiviate {archiviate} richieste; restano {misure['righe']}, "
+        f"database {misure['byte'] / 2**20:.1f} MB "
+        f"({misure['byte_liberi'] / 2**20:.1f} MB liberi)",
+        err=True)
+
+
+@app.cli.command('esporta-archivio')
+@click.argument('file')
+@click.option('--officina', 'id_officina', help="Id dell'officina")
+@click.option('--mese', help='AAAA-MM (default: tutti i mesi)')
+def comando_esporta_archivio(file, id_officina, mese):
+    """Esporta in FILE (.ndjson, anche .gz) le richieste archiviate, per
+    leggerle o portarle in un altro database (per rimetterle in questo:
+    ripristina-archivio)"""
+    archivio = officina_comando(id_officina).archivio
+    mesi = archivio.mesi()
+    if mese is not None and mese not in mesi:
+        raise click.BadParameter(f"Nessun archivio per il mese {mese}")
+    esportate = 0
+    with apri_file(file, 'wb') as uscita:
+        for mese_archivio in [mese] if mese else mesi:
+            for riga in archivio.leggi(mese_archivio):
+                uscita.write(riga)
+                esportate += 1
+    click.echo(f"Esportate {esportate} richieste archiviate", err=True)
+
+
+@app.cli.command('ripristina-archivio')
+@click.option('--officina', 'id_officina', help="Id dell'officina")
+@click.option('--mese', required=True, help='AAAA-MM')
+def comando_ripristina_archivio(id_officina, mese):
+    """Rimette nel database le richieste archiviate in un mese, con id e
+    statistiche invariati (importa-richieste le conterebbe due volte)"""
+    archivio = officina_comando(id_officina).archivio
+    if mese not in archivio.mesi():
+        raise click.BadParameter(f"Nessun archivio per il mese {mese}")
+    ripristinate = archivio.ripristina(mese)
+    click.echo(f"Ripristinate {ripristinate} richieste", err=True)
+
+
+def visualizza_richieste_titolare(database=None):
+    """Mostra in console le richieste nuove al titolare"""
+    richieste_nuove = (database or db).leggi_richieste_nuove()
+
+    click.echo(f"\n{'='*50}")
+    click.echo(f"📋 RICHIESTE NUOVE: {len(richieste_nuove)}")
+    click.echo(f"{'='*50}\n")
+
+    for richiesta in richieste_nuove:
+        (id_r, numero, auto, problema, urgenza, spie, orario, intervento,
+         diagnosi, categoria, data, stato) = richiesta
+
+        click.echo(f"ID: {id_r}")
+        click.echo(f"📱 Cliente: {numero}")
+        click.echo(f"🚗 Auto: {auto}")
+        click.echo(f"❗ Problema: {problema}")
+
+        if urgenza:
+            click.echo(f"🚨 Urgenza: {urgenza}")
+        if spie:
+            click.echo(f"💡 Spie: {spie}")
+        if orario:
+            click.echo(f"🕐 Orario: {orario}")
+        if intervento:
+            click.echo(f"🔧 Intervento: {intervento}")
+        if diagnosi:
+            click.echo(f"📋 Diagnosi: {diagnosi}")
+
+        click.echo(f"🏷️ {categoria}")
+        click.echo(f"📅 Data: {data}")
+        click.echo(f"{'-'*50}\n")
+
+
+@app.cli.command('richieste-nuove')
+@click.option('--officina', 'id_officina', help="Id dell'officina")
+def comando_richieste_nuove(id_officina):
+    """Mostra le richieste nuove, come nel riepilogo per il titolare"""
+    visualizza_richieste_titolare(officina_comando(id_officina).db)
+
+
 # ==================== AVVIO SERVER ====================
+
+
+def crea_app():
+    """App per gunicorn con --preload (vedi Procfile):
+
+        gunicorn 'main:crea_app()' --preload
+
+    Il master importa il modulo e prepara gli schemi e l'officina
+    predefinita una volta sola; i worker nascono per fork già pronti, senza
+    ripetere import e DDL. Nel master non restano connessioni SQLite (non
+    vanno portate oltre un fork) né thread di fondo: outbox, metriche e
+    lavori delle officine partono in ogni worker alla prima richiesta.
+    """
+    officine.lavori_di_fondo = False
+    try:
+        officina = officine.predefinita
+    finally:
+        officine.lavori_di_fondo = True
+    for database in {db, officina.db} if officina else {db}:
+        database.chiudi()
+    # Anche il listener dei log: un fork mentre scrive su stdout lascerebbe
+    # il lock dello stream preso nel worker. Riparte al primo record
+    for gestore in log.handlers:
+        if isinstance(gestore, GestoreCodaLog):
+            gestore.ferma()
+    return app
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000, debug=False)
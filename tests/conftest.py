@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# main apre database e cartelle all'import: tutto in una cartella
+# temporanea, prima che un test lo importi
+_CARTELLA = tempfile.mkdtemp(prefix='officina-test-')
+os.environ['DATABASE_PATH'] = os.path.join(_CARTELLA, 'richieste.db')
+os.environ['OFFICINE_DB_DIR'] = os.path.join(_CARTELLA, 'officine')
+os.environ['ARCHIVIO_DIR'] = os.path.join(_CARTELLA, 'archivio')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
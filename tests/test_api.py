@@ -0,0 +1,40 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize('since', ['garbage', '2020-01-01', '1.5'])
+def test_since_non_valido(client, since):
+    risposta = client.get('/api/richieste', query_string={'since': since})
+    assert risposta.status_code == 400
+
+
+def test_since(client):
+    officina = main.officine.predefinita
+    primo = officina.db.salva_richiesta('whatsapp:+393330000001',
+                                        {'auto': 'Fiat Panda'}, 'URGENTE')
+    secondo = officina.db.salva_richiesta('whatsapp:+393330000002',
+                                          {'auto': 'Opel Corsa'}, 'URGENTE')
+
+    risposta = client.get('/api/richieste',
+                          query_string={
+                              'since': primo,
+                              'campi': 'id'
+                          })
+    assert risposta.status_code == 200
+    assert risposta.get_json() == [{'id': secondo}]
+    assert risposta.headers['X-Ultimo-Id'] == str(secondo)
+
+
+def test_dopo_non_valido(client):
+    risposta = client.get('/api/eventi/attendi',
+                          query_string={
+                              'dopo': 'garbage',
+                              'timeout': 0
+                          })
+    assert risposta.status_code == 400
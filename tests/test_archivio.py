@@ -0,0 +1,132 @@
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def officina(tmp_path):
+    database = main.DatabaseRichieste(str(tmp_path / 'richieste.db'))
+    officina = SimpleNamespace(id='prova',
+                               db=database,
+                               eventi=main.BusEventi(database),
+                               riepiloghi=main.RiepiloghiRichieste(database))
+    yield officina
+    database.chiudi()
+
+
+@pytest.fixture
+def archivio(officina, tmp_path):
+    return main.ArchivioRichieste(officina,
+                                  giorni=30,
+                                  cartella=str(tmp_path / 'archivio'),
+                                  blocco=2)
+
+
+def importa(officina, *righe):
+    main.importa_richieste(officina,
+                           [main._riga_importata(valori) for valori in righe])
+
+
+def vecchie(officina):
+    """Tre richieste completate a gennaio 2024 e una ancora aperta"""
+    importa(
+        officina, *({
+            'numero_cliente': f'+39333000000{i}',
+            'auto': 'Fiat Panda',
+            'categoria': 'MANUTENZIONE',
+            'data_richiesta': f'2024-01-1{i} 09:00:00',
+            'stato': 'completata',
+            'data_completamento': f'2024-01-1{i} 12:00:00'
+        } for i in range(3)), {
+            'numero_cliente': '+393339999999',
+            'auto': 'Opel Corsa',
+            'data_richiesta': '2024-01-20 09:00:00',
+            'stato': 'lavorata'
+        })
+
+
+def ids(officina):
+    return [riga[0] for riga in officina.db._leggi(
+        'SELECT id FROM richieste ORDER BY id')]
+
+
+def test_archiviazione(officina, archivio):
+    vecchie(officina)
+    prima = officina.riepiloghi.riepilogo()
+
+    assert archivio.esegui() == 3
+    assert ids(officina) == [4]
+    assert archivio.mesi() == ['2024-01']
+    assert sorted(json.loads(riga)['id']
+                  for riga in archivio.leggi('2024-01')) == [1, 2, 3]
+    # Le statistiche contano ancora le richieste archiviate
+    assert officina.riepiloghi.riepilogo() == prima
+
+    # Niente di nuovo da archiviare
+    assert archivio.esegui() == 0
+
+
+def test_riaperta_durante_archiviazione(officina, archivio, monkeypatch):
+    vecchie(officina)
+    scrivi_archivio = archivio._scrivi_archivio
+
+    def riapri_dopo_la_scrittura(mese, righe):
+        scrivi_archivio(mese, righe)
+        # Tra la lettura del lotto e la cancellazione
+        if righe[0][0] == 1:
+            officina.db.aggiorna_stato(1, 'lavorata')
+
+    monkeypatch.setattr(archivio, '_scrivi_archivio',
+                        riapri_dopo_la_scrittura)
+    prima = officina.riepiloghi.riepilogo()
+
+    assert archivio.esegui() == 2
+    assert ids(officina) == [1, 4]
+    riepilogo = officina.riepiloghi.riepilogo()
+    assert riepilogo['totale'] == prima['totale']
+    assert riepilogo['per_stato'] == {'completata': 2, 'lavorata': 2}
+
+
+def test_ripristino_ripetuto(officina, archivio):
+    vecchie(officina)
+    prima = officina.riepiloghi.riepilogo()
+    archivio.esegui()
+
+    assert archivio.ripristina('2024-01') == 3
+    assert ids(officina) == [1, 2, 3, 4]
+    assert officina.riepiloghi.riepilogo() == prima
+
+    assert archivio.ripristina('2024-01') == 0
+    assert ids(officina) == [1, 2, 3, 4]
+    assert officina.riepiloghi.riepilogo() == prima
+
+
+def test_ripristino_non_tocca_le_righe_presenti(officina, archivio):
+    vecchie(officina)
+    archivio.esegui()
+    archivio.ripristina('2024-01')
+    officina.db.aggiorna_stato(2, 'lavorata')
+
+    assert archivio.ripristina('2024-01') == 0
+    assert officina.db._leggi('SELECT stato FROM richieste WHERE id = 2'
+                              )[0][0] == 'lavorata'
+
+
+def test_leggi_solo_la_copia_piu_recente(officina, archivio):
+    vecchie(officina)
+    archivio.esegui()
+    archivio.ripristina('2024-01')
+    # Ripristinate e ancora vecchie: il giro successivo le riarchivia,
+    # insieme a una modifica fatta nel frattempo
+    officina.db._scrivi("UPDATE richieste SET auto = 'Fiat Punto' "
+                        'WHERE id = 1')
+    prima = officina.riepiloghi.riepilogo()
+
+    assert archivio.esegui() == 3
+    righe = [json.loads(riga) for riga in archivio.leggi('2024-01')]
+    assert sorted(riga['id'] for riga in righe) == [1, 2, 3]
+    assert {riga['id']: riga['auto'] for riga in righe}[1] == 'Fiat Punto'
+    assert officina.riepiloghi.riepilogo() == prima
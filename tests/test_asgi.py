@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+import main
+
+asgi = pytest.importorskip('asgi')
+
+
+def chiama(metodo, percorso, messaggi):
+    """Esegue asgi.app con i messaggi di `messaggi` come corpo; ritorna
+    i messaggi inviati al server"""
+    scope = {
+        'type': 'http',
+        'method': metodo,
+        'scheme': 'http',
+        'path': percorso,
+        'query_string': b'',
+        'headers': [(b'host', b'localhost'),
+                    (b'content-type', b'application/json')],
+        'client': ('127.0.0.1', 50000),
+    }
+    coda = list(messaggi)
+    inviati = []
+
+    async def receive():
+        return coda.pop(0)
+
+    async def send(messaggio):
+        inviati.append(messaggio)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    return inviati
+
+
+def corpo(dati):
+    return [{'type': 'http.request', 'body': dati, 'more_body': False}]
+
+
+@pytest.mark.parametrize('percorso', ['/api/risposta', '/api/completa'])
+@pytest.mark.parametrize('dati', [b'{non json', b'\xff\xfe\xfa'])
+def test_json_non_valido(percorso, dati):
+    inviati = chiama('POST', percorso, corpo(dati))
+    assert inviati[0]['status'] == 400
+    assert b'JSON non valido' in inviati[1]['body']
+
+
+def test_errore_nel_gestore_non_diventa_400(monkeypatch):
+    monkeypatch.setattr(main, 'validatore_twilio', None)
+
+    def guasto(officina, form):
+        raise ValueError('errore del bot')
+
+    monkeypatch.setattr(main, 'rispondi_webhook', guasto)
+    inviati = chiama(
+        'POST', '/webhook/whatsapp',
+        [{
+            'type': 'http.request',
+            'body': b'From=whatsapp%3A%2B393331234567&Body=ciao',
+            'more_body': False
+        }])
+    assert inviati[0]['status'] == 500
+
+
+def test_client_disconnesso_nessuna_risposta():
+    inviati = chiama('POST', '/api/risposta', [{
+        'type': 'http.request',
+        'body': b'{"richiesta_id"',
+        'more_body': True
+    }, {
+        'type': 'http.disconnect'
+    }])
+    assert inviati == []
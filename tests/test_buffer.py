@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+import main
+
+DATI = {'auto': 'Fiat Panda', 'problema': 'Auto ferma / rumori strani'}
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = main.DatabaseRichieste(str(tmp_path / 'richieste.db'))
+    yield database
+    database.chiudi()
+
+
+def righe(database):
+    return database._leggi('SELECT id, categoria FROM richieste ORDER BY id')
+
+
+def salva(database, categoria='MANUTENZIONE'):
+    return database.salva_richiesta(
+        'whatsapp:+393331234567',
+        DATI,
+        categoria,
+        attendi=categoria in main.RICHIESTE_SINCRONE)
+
+
+def test_urgente_scritta_prima_di_rispondere(database):
+    id_richiesta = salva(database, 'URGENTE')
+
+    assert isinstance(id_richiesta, int)
+    assert righe(database) == [(id_richiesta, 'URGENTE')]
+
+
+def test_non_urgente_scritta_entro_il_lotto(database):
+    attesa = database.buffer.attesa
+    assert attesa == main.RICHIESTE_LOTTO_ATTESA
+    inizio = time.monotonic()
+
+    assert salva(database) is None
+    # Entro l'attesa del lotto, con margine per il commit e lo scheduler
+    while not righe(database):
+        assert time.monotonic() - inizio < attesa + 0.5
+        time.sleep(0.001)
+    assert [categoria for _, categoria in righe(database)] == ['MANUTENZIONE']
+    assert database.buffer.statistiche()['in_attesa'] == 0
+
+
+def test_lotto_con_piu_righe(database):
+    for _ in range(5):
+        salva(database)
+    id_urgente = salva(database, 'URGENTE')
+
+    # La riga sincrona fa partire il lotto con quelle già in coda
+    assert len(righe(database)) == 6
+    assert righe(database)[-1] == (id_urgente, 'URGENTE')
+
+
+def test_scrittore_bloccato_scrittura_diretta(database, monkeypatch):
+    monkeypatch.setattr(main, 'RICHIESTE_ATTESA_MAX', 0.1)
+    fermo = threading.Event()
+    # Lo scrittore non prende mai le righe dalla coda
+    monkeypatch.setattr(database.buffer, '_ciclo_scrittore', fermo.wait)
+    try:
+        id_richiesta = salva(database, 'URGENTE')
+    finally:
+        fermo.set()
+
+    assert isinstance(id_richiesta, int)
+    assert righe(database) == [(id_richiesta, 'URGENTE')]
+    statistiche = database.buffer.statistiche()
+    assert statistiche['dirette'] == 1
+    assert statistiche['in_attesa'] == 0
+
+
+@pytest.mark.parametrize('ritardo, scaduta', [(0.15, False), (0.4, True)])
+def test_scrittore_lento_nessun_doppione(database, monkeypatch, ritardo,
+                                        scaduta):
+    monkeypatch.setattr(main, 'RICHIESTE_ATTESA_MAX', 0.1)
+    scrivi_lotto = database.buffer._scrivi_lotto
+    finito = threading.Event()
+
+    def lento(lotto):
+        # Il lotto è già fuori dalla coda: aggiungi non può riprenderlo
+        time.sleep(ritardo)
+        scrivi_lotto(lotto)
+        finito.set()
+
+    monkeypatch.setattr(database.buffer, '_scrivi_lotto', lento)
+    id_richiesta = salva(database, 'URGENTE')
+    assert finito.wait(5)
+
+    statistiche = database.buffer.statistiche()
+    assert len(righe(database)) == 1
+    assert 'dirette' not in statistiche
+    if scaduta:
+        # Il chiamante rinuncia all'id, ma la riga è scritta una volta sola
+        assert id_richiesta is None
+        assert statistiche['scadute'] == 1
+    else:
+        assert righe(database) == [(id_richiesta, 'URGENTE')]
@@ -0,0 +1,43 @@
+import time
+
+import main
+
+CLIENTE = 'whatsapp:+393330000042'
+
+
+def conversa(bot, *messaggi):
+    return [
+        bot.gestisci_messaggio(CLIENTE, testo, sid)
+        for sid, testo in messaggi
+    ]
+
+
+def richieste_del_cliente(officina):
+    return officina.db._leggi(
+        'SELECT COUNT(*) FROM richieste WHERE numero_cliente = ?',
+        (CLIENTE, ))[0][0]
+
+
+def test_retry_del_messaggio_di_chiusura():
+    officina = main.officine.predefinita
+    bot = officina.bot
+    # Urgente: la richiesta è scritta prima della risposta
+    risposte = conversa(bot, ('SM1', 'ciao'), ('SM2', 'Fiat Panda'),
+                        ('SM3', '1'), ('SM4', '1'))
+    assert risposte[-1] == bot.flusso.chiusura
+    assert richieste_del_cliente(officina) == 1
+
+    # Il retry arriva a un altro worker: la sua cache in memoria non lo
+    # conosce, ma l'archivio condiviso sì
+    assert conversa(bot, ('SM4', '1')) == [bot.flusso.chiusura]
+    assert richieste_del_cliente(officina) == 1
+
+    # Il ricordo della chiusura scade presto
+    scadenza = officina.db._leggi(
+        'SELECT scadenza FROM conversazioni WHERE numero = ?',
+        (CLIENTE, ))[0][0]
+    assert scadenza <= time.time() + main.CONVERSAZIONI_TTL_CHIUSE
+
+    # Un messaggio nuovo apre una nuova conversazione
+    assert conversa(bot, ('SM5', 'ciao')) != [bot.flusso.chiusura]
+    assert officina.conversazioni.leggi(CLIENTE)['step'] is not None
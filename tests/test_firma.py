@@ -0,0 +1,139 @@
+import asyncio
+from urllib.parse import urlencode
+
+import pytest
+from twilio.request_validator import RequestValidator
+from werkzeug.datastructures import MultiDict
+
+import main
+
+TOKEN = 'token-di-prova'
+URL = 'https://officina.example.com/webhook/whatsapp'
+PARAMETRI = {
+    'From': 'whatsapp:+393331234567',
+    'To': 'whatsapp:+14155238886',
+    'Body': 'Fiat Panda',
+    'MessageSid': 'SM0123456789abcdef',
+}
+
+
+def firma(url, parametri=PARAMETRI, token=TOKEN):
+    """Firma calcolata come la calcola Twilio"""
+    return RequestValidator(token).compute_signature(url, parametri)
+
+
+@pytest.fixture
+def validatore():
+    return main.ValidatoreTwilio(TOKEN)
+
+
+def test_firma_come_twilio(validatore):
+    assert validatore.firma(URL, MultiDict(PARAMETRI)) == firma(URL)
+
+
+def test_firma_valida(validatore):
+    assert validatore.valida(URL, MultiDict(PARAMETRI), firma(URL))
+
+
+def test_porta_esplicita(validatore):
+    # Twilio a volte firma l'URL con la porta standard, a volte senza
+    con_porta = 'https://officina.example.com:443/webhook/whatsapp'
+    assert validatore.valida(URL, MultiDict(PARAMETRI), firma(con_porta))
+    assert validatore.valida(con_porta, MultiDict(PARAMETRI), firma(URL))
+
+
+@pytest.mark.parametrize('url, parametri, firma_inviata', [
+    (URL, dict(PARAMETRI, Body='Alfa Romeo'), firma(URL)),
+    ('http://officina.example.com/webhook/whatsapp', PARAMETRI, firma(URL)),
+    (URL, PARAMETRI, firma(URL, token='altro-token')),
+    (URL, PARAMETRI, ''),
+    (URL, PARAMETRI, None),
+])
+def test_firma_rifiutata(validatore, url, parametri, firma_inviata):
+    assert not validatore.valida(url, MultiDict(parametri), firma_inviata)
+
+
+def test_url_webhook_dietro_proxy(monkeypatch):
+    monkeypatch.setattr(main, 'TWILIO_WEBHOOK_URL', None)
+    interno = 'http://officina.example.com/webhook/whatsapp'
+    assert main.url_webhook(interno, 'https') == URL
+    assert main.url_webhook(interno, None) == interno
+    assert main.url_webhook(URL, 'https') == URL
+
+    monkeypatch.setattr(main, 'TWILIO_WEBHOOK_URL', URL)
+    assert main.url_webhook('http://10.0.0.5:8080/webhook/whatsapp') == URL
+
+
+# ---------- Webhook ----------
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, 'validatore_twilio',
+                        main.ValidatoreTwilio(TOKEN))
+    monkeypatch.setattr(main, 'TWILIO_WEBHOOK_URL', None)
+    return main.app.test_client()
+
+
+def invia(client, firma_inviata, **intestazioni):
+    intestazioni['X-Twilio-Signature'] = firma_inviata
+    return client.post('/webhook/whatsapp',
+                       base_url='http://officina.example.com',
+                       data=PARAMETRI,
+                       headers=intestazioni)
+
+
+def test_webhook_dietro_proxy(client):
+    # Il proxy termina TLS: l'app vede http, Twilio ha firmato https
+    risposta = invia(client, firma(URL), **{'X-Forwarded-Proto': 'https'})
+    assert risposta.status_code == 200
+    assert 'Message' in risposta.get_data(as_text=True)
+
+
+def test_webhook_senza_intestazione_del_proxy(client):
+    risposta = invia(client, firma(URL))
+    assert risposta.status_code == 403
+
+
+def test_webhook_firma_non_valida(client):
+    risposta = invia(client,
+                     firma(URL, token='altro-token'),
+                     **{'X-Forwarded-Proto': 'https'})
+    assert risposta.status_code == 403
+
+
+def test_webhook_url_configurato(client, monkeypatch):
+    # Con TWILIO_WEBHOOK_URL conta solo l'URL configurato su Twilio
+    monkeypatch.setattr(main, 'TWILIO_WEBHOOK_URL', URL)
+    assert invia(client, firma(URL)).status_code == 200
+    assert invia(client,
+                 firma('http://officina.example.com/webhook/whatsapp'),
+                 **{'X-Forwarded-Proto': 'http'}).status_code == 403
+
+
+def test_webhook_asgi_dietro_proxy(monkeypatch):
+    asgi = pytest.importorskip('asgi')
+    monkeypatch.setattr(main, 'validatore_twilio',
+                        main.ValidatoreTwilio(TOKEN))
+    monkeypatch.setattr(main, 'TWILIO_WEBHOOK_URL', None)
+
+    def chiama(firma_inviata, protocollo=None):
+        intestazioni = [(b'host', b'officina.example.com'),
+                        (b'x-twilio-signature', firma_inviata.encode())]
+        if protocollo:
+            intestazioni.append((b'x-forwarded-proto', protocollo.encode()))
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'scheme': 'http',
+            'path': '/webhook/whatsapp',
+            'query_string': b'',
+            'headers': intestazioni,
+            'client': ('10.0.0.1', 50000),
+        }
+        richiesta = asgi.Richiesta(scope, urlencode(PARAMETRI).encode())
+        return asyncio.run(asgi.webhook_whatsapp(richiesta))[1]
+
+    assert chiama(firma(URL), 'https') == 200
+    assert chiama(firma(URL)) == 403
+    assert chiama(firma(URL, token='altro-token'), 'https') == 403
@@ -0,0 +1,158 @@
+import pytest
+from twilio.base.exceptions import TwilioRestException
+
+import main
+
+OFFICINA = 'prova'
+
+
+class Destinatario:
+    """Gestore finto: risponde con gli stati HTTP in `risposte` (poi 201)
+    come farebbe Twilio, e ricorda i payload ricevuti"""
+
+    def __init__(self, *risposte):
+        self.risposte = list(risposte)
+        self.ricevuti = []
+
+    def __call__(self, payload):
+        self.ricevuti.append(payload)
+        stato = self.risposte.pop(0) if self.risposte else 201
+        if stato >= 400:
+            raise main.errore_twilio(
+                TwilioRestException(stato, '/Messages.json', f'HTTP {stato}'))
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = main.DatabaseRichieste(str(tmp_path / 'richieste.db'))
+    yield database
+    database.chiudi()
+
+
+def crea_coda(database, destinatario, max_tentativi=3):
+    # Nessun worker: gli invii si consegnano a mano con elabora_uno
+    coda = main.CodaInvii(database, n_worker=0, max_tentativi=max_tentativi)
+    coda.registra('whatsapp', destinatario)
+    return coda
+
+
+def accoda(coda, chiave=None):
+    payload = {'to': 'whatsapp:+393331234567', 'body': 'La tua auto è pronta'}
+    return coda.accoda('whatsapp', payload, chiave, officina=OFFICINA)
+
+
+def scadi(database, id_invio):
+    """Porta il prossimo tentativo (o la scadenza del lease) nel passato"""
+    database._scrivi('UPDATE outbox SET prossimo_tentativo = 0 WHERE id = ?',
+                     (id_invio, ))
+
+
+def test_consegna(database):
+    destinatario = Destinatario()
+    coda = crea_coda(database, destinatario)
+    id_invio = accoda(coda)
+
+    assert coda.elabora_uno()
+    assert coda.leggi(id_invio, OFFICINA)['stato'] == 'inviato'
+    assert len(destinatario.ricevuti) == 1
+    assert not coda.elabora_uno()
+
+
+def test_riprova_dopo_5xx(database):
+    destinatario = Destinatario(503)
+    coda = crea_coda(database, destinatario)
+    id_invio = accoda(coda)
+
+    assert coda.elabora_uno()
+    invio = coda.leggi(id_invio, OFFICINA)
+    assert invio['stato'] == 'in_attesa'
+    assert invio['tentativi'] == 1
+    assert 'HTTP 503' in invio['ultimo_errore']
+    # Il backoff non è ancora passato
+    assert not coda.elabora_uno()
+
+    scadi(database, id_invio)
+    assert coda.elabora_uno()
+    invio = coda.leggi(id_invio, OFFICINA)
+    assert invio['stato'] == 'inviato'
+    assert invio['tentativi'] == 2
+    assert len(destinatario.ricevuti) == 2
+
+
+def test_dead_letter_dopo_max_tentativi(database):
+    destinatario = Destinatario(500, 502, 503, 504)
+    coda = crea_coda(database, destinatario, max_tentativi=3)
+    id_invio = accoda(coda)
+
+    for _ in range(3):
+        scadi(database, id_invio)
+        assert coda.elabora_uno()
+    invio = coda.leggi(id_invio, OFFICINA)
+    assert invio['stato'] == 'fallito'
+    assert invio['tentativi'] == 3
+    assert [f['id'] for f in coda.falliti(OFFICINA)] == [id_invio]
+    assert coda.falliti('altra') == []
+
+    scadi(database, id_invio)
+    assert not coda.elabora_uno()
+    assert len(destinatario.ricevuti) == 3
+
+
+@pytest.mark.parametrize('stato', [400, 404])
+def test_nessun_tentativo_dopo_4xx(database, stato):
+    destinatario = Destinatario(stato)
+    coda = crea_coda(database, destinatario)
+    id_invio = accoda(coda)
+
+    assert coda.elabora_uno()
+    invio = coda.leggi(id_invio, OFFICINA)
+    assert invio['stato'] == 'fallito'
+    assert invio['tentativi'] == 1
+
+    scadi(database, id_invio)
+    assert not coda.elabora_uno()
+    assert len(destinatario.ricevuti) == 1
+
+
+def test_429_si_riprova(database):
+    coda = crea_coda(database, Destinatario(429))
+    id_invio = accoda(coda)
+
+    assert coda.elabora_uno()
+    assert coda.leggi(id_invio, OFFICINA)['stato'] == 'in_attesa'
+
+
+def test_chiave_di_idempotenza(database):
+    destinatario = Destinatario()
+    coda = crea_coda(database, destinatario)
+
+    primo = accoda(coda, 'risposta:prova:1:abc')
+    assert accoda(coda, 'risposta:prova:1:abc') == primo
+    assert accoda(coda, 'risposta:prova:1:def') != primo
+
+    while coda.elabora_uno():
+        pass
+    # Anche dopo la consegna la stessa chiave non produce un altro invio
+    assert accoda(coda, 'risposta:prova:1:abc') == primo
+    assert not coda.elabora_uno()
+    assert len(destinatario.ricevuti) == 2
+    assert coda.conteggi(OFFICINA) == {'inviato': 2}
+
+
+def test_lease_scaduto(database):
+    destinatario = Destinatario()
+    coda = crea_coda(database, destinatario)
+    id_invio = accoda(coda)
+
+    # Un worker prenota l'invio e muore prima di consegnarlo
+    assert [riga[0] for riga in coda._prendi()] == [id_invio]
+    assert coda.leggi(id_invio, OFFICINA)['stato'] == 'in_corso'
+    # Finché il lease vale nessun altro lo prende
+    assert not coda.elabora_uno()
+
+    scadi(database, id_invio)
+    assert coda.elabora_uno()
+    invio = coda.leggi(id_invio, OFFICINA)
+    assert invio['stato'] == 'inviato'
+    assert invio['tentativi'] == 2
+    assert len(destinatario.ricevuti) == 1
@@ -0,0 +1,185 @@
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+TABELLE = ('riepilogo_richieste', 'riepilogo_marche',
+           'riepilogo_completamento')
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = main.DatabaseRichieste(str(tmp_path / 'richieste.db'))
+    yield database
+    database.chiudi()
+
+
+@pytest.fixture
+def riepiloghi(database):
+    return main.RiepiloghiRichieste(database)
+
+
+def nuova(database, auto='Fiat Panda', categoria='MANUTENZIONE'):
+    return database.salva_richiesta('whatsapp:+393331234567', {
+        'auto': auto,
+        'problema': 'Tagliando / controllo'
+    }, categoria)
+
+
+def contenuto(conn):
+    """Righe non nulle dei riepiloghi (le somme arrotondate)"""
+    righe = {}
+    for tabella in TABELLE:
+        righe[tabella] = {
+            tuple(round(v, 6) if isinstance(v, float) else v for v in riga)
+            for riga in conn.execute(f'SELECT * FROM {tabella} WHERE n != 0')
+        }
+    return righe
+
+
+def uguale_a_ricostruzione(riepiloghi, conn):
+    """I riepiloghi tenuti dai trigger coincidono con quelli ricalcolati da
+    zero dalle richieste"""
+    attuale = contenuto(conn)
+    conn.execute('BEGIN')
+    try:
+        for tabella in TABELLE:
+            conn.execute(f'DELETE FROM {tabella}')
+        riepiloghi._ricostruisci(conn)
+        return contenuto(conn) == attuale
+    finally:
+        conn.rollback()
+
+
+def test_inserimento(database, riepiloghi):
+    nuova(database)
+    nuova(database, auto='fiat 500', categoria='URGENTE')
+    nuova(database, auto='  Lancia Ypsilon')
+
+    r = riepiloghi.riepilogo()
+    assert r['totale'] == 3
+    assert r['per_categoria'] == {'MANUTENZIONE': 2, 'URGENTE': 1}
+    assert r['per_stato'] == {'nuova': 3}
+    assert r['quota_urgenti'] == round(1 / 3, 4)
+    assert r['per_marca'] == [{
+        'marca': 'FIAT',
+        'richieste': 2
+    }, {
+        'marca': 'LANCIA',
+        'richieste': 1
+    }]
+    assert r['completamento']['completate'] == 0
+    assert uguale_a_ricostruzione(riepiloghi, database.connessione())
+
+
+def test_cambio_stato(database, riepiloghi):
+    id_richiesta = nuova(database)
+    nuova(database)
+
+    database.aggiorna_stato(id_richiesta, 'lavorata')
+    assert riepiloghi.riepilogo()['per_stato'] == {'nuova': 1, 'lavorata': 1}
+
+    # Lo stesso stato non sposta nulla
+    database.aggiorna_stato(id_richiesta, 'lavorata')
+    r = riepiloghi.riepilogo()
+    assert r['per_stato'] == {'nuova': 1, 'lavorata': 1}
+    assert r['totale'] == 2
+    assert uguale_a_ricostruzione(riepiloghi, database.connessione())
+
+
+def test_completamento_e_riapertura(database, riepiloghi):
+    id_richiesta = nuova(database)
+
+    database.aggiorna_stato(id_richiesta, 'completata')
+    completamento = riepiloghi.riepilogo()['completamento']
+    assert completamento['completate'] == 1
+    assert completamento['mediana_fascia'] == '<1h'
+    assert database._leggi(
+        'SELECT data_completamento FROM richieste WHERE id = ?',
+        (id_richiesta, ))[0][0] is not None
+    assert uguale_a_ricostruzione(riepiloghi, database.connessione())
+
+    # Completarla di nuovo non la conta due volte
+    database.aggiorna_stato(id_richiesta, 'completata')
+    assert riepiloghi.riepilogo()['completamento']['completate'] == 1
+
+    database.aggiorna_stato(id_richiesta, 'lavorata')
+    r = riepiloghi.riepilogo()
+    assert r['completamento']['completate'] == 0
+    assert r['completamento']['media_ore'] is None
+    assert r['per_stato'] == {'lavorata': 1}
+    assert database._leggi(
+        'SELECT data_completamento FROM richieste WHERE id = ?',
+        (id_richiesta, ))[0][0] is None
+    assert uguale_a_ricostruzione(riepiloghi, database.connessione())
+
+
+def test_cancellazione(database, riepiloghi):
+    aperta = nuova(database)
+    completata = nuova(database, auto='Opel Corsa', categoria='URGENTE')
+    database.aggiorna_stato(completata, 'completata')
+
+    database.elimina_richiesta(aperta)
+    database.elimina_richiesta(completata)
+
+    r = riepiloghi.riepilogo()
+    assert r['totale'] == 0
+    assert r['per_stato'] == {}
+    assert r['per_marca'] == []
+    assert r['completamento']['completate'] == 0
+    assert contenuto(database.connessione()) == {t: set() for t in TABELLE}
+
+
+def test_importazione(database, riepiloghi):
+    officina = SimpleNamespace(db=database, eventi=main.BusEventi(database))
+    righe = [
+        main._riga_importata({
+            'numero_cliente': '+393331111111',
+            'auto': 'Fiat Panda',
+            'categoria': 'URGENTE',
+            'data_richiesta': '2024-03-01 09:00:00',
+            'stato': 'completata',
+            'data_completamento': '2024-03-01 11:30:00'
+        }),
+        main._riga_importata({
+            'numero_cliente': '+393332222222',
+            'auto': 'Alfa Romeo Giulia',
+            'categoria': 'PREVENTIVO',
+            'data_richiesta': '2024-03-02T10:00:00'
+        }),
+        main._riga_importata({'numero_cliente': '+393333333333'}),
+    ]
+
+    assert main.importa_richieste(officina, righe, blocco=2) == 3
+
+    r = riepiloghi.riepilogo(dal='2024-03-01', al='2024-03-31')
+    assert r['totale'] == 2
+    assert r['per_giorno'] == {'2024-03-01': 1, '2024-03-02': 1}
+    assert r['per_stato'] == {'completata': 1, 'nuova': 1}
+    assert r['completamento']['completate'] == 1
+    assert r['completamento']['media_ore'] == 2.5
+    assert r['completamento']['mediana_fascia'] == '1-4h'
+    # Senza data né stato: oggi, nuova, categoria e marca N/D
+    r = riepiloghi.riepilogo()
+    assert r['totale'] == 3
+    assert r['per_categoria']['N/D'] == 1
+    assert {'marca': 'N/D', 'richieste': 1} in r['per_marca']
+    assert uguale_a_ricostruzione(riepiloghi, database.connessione())
+
+
+def test_ricostruzione_delle_richieste_esistenti(database):
+    nuova(database)
+    completata = nuova(database, categoria='URGENTE')
+    database._scrivi(
+        "UPDATE richieste SET stato = 'completata', "
+        "data_completamento = datetime(data_richiesta, '+5 hours') "
+        'WHERE id = ?', (completata, ))
+
+    # Riepiloghi creati su un database che ha già richieste
+    riepiloghi = main.RiepiloghiRichieste(database)
+    r = riepiloghi.riepilogo()
+    assert r['totale'] == 2
+    assert r['completamento']['completate'] == 1
+    assert r['completamento']['mediana_fascia'] == '4-24h'
+    assert uguale_a_ricostruzione(riepiloghi, database.connessione())